@@ -0,0 +1,69 @@
+"""
+Benchmark of converting the industries from the portal into flat rows.
+
+Compares the reflection based dataclass_from_dict + process_data with the
+compiled conversion functions and the columnar table builder in
+ocems_tracker.industry.
+
+    python benchmarks/bench_industry.py
+"""
+from pathlib import Path
+import csv
+import sys
+import timeit
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from ocems_tracker.industry import Industry, dataclass_from_dict, process_data, _get_flat_fields, industries_to_columns
+
+
+def load_records(path=ROOT / "data" / "industries.csv"):
+    """Makes records in the format returned by the portal from data/industries.csv.
+    """
+    flat_fields = _get_flat_fields(Industry)
+    records = []
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            record = {}
+            for path, target in flat_fields:
+                d = record
+                for name in path[:-1]:
+                    d = d.setdefault(name, {})
+                d[path[-1]] = row[target]
+            records.append(record)
+    return records
+
+
+def old_path(records):
+    return [process_data(dataclass_from_dict(Industry, d)) for d in records]
+
+
+def compiled_path(records):
+    return [Industry.from_dict(d).to_flat_dict() for d in records]
+
+
+def direct_path(records):
+    return [Industry.flat_dict_from_dict(d) for d in records]
+
+
+def columns_path(records):
+    columns = industries_to_columns(records)
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def main():
+    records = load_records()
+    expected = old_path(records)
+    assert compiled_path(records) == expected
+    assert direct_path(records) == expected
+    assert columns_path(records) == expected
+
+    print(f"converting {len(records)} industries")
+    for name, func in [("reflection", old_path), ("compiled", compiled_path), ("direct", direct_path), ("columns", lambda r: industries_to_columns(r))]:
+        t = min(timeit.repeat(lambda: func(records), number=1, repeat=5))
+        print(f"{name:12s} {t*1000:8.1f} ms {len(records)/t:12.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    main()
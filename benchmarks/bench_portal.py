@@ -0,0 +1,104 @@
+"""
+End-to-end benchmark of the commands against a local stand-in for the portal.
+
+Runs the steps of live_data, historical_data, split_data and make_index in
+a temporary directory, with the requests to the portal answered by the
+FakePortalAdapter, and reports the throughput of each step.
+
+    python benchmarks/bench_portal.py --states 2 --latency 0.05 --workers 8
+    python benchmarks/bench_portal.py --recordings recordings.jsonl
+"""
+from pathlib import Path
+from types import SimpleNamespace
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import manage
+from ocems_tracker import scraper
+from ocems_tracker.archive import split_file
+from ocems_tracker.industry import industries_to_columns, write_columns_csv
+from ocems_tracker.writers import StreamingCSVWriter
+from fake_portal import FakePortal, FakePortalAdapter, load_recordings
+
+
+def report(name, seconds, rows=None, unit="rows"):
+    metrics = scraper.telemetry.snapshot()
+    line = f"{name:20s} {seconds:8.2f} s {metrics['requests']:7d} requests"
+    if rows is not None:
+        line += f" {rows:10d} {unit} {rows / seconds:12.0f} {unit}/sec"
+    print(line)
+    scraper.telemetry.reset()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--states", type=int, default=2)
+    p.add_argument("--cities", type=int, default=2)
+    p.add_argument("--industries", type=int, default=5, help="number of industries per city")
+    p.add_argument("--days", type=int, default=30, help="max number of days of historical data")
+    p.add_argument("--latency", type=float, default=0.0)
+    p.add_argument("--jitter", type=float, default=0.0)
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument("--batch-params", action="store_true")
+    p.add_argument("--recordings", help="JSONL file of responses saved by the RecordingAdapter")
+    args = p.parse_args()
+
+    portal = FakePortal(n_states=args.states, n_cities=args.cities, n_industries=args.industries, max_days=args.days)
+    recordings = load_recordings(args.recordings) if args.recordings else None
+    adapter = FakePortalAdapter(portal, recordings, latency=args.latency, jitter=args.jitter,
+                                error_rate=args.error_rate, seed=0)
+
+    tmp = tempfile.TemporaryDirectory()
+    # the cache and the outputs are relative to the working directory
+    os.chdir(tmp.name)
+    manage.ROOT = Path(tmp.name)
+
+    api = scraper.API()
+    adapter.mount(api.session)
+    api.policy.backoff = 0.01
+
+    t0 = time.perf_counter()
+    live = scraper.LiveDataScrapper(api, max_workers=args.workers, batch_params=args.batch_params)
+    industry_ids = api.get_industry_ids()
+    report("metadata", time.perf_counter() - t0, len(industry_ids), "industries")
+
+    t0 = time.perf_counter()
+    with StreamingCSVWriter("live-data.csv") as w:
+        w.write_rows(live.get_all_live_data())
+    report("live_data", time.perf_counter() - t0, w.row_count)
+
+    t0 = time.perf_counter()
+    history_rows = sum(manage.download_industry(live, id) for id in industry_ids)
+    report("historical_data", time.perf_counter() - t0, history_rows)
+
+    t0 = time.perf_counter()
+    split_rows = 0
+    for path in sorted(Path("cache/history").glob("*.csv.gz")):
+        split_rows += sum(split_file(path, Path("split")).values())
+    report("split_data", time.perf_counter() - t0, split_rows)
+
+    files = [SimpleNamespace(name=p.relative_to("archive").as_posix()) for p in Path("archive").glob("*/*.csv.gz")]
+    industries = {d['id']: d for d in api.get_all_industries()}
+    Path("data").mkdir()
+    t0 = time.perf_counter()
+    manage.IndexBuilder(files, industries).build()
+    report("make_index", time.perf_counter() - t0, len(files), "files")
+
+    write_columns_csv(industries_to_columns(api.get_all_industries()), "data/industries.csv")
+    t0 = time.perf_counter()
+    manage.make_local_index("data/index.csv")
+    report("make_index --local", time.perf_counter() - t0, len(files), "files")
+
+    print(f"{adapter.request_count} requests served by the fake portal")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark of removing the sensitive fields from the industry metadata.
+
+Compares the original recursive strip_sensitive_data with the Redactor,
+both on parsed data and while parsing the JSON. The metadata documents
+are generated to have the same shape and size as the responses of
+industryMapDetailNEW.
+
+    python benchmarks/bench_redact.py
+"""
+from pathlib import Path
+import json
+import sys
+import timeit
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from ocems_tracker.redact import Redactor
+
+
+def strip_sensitive_data(data):
+    """The original implementation from API.strip_sensitive_data.
+    """
+    def is_sensitive_key(key):
+        key = key.lower()
+        sensitive_names = ['email', 'phone', 'contactno', 'password', 'token']
+        return any(name in key for name in sensitive_names)
+
+    if isinstance(data, list):
+        return [strip_sensitive_data(d) for d in data]
+    elif isinstance(data, dict):
+        return {k: strip_sensitive_data(v) for k, v in data.items() if not is_sensitive_key(k)}
+    else:
+        return data
+
+
+def make_metadata(industry_id, n_stations=6, n_devices=4, n_params=8):
+    params = [
+        {"id": i, "stdParam": {"id": i, "type": "emission", "name": f"P{i}", "paramKey": f"p{i}",
+                               "label": f"Param {i}", "stdUnit": "mg/Nm3"}, "status": "ACTIVE"}
+        for i in range(n_params)
+    ]
+    stations = [
+        {"id": industry_id * 10 + s, "name": f"Stack {s}", "contactEmail": "a@example.com",
+         "devices": [{"id": s * 100 + d, "name": f"Device {d}", "make": "Make", "model": "Model",
+                      "serialNo": "1234", "params": params} for d in range(n_devices)]}
+        for s in range(n_stations)
+    ]
+    thresholds = {
+        str(station["id"]): {str(p["id"]): {"min": 0, "max": 100, "unit": "mg/Nm3"} for p in params}
+        for station in stations
+    }
+    return {
+        "industry": {"id": industry_id, "name": f"Industry {industry_id}", "contactEmail": "a@example.com",
+                     "contactNo": "9999999999", "address": "Somewhere", "city": "City",
+                     "state": {"id": 1, "name": "State", "zone": {"id": 1, "name": "Zone"}}},
+        "stations": stations,
+        "thresholdNEW": thresholds,
+        "users": [{"name": "User", "email": "u@example.com", "phoneNo": "9999", "password": "x", "authToken": "y"}],
+        "industryStatus": "live",
+    }
+
+
+def main():
+    texts = [json.dumps(make_metadata(i)) for i in range(1000)]
+    print(f"{len(texts)} documents, {sum(map(len, texts)) / len(texts) / 1024:.1f} KB each")
+
+    redactor = Redactor()
+    expected = [strip_sensitive_data(json.loads(t)) for t in texts]
+    assert [redactor.redact(json.loads(t)) for t in texts] == expected
+    assert [redactor.loads(t) for t in texts] == expected
+
+    parsed = [json.loads(t) for t in texts]
+    cases = [
+        ("strip (parsed)", lambda: [strip_sensitive_data(d) for d in parsed]),
+        ("redact (parsed)", lambda: [redactor.redact(d) for d in parsed]),
+        ("json.loads + strip", lambda: [strip_sensitive_data(json.loads(t)) for t in texts]),
+        ("redactor.loads", lambda: [redactor.loads(t) for t in texts]),
+    ]
+    for name, func in cases:
+        t = min(timeit.repeat(func, number=1, repeat=5))
+        print(f"{name:20s} {t*1000:8.1f} ms {len(texts)/t:10.0f} docs/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark of writing the rows of an industry to the yearly archive.
+
+Compares the original YearlyWriter, which converted, split and joined
+every row separately, with the chunked YearlyWriter that parses the times
+of a chunk at once and writes the lines of every year in a single write.
+Most of the time goes in the gzip compression, so the writers are also
+compared without compression, and the chunked writer with the original
+compression level of 9 and the new default of 6.
+
+    python benchmarks/bench_write.py
+"""
+from pathlib import Path
+import datetime
+import gzip
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+from ocems_tracker.archive import COLUMNS, YearlyWriter, parse_times
+
+
+class OriginalYearlyWriter:
+    """The original implementation of YearlyWriter, without append mode and rollups.
+    """
+    def __init__(self, industry_id, archive_root, compresslevel=9):
+        self.archive_root = Path(archive_root)
+        self.filename = f"{industry_id}.csv.gz"
+        self.compresslevel = compresslevel
+        self.files = {}
+
+    def get_file(self, year):
+        if year not in self.files:
+            path = self.archive_root / year / self.filename
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.files[year] = gzip.open(path, "wt", compresslevel=self.compresslevel)
+            self.files[year].write(",".join(COLUMNS) + "\n")
+        return self.files[year]
+
+    def commit(self):
+        for f in self.files.values():
+            f.close()
+
+    def write_row(self, row):
+        row = [str(x) for x in row]
+        t = row[-2]
+        year = t.split("-")[0]
+        self.get_file(year).write(",".join(row) + "\n")
+
+
+def make_rows(n, n_params=8):
+    start = datetime.datetime(2019, 12, 1)
+    step = datetime.timedelta(minutes=15)
+    rows = []
+    for i in range(n // n_params):
+        t = (start + i * step).strftime("%Y-%m-%d %H:%M:%S:000")
+        for p in range(n_params):
+            rows.append([122, 190, 3080 + p % 2, f"p{p}", f"Param {p}", t, round(10 + (i * p) % 50 * 0.7, 2)])
+    return rows
+
+
+def check_parse_times(rows):
+    times = [row[5] for row in rows[::997]]
+    expected = [int(datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S:%f")
+                    .replace(tzinfo=datetime.timezone.utc).timestamp() * 1000) for t in times]
+    assert parse_times(times).tolist() == expected
+
+
+def main():
+    rows = make_rows(1_000_000)
+    check_parse_times(rows)
+    print(f"{len(rows)} rows")
+
+    def run_original(root, compresslevel=9):
+        w = OriginalYearlyWriter(122, root, compresslevel=compresslevel)
+        for row in rows:
+            w.write_row(row)
+        w.commit()
+
+    def run_chunked(root, compresslevel=6):
+        w = YearlyWriter(122, root, compresslevel=compresslevel)
+        w.write_rows(rows)
+        w.commit()
+
+    times = [row[5] for row in rows]
+    cases = [
+        ("strptime", lambda root: [datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S:%f") for t in times]),
+        ("parse_times", lambda root: parse_times(times)),
+        ("original writer (level 0)", lambda root: run_original(root, 0)),
+        ("chunked writer (level 0)", lambda root: run_chunked(root, 0)),
+        ("original writer (level 9)", lambda root: run_original(root, 9)),
+        ("chunked writer (level 9)", lambda root: run_chunked(root, 9)),
+        ("chunked writer (level 6)", lambda root: run_chunked(root, 6)),
+    ]
+    for name, func in cases:
+        root = Path(tempfile.mkdtemp())
+        try:
+            t0 = time.perf_counter()
+            func(root)
+            t = time.perf_counter() - t0
+        finally:
+            shutil.rmtree(root)
+        print(f"{name:26s} {t:8.2f} s {len(rows) / t:12.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    main()
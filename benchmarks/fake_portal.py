@@ -0,0 +1,256 @@
+"""
+Local stand-in for the OCEMS portal at rtdms.cpcb.gov.in.
+
+The FakePortalAdapter is a transport adapter for requests, which answers
+the requests to the portal without any network access. The responses are
+replayed from a recordings file when available, and are otherwise
+generated by a FakePortal for a synthetic fleet of industries. The
+latency of the responses and the rate of errors can be configured.
+
+    api = scraper.API()
+    adapter = FakePortalAdapter(FakePortal(n_states=2), latency=0.05, error_rate=0.01)
+    adapter.mount(api.session)
+
+The responses of the real portal can be recorded using a RecordingAdapter
+and replayed later using load_recordings.
+
+    recorder = RecordingAdapter("recordings.jsonl")
+    recorder.mount(api.session)
+"""
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+import datetime
+import json
+import random
+import threading
+import time
+import zlib
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+PORTAL_URL = "https://rtdms.cpcb.gov.in/"
+
+# the portal returns data till the end of this date
+END_DATE = datetime.date(2024, 1, 10)
+
+
+class FakePortal:
+    """Generates the responses of the portal for a synthetic fleet.
+
+    There are n_cities in every state, n_industries in every city and so
+    on. The station data endpoint returns one value every 15 minutes for
+    the requested window, limited to max_days days.
+    """
+    def __init__(self, n_states=2, n_cities=2, n_industries=5, n_stations=2, n_devices=2, n_params=4, max_days=30):
+        self.n_states = n_states
+        self.n_cities = n_cities
+        self.n_industries = n_industries
+        self.n_stations = n_stations
+        self.n_devices = n_devices
+        self.n_params = n_params
+        self.max_days = max_days
+
+        self.industries = {}
+        for s in range(1, n_states + 1):
+            for c in range(1, n_cities + 1):
+                for i in range(n_industries):
+                    industry_id = (s * 100 + c) * 100 + i
+                    self.industries[industry_id] = self.make_industry(industry_id, s, f"City {s}-{c}")
+
+    def make_industry(self, industry_id, state_id, city):
+        return {
+            "id": industry_id, "name": f"Industry {industry_id}", "status": "ENABLED",
+            "createdDate": "07-Nov-2016 16:43:22", "lastUpdateDate": "10-Apr-2023 16:31:43",
+            "address": f"Plot {industry_id}", "latitude": "17.49", "longitude": "82.94",
+            "city": city, "code": f"CODE{industry_id}", "zip": "531011", "timezone": None,
+            "industryType": {"id": 20, "type": "Pharma", "description": "Under 17 category", "status": "ACTIVE"},
+            "gangaSegment": None,
+            "state": {"id": state_id, "name": f"State {state_id}", "zone": {"id": 7, "name": "Zone"}, "isGangaBasin": False},
+            "contactEmail": "a@example.com", "contactNo": "9999999999",
+            "consumerLastDataAt": "07-Aug-2024 15:30:00", "spcbRegionalOffice": "RO",
+            "listOfEntities": None, "gangaBasin": False, "isGangaBasin": False,
+        }
+
+    def get_station_ids(self, industry_id):
+        return [industry_id * 10 + s for s in range(self.n_stations)]
+
+    def get_params(self):
+        return [{"id": p, "type": "emission", "name": f"P{p}", "paramKey": f"p{p}",
+                 "label": f"Param {p}", "stdUnit": "mg/Nm3"} for p in range(self.n_params)]
+
+    def make_metadata(self, industry_id):
+        params = [{"id": p["id"], "stdParam": p, "status": "ACTIVE"} for p in self.get_params()]
+        stations = [
+            {"id": station_id, "name": f"Stack {station_id}", "contactEmail": "a@example.com",
+             "devices": [{"id": station_id * 10 + d, "name": f"Device {d}", "params": params}
+                         for d in range(self.n_devices)]}
+            for station_id in self.get_station_ids(industry_id)
+        ]
+        thresholds = {
+            str(station["id"]): {str(p["id"]): {"min": 0, "max": 100} for p in self.get_params()}
+            for station in stations
+        }
+        return {
+            "industry": self.industries[industry_id],
+            "stations": stations,
+            "thresholdNEW": thresholds,
+            "users": [{"name": "User", "email": "u@example.com", "password": "x"}],
+            "industryStatus": "live",
+        }
+
+    def get_days(self, start_date):
+        # start date looks like 2d-ago or 10y-ago
+        n, unit = int(start_date[:-5]), start_date[-5]
+        days = n * 365 if unit == "y" else n
+        return min(days, self.max_days)
+
+    def make_values(self, station_id, device_id, param_key, start_date):
+        days = self.get_days(start_date)
+        start = datetime.datetime.combine(END_DATE, datetime.time()) - datetime.timedelta(days=days)
+        step = datetime.timedelta(minutes=15)
+        seed = zlib.crc32(f"{station_id}/{device_id}/{param_key}".encode()) % 100
+        return [{"time": (start + i * step).strftime("%Y-%m-%d %H:%M:%S:000"),
+                 "value": round(50 + 60 * ((i * 7 + seed) % 100) / 100, 2)}
+                for i in range(days * 96)]
+
+    def handle(self, method, path, body=None):
+        """Returns the status code and the data of the response for a request.
+        """
+        parts = [unquote(p) for p in path.strip("/").split("/")]
+        if parts[:1] != ["api"]:
+            return 404, {"error": "not found"}
+        parts = parts[1:]
+        name = parts[0] if parts else ""
+
+        if name == "getAllState":
+            return 200, [{"id": s, "name": f"State {s}"} for s in range(1, self.n_states + 1)]
+        elif name == "getAllCity":
+            state_id = int(parts[1])
+            return 200, [{"id": state_id, "city": f"City {state_id}-{c}"} for c in range(1, self.n_cities + 1)]
+        elif name == "industryList":
+            city = parts[3]
+            return 200, [d for d in self.industries.values() if d["city"] == city]
+        elif name == "industryListStatus":
+            city = parts[3]
+            return 200, [{"id": d["id"], "status": "live"} for d in self.industries.values()
+                         if d["city"] == city and d["id"] % 3]
+        elif name == "industryMapDetailNEW":
+            industry_id = int(parts[1])
+            if industry_id not in self.industries:
+                return 200, {}
+            return 200, self.make_metadata(industry_id)
+        elif name == "stations" and parts[-1] == "data" and method == "POST":
+            station_id, device_id = int(parts[1]), int(parts[3])
+            payload = json.loads(body)
+            params = {p["paramKey"]: p["name"] for p in self.get_params()}
+            return 200, {params[key]: self.make_values(station_id, device_id, key, payload["startDate"])
+                         for key in payload["param"].split(",") if key in params}
+        return 404, {"error": "not found"}
+
+
+def get_recording_key(method, url, body=None):
+    if isinstance(body, bytes):
+        body = body.decode()
+    return f"{method} {url} {body or ''}"
+
+
+def load_recordings(path):
+    """Loads the responses saved by the RecordingAdapter.
+
+    Returns a dict with the key of the request as key and (status, content) as value.
+    """
+    recordings = {}
+    with open(path) as f:
+        for line in f:
+            d = json.loads(line)
+            key = get_recording_key(d["method"], d["url"], d["body"])
+            recordings[key] = (d["status"], d["content"].encode())
+    return recordings
+
+
+def make_response(request, status, content):
+    r = requests.Response()
+    r.status_code = status
+    r.reason = "OK" if status < 400 else "Error"
+    r._content = content
+    r.headers["Content-Type"] = "application/json"
+    r.encoding = "utf-8"
+    r.url = request.url
+    r.request = request
+    return r
+
+
+class FakePortalAdapter(BaseAdapter):
+    """Transport adapter that answers the requests to the portal locally.
+
+    Every response is delayed by latency seconds, plus a random jitter of
+    up to jitter seconds. A fraction error_rate of the requests fail with
+    the error_status, and a fraction timeout_rate of them raise a timeout.
+    """
+    def __init__(self, portal=None, recordings=None, latency=0, jitter=0,
+                 error_rate=0, error_status=503, timeout_rate=0, seed=None):
+        super().__init__()
+        self.portal = portal or FakePortal()
+        self.recordings = recordings or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.timeout_rate = timeout_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    def mount(self, session):
+        # the prefix is longer than https:// so that this adapter is used
+        # even when another adapter is mounted for https://
+        session.mount(PORTAL_URL, self)
+        return session
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.request_count += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            x = self.random.random()
+        if delay:
+            time.sleep(delay)
+
+        if x < self.timeout_rate:
+            raise requests.exceptions.ConnectTimeout(f"injected timeout for {request.url}", request=request)
+        if x < self.timeout_rate + self.error_rate:
+            return make_response(request, self.error_status, b'{"error": "injected error"}')
+
+        key = get_recording_key(request.method, request.url, request.body)
+        if key in self.recordings:
+            status, content = self.recordings[key]
+            return make_response(request, status, content)
+
+        status, data = self.portal.handle(request.method, urlparse(request.url).path, request.body)
+        return make_response(request, status, json.dumps(data).encode())
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Transport adapter that saves the responses of the portal to a JSONL
+    file, which can be loaded using load_recordings.
+    """
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        self.lock = threading.Lock()
+
+    def mount(self, session):
+        session.mount(PORTAL_URL, self)
+        return session
+
+    def send(self, request, **kwargs):
+        r = super().send(request, **kwargs)
+        body = request.body.decode() if isinstance(request.body, bytes) else request.body
+        record = dict(method=request.method, url=request.url, body=body, status=r.status_code, content=r.text)
+        with self.lock:
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+        return r
@@ -1,6 +1,19 @@
 import click
 from ocems_tracker import scraper
-from ocems_tracker.industry import Industry
+from ocems_tracker.industry import count_changed, industries_to_columns, read_rows_csv, read_rows_parquet, write_columns_csv, write_columns_parquet
+from ocems_tracker.writers import StreamingCSVWriter, get_tmp_path
+from ocems_tracker.history import HistoryState
+from ocems_tracker.manifest import Manifest, ManifestEntry
+from ocems_tracker.merge import ArchiveMerger, read_csv_rows
+from ocems_tracker.exceedance import EventWriter, ExceedanceDetector
+from ocems_tracker.archive import COLUMNS, HEADER, YearlyWriter, encode_rows, iter_chunks, split_file
+from ocems_tracker.parquet import YearlyParquetWriter, split_file_parquet
+from ocems_tracker.query import ArchiveQuery
+from ocems_tracker.rollup import Rollup
+from ocems_tracker.status import StatusHistory
+from ocems_tracker.telemetry import Reporter
+from ocems_tracker.upload import InternetArchiveClient, LocalArchiveClient, UploadJournal, Uploader
+from ocems_tracker.workqueue import Heartbeat, LeaseLost, WorkQueue, get_worker_id
 import pandas as pd
 from pathlib import Path
 import shutil
@@ -9,6 +22,11 @@ import logging
 import csv
 import gzip
 import internetarchive as ia
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+import functools
+import itertools
+import os
 
 # Disable urllib3 warnings
 import urllib3
@@ -33,25 +51,69 @@ def setup_logger(verbose=False, format="short"):
 
 
 @click.group()
-def app():
-    pass
+@click.option("--metrics", help="Save the metrics of the download commands to this file, as JSON if it ends with .json or as a Prometheus textfile otherwise")
+@click.option("--report-interval", default=30, help="Seconds between the summaries of the metrics")
+@click.pass_context
+def app(ctx, metrics, report_interval):
+    # saves the access times of the entries read from the cache
+    ctx.call_on_close(scraper.cache.close)
+
+def with_reporter(f):
+    """Decorator for the commands that download from the portal, which
+    reports their metrics while they run, as per the --metrics and
+    --report-interval options of the app.
+    """
+    @click.pass_context
+    @functools.wraps(f)
+    def wrapper(ctx, *args, **kwargs):
+        options = ctx.find_root().params
+        telemetry = scraper.telemetry
+        telemetry.name = ctx.info_name
+        with Reporter(telemetry, interval=options["report_interval"], path=options["metrics"]):
+            return f(*args, **kwargs)
+    return wrapper
 
 @app.command()
-def download_industries():
+@click.option("--workers", default=8, help="Number of concurrent requests")
+@click.option("--format", "format", type=click.Choice(["csv", "parquet"]), default="csv", help="Format of the output file")
+@click.option("--incremental", is_flag=True, help="Convert only the industries whose lastUpdateDate changed")
+def download_industries(workers, format, incremental):
     api = scraper.API()
+    api.prefetch_industries(max_workers=workers)
 
     industries = api.get_all_industries()
-    data = [Industry.from_dict(ind).to_flat_dict() for ind in industries]
-    df = pd.DataFrame(data)
-    df.to_csv("data/industries.csv", index=False)
+    path = Path(f"data/industries.{format}")
+
+    existing_rows = None
+    if incremental and path.exists():
+        existing_rows = read_rows_csv(path) if format == "csv" else read_rows_parquet(path)
+        changed = count_changed(industries, existing_rows)
+        if changed == 0 and len(existing_rows) == len(industries):
+            logger.info("none of the %d industries changed, %s is up to date", len(industries), path)
+            return
+        logger.info("converting %d new or changed industries", changed)
+
+    # the rows of the industries that didn't change are reused
+    columns = industries_to_columns(industries, existing_rows)
+    if format == "csv":
+        write_columns_csv(columns, path)
+    else:
+        write_columns_parquet(columns, path)
+    logger.info("saved %d industries", len(columns["id"]))
 
 
 @app.command()
-def download_industry_metadata():
+@click.option("--workers", default=8, help="Number of concurrent requests")
+def download_industry_metadata(workers):
     api = scraper.API()
-    # this saves the JSONL file in cache
+    # fill the cache of individual industries in parallel,
+    # skipping the ones that are already downloaded
+    api.prefetch_industry_metadata(max_workers=workers)
+    # this saves the JSONL file in cache, only when all the industries are fetched
     api.get_all_industry_metadata()
-    shutil.copy("cache/industry-metadata/all.jsonl", "data/industry-metadata.jsonl")
+    if not scraper.cache.exists("industry-metadata/all.jsonl"):
+        raise click.ClickException("Failed to fetch the metadata of some industries. Run the command again to retry them.")
+    scraper.cache.dump("industry-metadata/all.jsonl", "data/industry-metadata.jsonl")
     print("generated data/industry-metadata.jsonl")
 
 @app.command()
@@ -59,16 +121,31 @@ def download_param_metadata():
     api = scraper.API()
     # this saves the JSONL file in cache
     api.get_all_param_metadata()
-    shutil.copy("cache/param-metadata.jsonl", "data/param-metadata.jsonl")
+    scraper.cache.dump("param-metadata.jsonl", "data/param-metadata.jsonl")
     print("generated data/param-metadata.jsonl")
 
+@app.command()
+def cache_stats():
+    """Prints the number of entries and the size of the cache.
+    """
+    for k, v in scraper.cache.stats().items():
+        print(f"{k}: {v}")
+
+@app.command()
+@click.argument("path", default="cache/")
+def cache_import(path):
+    """Imports an existing cache directory with one json file per key into the cache.
+    """
+    scraper.cache.import_dir(path)
+
 @app.command
-def industry_status():
+@click.option("--workers", default=8, help="Number of concurrent requests")
+def industry_status(workers):
     """Downloads status of all industries.
     """
     logger.info("Downloading industry status of all industries")
     api = scraper.API()
-    data = api.get_all_industry_status()
+    data = api.get_all_industry_status(max_workers=workers)
     date = api.today()
     df = pd.DataFrame(data)
     path = Path(f"daily/status/{date}.csv")
@@ -76,63 +153,219 @@ def industry_status():
     df.to_csv(path, index=False)
     logger.info("saved the industry status to %s", path)
 
+    history = StatusHistory.load(STATUS_HISTORY_PATH)
+    history.append(date, dict(zip(df.industry_id, df.status)))
+    history.save(STATUS_HISTORY_PATH)
+    logger.info("updated the status history %s", STATUS_HISTORY_PATH)
+
+STATUS_HISTORY_PATH = "daily/status-history.npz"
+
+@app.command()
+def import_status_history():
+    """Builds the status history from the daily status files in daily/status/.
+    """
+    history = StatusHistory()
+    for path in sorted(Path("daily/status").glob("*.csv")):
+        df = pd.read_csv(path)
+        history.append(path.stem, dict(zip(df.industry_id, df.status)))
+    history.save(STATUS_HISTORY_PATH)
+    logger.info("saved the status history of %d days to %s", len(history.dates), STATUS_HISTORY_PATH)
+
+@app.command()
+@click.option("--start", help="Start date (inclusive), eg: 2023-01-01")
+@click.option("--end", help="End date (exclusive), eg: 2024-01-01")
+@click.option("-o", "--output", default="-", help="Path of the output csv file")
+def status_report(start, end, output):
+    """Reports the uptime and the longest outage of every industry.
+    """
+    history = StatusHistory.load(STATUS_HISTORY_PATH)
+    uptime = history.uptime(start, end)
+    outage = history.longest_outage(start, end)
+    df = pd.DataFrame({
+        "industry_id": list(uptime),
+        "uptime_percent": list(uptime.values()),
+        "longest_outage_days": [outage[id] for id in uptime],
+    })
+    df.sort_values("industry_id", inplace=True)
+    with click.open_file(output, "w") as f:
+        df.to_csv(f, index=False)
+
 @app.command()
-def live_data():
+@with_reporter
+@click.option("--workers", default=8, help="Number of concurrent requests")
+@click.option("--rate-limit", default=10.0, help="Max requests per second to the portal, 0 for no limit")
+@click.option("-o", "--output", default="live-data.csv", help="Path of the output file")
+@click.option("--gzip", "compress", is_flag=True, help="Compress the output using gzip")
+@click.option("--split-by-date", is_flag=True, help="Write one file per date")
+@click.option("--batch-params", is_flag=True, help="Fetch all params of a device in a single request")
+@click.option("--archive", "merge_archive", is_flag=True, help="Also merge the rows into the archive, skipping the readings already archived")
+@click.option("--events", "events_path", help="Also add the threshold exceedance events to this csv.gz file")
+@click.option("--state", "state_path", help="Keep the open events and the last time of every param in this file between runs")
+def live_data(workers, rate_limit, output, compress, split_by_date, batch_params, merge_archive, events_path, state_path):
     """Fetch live parameter values for all industries for yesterday.
+
+    The rows are written to the output file as they are downloaded.
+
+    With --events and --state, the events already reported in the earlier
+    runs on the overlapping windows are not added again.
     """
     api = scraper.API()
-    live = scraper.LiveDataScrapper(api)
+    live = scraper.LiveDataScrapper(api, max_workers=workers, rate_limit=rate_limit, batch_params=batch_params)
+
+    if compress and not output.endswith(".gz"):
+        output += ".gz"
+    if split_by_date and "{date}" not in output:
+        # live-data.csv -> live-data-{date}.csv
+        path = Path(output)
+        ext = "".join(path.suffixes)
+        name = path.name[:len(path.name) - len(ext)]
+        output = str(path.with_name(f"{name}-{{date}}{ext}"))
 
     data = live.get_all_live_data()
-    df = pd.DataFrame(data)
-    df.to_csv("live-data.csv", index=False)
+    if events_path:
+        # the events are detected while the rows are written
+        detector = ExceedanceDetector.from_param_index(live.param_index)
+        if state_path:
+            detector.load_state(state_path)
+        events = []
+        data = detector.watch(data, events)
+
+    with StreamingCSVWriter(output, compress=compress, split_by_date=split_by_date) as w:
+        w.write_rows(data)
+    logger.info("saved %d rows to %s", w.row_count, output)
+
+    if events_path:
+        save_events(detector, events, events_path, state_path)
+
+    if merge_archive:
+        merger = ArchiveMerger(ROOT / "archive", HISTORY_STATE_ROOT)
+        merger.merge(itertools.chain.from_iterable(read_csv_rows(p) for p in w.saved_paths))
+
+@app.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--window-days", default=3, help="Number of days before the last archived time for which the archived times are remembered")
+@click.option("--max-rows", default=1000000, help="Max number of rows to sort in memory")
+def merge(paths, window_days, max_rows):
+    """Merges data files, like the output of live_data, into the archive.
+
+    The readings that are already in the archive are skipped.
+    """
+    merger = ArchiveMerger(ROOT / "archive", HISTORY_STATE_ROOT, window_days=window_days, max_rows=max_rows)
+    merger.merge(itertools.chain.from_iterable(read_csv_rows(p) for p in paths))
+
+@app.command()
+@click.argument("paths", nargs=-1)
+@click.option("-i", "--industry", "industry_ids", multiple=True, help="Industry id (can be repeated)")
+@click.option("--start", help="Start date (inclusive), eg: 2019-03 or 2019-03-01")
+@click.option("--end", help="End date (exclusive), eg: 2019-04 or 2019-04-01")
+@click.option("-o", "--output", default="exceedances.csv.gz", help="Path of the events file, the new events are added to it")
+@click.option("--max-gap", default=60, help="Max minutes between two readings of the same event")
+@click.option("--state", "state_path", help="Keep the open events and the last time of every param in this file between runs")
+def exceedances(paths, industry_ids, start, end, output, max_gap, state_path):
+    """Finds the events of readings above the threshold of their param.
+
+    The rows are read from the given data files, like the output of
+    live_data, or from the local archive when no paths are given.
+
+    With --state, the readings processed in the earlier runs are skipped and
+    the events still open are saved to the state instead of the output, so
+    the command can be run on overlapping windows of the live data.
+    """
+    if paths:
+        rows = itertools.chain.from_iterable(read_csv_rows(p) for p in paths)
+    else:
+        q = ArchiveQuery(ROOT / "archive", ROOT / "data" / "index.csv")
+        rows = q.query(industry_ids, start=start, end=end)
+
+    detector = ExceedanceDetector(get_thresholds(), max_gap=max_gap)
+    if state_path:
+        detector.load_state(state_path)
+    save_events(detector, detector.process(rows), output, state_path)
+
+def save_events(detector, events, output, state_path=None):
+    """Adds the events to the output file.
+
+    When there is a state file, the events still open are saved to the state
+    to be continued in the next run. Otherwise they are added as ongoing.
+    """
+    with EventWriter(output) as w:
+        w.write_events(events)
+        if state_path:
+            logger.info("%d events are still open", len(detector.open_events))
+        else:
+            w.write_events(detector.finish(), ongoing=True)
+
+    if detector.skipped_count:
+        logger.info("skipped %d readings that were not newer than the last reading of their param", detector.skipped_count)
+    if state_path:
+        detector.save_state(state_path)
+
+FORMATS = ["csv", "parquet", "both"]
+
+@app.command()
+@with_reporter
+@click.option("--workers", default=8, help="Number of concurrent requests")
+@click.option("-o", "--output", default="retried-data.csv", help="Path of the output file")
+def retry_failed(workers, output):
+    """Retries fetching the params that failed in the earlier runs.
+
+    The failed params are saved in cache/dead-letters.jsonl.
+    """
+    api = scraper.API()
+    live = scraper.LiveDataScrapper(api, max_workers=workers)
+
+    data = live.retry_failed()
+    with StreamingCSVWriter(output) as w:
+        w.write_rows(data)
+    logger.info("saved %d rows to %s", w.row_count, output)
 
 @app.command()
 @click.argument("path")
-def split_data(path):
+@click.option("--compresslevel", default=6, help="gzip compression level of the output files")
+@click.option("--format", "format", type=click.Choice(FORMATS), default="csv", help="Format of the output files")
+@click.option("--rollups", is_flag=True, help="Also compute the hourly, daily and monthly rollups")
+def split_data(path, compresslevel, format, rollups):
     """Splits a csv.gz data file for an industry by year.
     """
-    path = Path(path)
-    print("splitting", path)
-
-    root = Path(__file__).parent.resolve() / "archive"
-
-    files = {}
-    def get_file(year):
-        year = str(year)
-        if year not in files:
-            new_path = ROOT / "archive" / year / (path.name + ".tmp")
-            new_path.parent.mkdir(parents=True, exist_ok=True)
-            print(year, new_path)
-            files[year] = gzip.open(new_path, "wt")
-            files[year].write(header)
-        return files[year]
-
-    with gzip.open(path, "rt") as f:
-        header = f.readline()
-
-        for line in f:
-            t = line.split(",")[-2] # eg: 2016-01-01 01:30:00:000
-            year = t.split("-")[0]
-            get_file(year).write(line)
-
-    for f in files.values():
-        f.close()
-
-        filename1 = f.name
-        filename2 = filename1.replace(".tmp", "")
-        shutil.move(filename1, filename2)
-        print("saved", filename2)
+    if format in ["csv", "both"]:
+        split_file(path, ROOT / "archive", compresslevel=compresslevel, **get_rollup_options(rollups))
+    if format in ["parquet", "both"]:
+        split_file_parquet(path, ROOT / "parquet")
 
 @app.command
-def archive():
+@click.option("--workers", default=os.cpu_count(), help="Number of worker processes")
+@click.option("--compresslevel", default=6, help="gzip compression level of the output files")
+@click.option("--max-open-files", default=16, help="Max number of output files kept open by each worker")
+@click.option("--buffer-size", default=1024*1024, help="Size of the read and write buffers in bytes")
+@click.option("--rollups", is_flag=True, help="Also compute the hourly, daily and monthly rollups")
+def archive(workers, compresslevel, max_open_files, buffer_size, rollups):
     """Archive the historical data to internet archive item ocems-data-archive.
+
+    The files in cache/history/ are split by year using a pool of processes.
     """
-    for p in sorted(Path("cache/history/").glob("*.csv.gz"), key=lambda p: int(p.name.split(".")[0])):
-        split_data_by_year(p)
+    paths = sorted(Path("cache/history/").glob("*.csv.gz"), key=lambda p: int(p.name.split(".")[0]))
+    logger.info("Archiving %d files using %d workers", len(paths), workers)
+
+    split = functools.partial(split_file,
+        archive_root=ROOT / "archive",
+        compresslevel=compresslevel,
+        max_open_files=max_open_files,
+        buffer_size=buffer_size,
+        **get_rollup_options(rollups))
+
+    with ProcessPoolExecutor(workers) as executor:
+        for path, row_counts in zip(paths, executor.map(split, paths)):
+            logger.info("archived %s - %d rows", path, sum(row_counts.values()))
 
 @app.command
-def historical_data():
+@with_reporter
+@click.option("--incremental", is_flag=True, help="Download only the data newer than what is archived")
+@click.option("--format", "format", type=click.Choice(FORMATS), default="csv", help="Format of the output files")
+@click.option("--rollups", is_flag=True, help="Also compute the hourly, daily and monthly rollups")
+def historical_data(incremental, format, rollups):
+    if incremental and format != "csv":
+        raise click.UsageError("--incremental is supported only for the csv format")
+
     api = scraper.API()
     live = scraper.LiveDataScrapper(api)
     industry_ids = [int(line) for line in open("active.txt")]
@@ -140,22 +373,170 @@ def historical_data():
     logger.info("Starting download of historical data")
     logger.info("Found %d industries", len(industry_ids))
 
+    rollup_options = get_rollup_options(rollups)
+    scraper.telemetry.add_total(live.count_params(industry_ids))
+
     for industry_id in industry_ids:
-        download_historical_data(live, industry_id)
-        split_data(f"cache/history/{industry_id}.csv.gz")
+        download_industry(live, industry_id, incremental, format, rollup_options)
 
     logger.info("Download of historical data is complete")
 
+QUEUE_PATH = "cache/queue.db"
+
+@app.command()
+@click.option("--shard-size", default=10, help="Number of industries in each shard")
+@click.option("--reset", is_flag=True, help="Clear the queue before adding the industries")
+def queue_init(shard_size, reset):
+    """Adds the industries in active.txt to the work queue used by queue_worker.
+    """
+    industry_ids = [int(line) for line in open("active.txt")]
+    queue = WorkQueue(QUEUE_PATH)
+    count = queue.init(industry_ids, shard_size=shard_size, reset=reset)
+    logger.info("added %d industries to %s", count, QUEUE_PATH)
+
+@app.command()
+@with_reporter
+@click.option("--worker-id", default=get_worker_id, help="Name of the worker, defaults to hostname:pid")
+@click.option("--lease-timeout", default=300, help="Seconds after which the shard of a worker that stopped responding is given to another worker")
+@click.option("--incremental", is_flag=True, help="Download only the data newer than what is archived")
+@click.option("--format", "format", type=click.Choice(FORMATS), default="csv", help="Format of the output files")
+@click.option("--rollups", is_flag=True, help="Also compute the hourly, daily and monthly rollups")
+def queue_worker(worker_id, lease_timeout, incremental, format, rollups):
+    """Downloads the historical data of the industries in the work queue.
+
+    Any number of workers can be started, on the same machine or on
+    machines sharing this directory. Each worker takes one shard at a
+    time and stops when there are no more shards left.
+    """
+    if incremental and format != "csv":
+        raise click.UsageError("--incremental is supported only for the csv format")
+
+    queue = WorkQueue(QUEUE_PATH, lease_timeout=lease_timeout)
+    api = scraper.API()
+    live = scraper.LiveDataScrapper(api)
+    rollup_options = get_rollup_options(rollups)
+
+    while True:
+        shard = queue.claim(worker_id)
+        if shard is None:
+            break
+        logger.info("worker %s took shard %d with %d pending industries", worker_id, shard.id, len(shard.pending_ids))
+        scraper.telemetry.add_total(live.count_params(shard.pending_ids))
+        try:
+            with Heartbeat(queue, shard) as heartbeat:
+                for industry_id in shard.pending_ids:
+                    if heartbeat.lost.is_set():
+                        raise LeaseLost(f"worker {worker_id} has lost the lease on shard {shard.id}")
+                    row_count = download_industry(live, industry_id, incremental, format, rollup_options)
+                    queue.mark_done(shard, industry_id, row_count)
+        except LeaseLost:
+            logger.error("skipping the rest of shard %d", shard.id)
+            continue
+        except KeyboardInterrupt:
+            queue.release(shard)
+            raise
+        except Exception as e:
+            logger.exception("Failed to process shard %d", shard.id)
+            queue.fail(shard, e)
+            continue
+        queue.complete(shard)
+
+    logger.info("worker %s is done, no more shards in the queue", worker_id)
+
+@app.command()
+def queue_status():
+    """Prints the progress of the work queue.
+    """
+    queue = WorkQueue(QUEUE_PATH)
+    for k, v in queue.status().items():
+        print(f"{k}: {v}")
+
 @app.command()
-def make_index():
+@click.option("-i", "--industry", "industry_ids", multiple=True, help="Industry id (can be repeated)")
+@click.option("--state", "states", multiple=True, help="State name (can be repeated)")
+@click.option("--city", "cities", multiple=True, help="City name (can be repeated)")
+@click.option("-p", "--param", "param_keys", multiple=True, help="Param key like pm (can be repeated)")
+@click.option("--start", help="Start date (inclusive), eg: 2019-03 or 2019-03-01")
+@click.option("--end", help="End date (exclusive), eg: 2019-04 or 2019-04-01")
+@click.option("-o", "--output", default="-", help="Path of the output csv file")
+def query(industry_ids, states, cities, param_keys, start, end, output):
+    """Query the data in the local archive.
+    """
+    q = ArchiveQuery(ROOT / "archive", ROOT / "data" / "index.csv")
+    rows = q.query(industry_ids, states, cities, param_keys, start, end)
+
+    with click.open_file(output, "w") as f:
+        w = csv.writer(f)
+        w.writerow(COLUMNS)
+        w.writerows(rows)
+
+@app.command()
+@click.option("--local", is_flag=True, help="Build the index from the manifest of the local archive and data/industries.csv")
+def make_index(local):
+    if local:
+        make_local_index("data/index.csv")
+        return
     builder = IndexBuilder()
     builder.build()
 
+@app.command()
+def update_manifest():
+    """Adds the archive files that are missing in the manifest or have changed.
+    """
+    count = Manifest.for_archive(ROOT / "archive").refresh()
+    logger.info("updated %d entries in the manifest", count)
+
+UPLOAD_JOURNAL_PATH = "cache/upload-journal.jsonl"
+
+@app.command()
+@click.option("--workers", default=4, help="Number of concurrent uploads")
+@click.option("--year", "years", multiple=True, help="Upload only the files of this year (can be repeated)")
+@click.option("--dest", help="Copy the files to this directory instead of uploading to internet archive")
+@click.option("--dry-run", is_flag=True, help="Only print the files that would be uploaded")
+def upload(workers, years, dest, dry_run):
+    """Uploads the archive files to the internet archive item ocems-data-archive.
+
+    The files already in the item with the same md5 are skipped. The
+    uploads are recorded in cache/upload-journal.jsonl, so an interrupted
+    upload can be resumed by running this again.
+    """
+    client = LocalArchiveClient(dest) if dest else InternetArchiveClient("ocems-data-archive")
+    uploader = Uploader(client, ROOT / "archive", UploadJournal(UPLOAD_JOURNAL_PATH))
+    result = uploader.run(years, max_workers=workers, dry_run=dry_run)
+    if result["failed"]:
+        raise click.ClickException(f"Failed to upload {result['failed']} files")
+
+ARCHIVE_DOWNLOAD_URL = "https://archive.org/download/ocems-data-archive/"
+
+def make_local_index(output_path, industries_path="data/industries.csv"):
+    """Builds the index from the manifest of the local archive, without
+    listing the files of the archive item or fetching the industries.
+    """
+    entries = Manifest.for_archive(ROOT / "archive").entries()
+    df = pd.DataFrame([dataclasses.astuple(e) for e in entries],
+                      columns=[f.name for f in dataclasses.fields(ManifestEntry)])
+    industries = pd.read_csv(industries_path, usecols=["id", "name", "city", "state_name"])
+    industries.columns = ["industry_id", "industry_name", "city", "state"]
+
+    df = df.merge(industries, on="industry_id", how="left")
+    df["download_url"] = ARCHIVE_DOWNLOAD_URL + df.path
+    columns = ["industry_id", "industry_name", "city", "state", "year", "download_url"]
+    df = df[columns].sort_values(["industry_id", "year"])
+    df.to_csv(output_path, index=False)
+    logger.info("saved %s with %d files", output_path, len(df))
+
 class IndexBuilder:
-    def __init__(self):
-        item = ia.get_item("ocems-data-archive")
-        self.files = [name for name in item.get_files(glob_pattern="*/*.csv.gz")]
-        self.industries = self.get_industry_names()
+    """Builds data/index.csv from the files in the archive item.
+
+    The files and the industries are fetched from internet archive and the
+    portal unless they are specified.
+    """
+    def __init__(self, files=None, industries=None):
+        if files is None:
+            item = ia.get_item("ocems-data-archive")
+            files = [name for name in item.get_files(glob_pattern="*/*.csv.gz")]
+        self.files = files
+        self.industries = industries if industries is not None else self.get_industry_names()
 
     def get_industry_names(self):
         api = scraper.API()
@@ -177,88 +558,131 @@ class IndexBuilder:
         name = industry['name']
         city = industry['city']
         state = industry['state']['name']
-        url = f"https://archive.org/download/ocems-data-archive/{year}/{filename}"
+        url = f"{ARCHIVE_DOWNLOAD_URL}{year}/{filename}"
         return [industry_id, name, city, state, year, url]
 
     def build(self):
         self.make_index("data/index.csv", self.files)
 
 @app.command
+@with_reporter
 @click.argument("industry_id")
-def download_data(industry_id):
+@click.option("--incremental", is_flag=True, help="Download only the data newer than what is archived")
+@click.option("--format", "format", type=click.Choice(FORMATS), default="csv", help="Format of the output files")
+@click.option("--rollups", is_flag=True, help="Also compute the hourly, daily and monthly rollups")
+def download_data(industry_id, incremental, format, rollups):
+    if incremental and format != "csv":
+        raise click.UsageError("--incremental is supported only for the csv format")
+
     api = scraper.API()
     live = scraper.LiveDataScrapper(api)
+    if incremental:
+        scraper.telemetry.add_total(live.count_params([industry_id]))
+        download_incremental_data(live, industry_id, get_rollup_options(rollups))
+        return
     logger.info("Starting download of historical data for industry %s", industry_id)
+    scraper.telemetry.add_total(live.count_params([industry_id]))
     data = live.get_historical_data(industry_id)
-    w = YearlyWriter(industry_id)
-    w.write_rows(data)
-    w.commit()
+
+    writers = []
+    if format in ["csv", "both"]:
+        rollup = rollups and Rollup(industry_id, **get_rollup_options(rollups))
+        writers.append(YearlyWriter(industry_id, ROOT / "archive", rollup=rollup))
+    if format in ["parquet", "both"]:
+        writers.append(YearlyParquetWriter(industry_id, ROOT / "parquet"))
+
+    for row in data:
+        for w in writers:
+            w.write_row(row)
+    for w in writers:
+        w.commit()
 
 ROOT = Path(__file__).parent.resolve()
 
-class YearlyWriter:
-    def __init__(self, industry_id):
-        self.industry_id = industry_id
-        self.filename = industry_id + ".csv.gz"
-        self.files = {}
-        self.columns = "industry_id station_id device_id param_key param_label time value".split()
-
-    def get_file(self, year):
-        if year not in self.files:
-            filename = f"{self.industry_id}.csv.gz.tmp"
-            path = ROOT / "archive" / year / filename
-            self.files[year] = gzip.open(path, "wt")
-        return self.files[year]
-
-    def commit(self):
-        """Saves all the files"""
-        for f in self.files.values():
-            f.close()
-
-            print(f)
-            print(f.name)
-            name = Path(f.name).with_suffix("") # remove .tmp suffix
-            shutil.move(f.name, name)
-            logger.info("saving file %s", name)
-
-    def rollback(self):
-        """Deletes all the files written.
-        """
-        for f in self.files.values():
-            Path(f.name).unlink()
-
-    def write_rows(self, rows):
-        for row in rows:
-            self.write_row(row)
-
-    def write_row(self, row):
-        # row will be of the following format
-        # 122,190,3080,pm,PM,2016-01-08 16:15:00:000,13.5
-        row = [str(x) for x in row]
-        t = row[-2]
-        year = t.split("-")[0]
-        self.get_file(year).write(",".join(row))
+HISTORY_STATE_ROOT = "cache/history/state"
+
+def get_thresholds():
+    api = scraper.API()
+    return scraper.load_param_index(api).get_thresholds()
+
+def get_rollup_options(rollups):
+    """Returns the rollup options to pass to split_file or Rollup.
+    """
+    if not rollups:
+        return {}
+    return dict(rollup_root=ROOT / "rollups", thresholds=get_thresholds())
+
+def download_industry(live, industry_id, incremental=False, format="csv", rollup_options=None):
+    """Downloads the historical data of an industry and adds it to the archive.
+
+    Returns the number of rows added to the archive.
+    """
+    rollup_options = rollup_options or {}
+    if incremental:
+        return download_incremental_data(live, industry_id, rollup_options)
+
+    download_historical_data(live, industry_id)
+    path = f"cache/history/{industry_id}.csv.gz"
+    row_count = 0
+    if format in ["csv", "both"]:
+        row_count = sum(split_file(path, ROOT / "archive", **rollup_options).values())
+    if format in ["parquet", "both"]:
+        split_file_parquet(path, ROOT / "parquet")
+    return row_count
+
+def download_incremental_data(live, industry_id, rollup_options=None):
+    """Downloads the data of an industry that is newer than what is already
+    archived and appends it to the yearly files in the archive.
+
+    The rollups are also updated when rollup_options are specified.
+    """
+    logger.info("Downloading incremental data for industry %s", industry_id)
+    state = HistoryState.load(HISTORY_STATE_ROOT, industry_id, archive_root=ROOT / "archive")
+    data = live.get_incremental_data(industry_id, state)
+
+    # track the new timestamps separately as the state is also used to
+    # filter the rows while they are being downloaded
+    new_state = HistoryState(state.path, dict(state.last_times))
+    row_count = 0
+
+    rollup = rollup_options and Rollup(industry_id, append=True, **rollup_options)
+    w = YearlyWriter(industry_id, ROOT / "archive", append=True, rollup=rollup)
+    try:
+        for row in data:
+            w.write_row(row)
+            new_state.update(row)
+            row_count += 1
+    except BaseException:
+        w.rollback()
+        raise
+    w.commit()
+
+    # the state is saved only after the files are committed so that an
+    # interrupted run downloads the same window again
+    new_state.save()
+    logger.info("Added %d new rows for industry %s", row_count, industry_id)
+    return row_count
 
 def download_historical_data(live, industry_id):
     path = Path(f"cache/history/{industry_id}.csv.gz")
     path.parent.mkdir(exist_ok=True, parents=True)
     if path.exists():
         logger.info("Data already downloaded for industry %s", industry_id)
+        scraper.telemetry.advance(live.count_params([industry_id]))
         return
 
     logger.info("Downloading historical data for industry %s", industry_id)
 
-    path2 = path.with_suffix(".gz.tmp")
+    # another worker may download the same industry after the lease of its shard expired
+    path2 = get_tmp_path(path)
 
     try:
         data = live.get_historical_data(industry_id)
-        columns = "industry_id station_id device_id param_key param_label time value".split()
-        rows = ({k: str(v) for k, v in d.items()} for d in data)
-
-        with gzip.open(path2, "wt") as f:
-            w = csv.DictWriter(f, columns)
-            w.writeheader()
-            w.writerows(rows)
+        with gzip.open(path2, "wb") as f:
+            f.write(HEADER)
+            for rows in iter_chunks(data, 10000):
+                f.write(encode_rows(rows))
+                scraper.telemetry.count("rows_written", len(rows))
 
         # df = pd.DataFrame(data)
         # df.to_csv(path, index=False)
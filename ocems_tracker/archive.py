@@ -0,0 +1,436 @@
+"""
+Utilities to write the data of industries to the yearly archive.
+
+The archive has one file for every industry for every year:
+
+    archive/{year}/{industry_id}.csv.gz
+
+The files saved are added to the manifest of the archive.
+"""
+from collections import OrderedDict
+from pathlib import Path
+import datetime
+import gzip
+import io
+import itertools
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from .manifest import Manifest
+from .rollup import Rollup
+from .telemetry import telemetry
+from .writers import get_tmp_path
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = "industry_id station_id device_id param_key param_label time value".split()
+
+
+# format of the lines of the archive files
+LINE_FORMAT = "%s,%s,%s,%s,%s,%s,%s\n"
+HEADER = (",".join(COLUMNS) + "\n").encode()
+
+
+def iter_chunks(rows, size):
+    """Splits the rows into lists of size rows.
+    """
+    it = iter(rows)
+    while chunk := list(itertools.islice(it, size)):
+        yield chunk
+
+
+def encode_rows(rows):
+    """Encodes the rows as the lines of a csv file.
+
+    The label is the only column which can have a comma and it is quoted
+    when required.
+    """
+    lines = []
+    for row in rows:
+        label = row[4]
+        if isinstance(label, str) and ("," in label or '"' in label):
+            row = list(row)
+            row[4] = '"' + label.replace('"', '""') + '"'
+        lines.append(LINE_FORMAT % tuple(row))
+    return "".join(lines).encode()
+
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S:%f"
+# the positions of the separators in times like 2016-01-08 16:15:00:000
+TIME_SEPARATORS = {4: b"-", 7: b"-", 10: b" ", 13: b":", 16: b":", 19: b":"}
+TIME_DIGITS = [i for i in range(23) if i not in TIME_SEPARATORS]
+# the positions of the year, month, day, hour, minute, second and milliseconds
+TIME_FIELDS = [(0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19), (20, 23)]
+
+
+def parse_time(t):
+    """Parses a single time like parse_times, allowing fewer digits of the
+    milliseconds and times without them.
+
+    Raises ValueError if the time is not in one of these formats.
+    """
+    t = t.decode() if isinstance(t, bytes) else str(t)
+    if t.count(":") == 2:
+        t += ":000"
+    if len(t) > 23:
+        raise ValueError(f"invalid time: {t!r}")
+    dt = datetime.datetime.strptime(t, TIME_FORMAT)
+    epoch = datetime.datetime(1970, 1, 1)
+    return (dt - epoch) // datetime.timedelta(milliseconds=1)
+
+
+def parse_times(times):
+    """Parses times like 2016-01-08 16:15:00:000 into milliseconds since epoch.
+
+    All the times are parsed at once by reading the digits from the bytes of
+    the times. The times that are not exactly in this format are parsed
+    one by one by parse_time, which raises ValueError for invalid times.
+    """
+    if len(times) == 0:
+        return np.zeros(0, dtype=np.int64)
+    try:
+        # one more byte than required, to find the times that are too long
+        a = np.array(times, dtype="S24")
+    except UnicodeEncodeError:
+        return np.array([parse_time(t) for t in times], dtype=np.int64)
+    chars = a.view(np.uint8).reshape(len(a), 24)
+    # the bytes that aren't digits are larger than 9, as they wrap around
+    digits = chars - np.uint8(ord("0"))
+    valid = (chars[:, 23] == 0) & (digits[:, TIME_DIGITS] <= 9).all(axis=1)
+    for i, sep in TIME_SEPARATORS.items():
+        valid &= chars[:, i] == ord(sep)
+
+    def number(start, end):
+        n = digits[:, start].astype(np.int64)
+        for i in range(start + 1, end):
+            n = n * 10 + digits[:, i]
+        return n
+
+    year, month, day, hour, minute, second, ms = [number(start, end) for start, end in TIME_FIELDS]
+    for n, low, high in [(month, 1, 12), (day, 1, 31), (hour, 0, 23), (minute, 0, 59), (second, 0, 59)]:
+        valid &= (n >= low) & (n <= high)
+
+    months = (year - 1970) * 12 + month - 1
+    month_starts = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    month_ends = (months + 1).astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    days = month_starts + day - 1
+    valid &= days < month_ends
+    seconds = ((days * 24 + hour) * 60 + minute) * 60 + second
+    result = seconds * 1000 + ms
+
+    for i in np.flatnonzero(~valid).tolist():
+        result[i] = parse_time(times[i])
+    return result
+
+
+def get_years(times):
+    """Returns the years of the times in milliseconds since epoch.
+    """
+    return times.astype("datetime64[ms]").astype("datetime64[Y]").astype(np.int64) + 1970
+
+
+def append_file(path, src):
+    """Appends the contents of the file src to the file at path.
+
+    The size of the file before the append is saved in a `.append` file
+    next to it till the append is complete, so that an append interrupted
+    by a crash is undone by recover_append.
+    """
+    path = Path(path)
+    journal = path.with_name(path.name + ".append")
+    size = path.stat().st_size
+    tmp_path = get_tmp_path(journal)
+    tmp_path.write_text(str(size))
+    tmp_path.replace(journal)
+    try:
+        with open(src, "rb") as f, open(path, "ab") as out:
+            shutil.copyfileobj(f, out)
+    except BaseException:
+        os.truncate(path, size)
+        journal.unlink()
+        raise
+    journal.unlink()
+
+
+def recover_append(path):
+    """Truncates the file at path to its size before an interrupted append_file.
+    """
+    path = Path(path)
+    journal = path.with_name(path.name + ".append")
+    if journal.exists():
+        logger.warning("undoing the interrupted append to %s", path)
+        os.truncate(path, int(journal.read_text()))
+        journal.unlink()
+
+
+class YearlyWriter:
+    """Writes the rows of an industry to one file per year.
+
+    In append mode, the new rows are added to the existing files of the
+    industry in the archive instead of replacing them. The new rows of a
+    year are written to a temporary file as a separate gzip stream, which is
+    appended to the existing file on commit. As gzip allows concatenating
+    multiple streams, the existing rows are neither copied nor recompressed
+    and an append costs only the new rows. The md5 of the appended files is
+    computed later, when the manifest is refreshed.
+
+    When a Rollup is specified, it is updated with every row written and
+    is committed along with the files.
+
+    The rows are written in chunks of chunk_size rows. The times of all the
+    rows in a chunk are parsed at once and the lines of every year are
+    encoded and written to the file in a single write.
+    """
+    def __init__(self, industry_id, archive_root, append=False, rollup=None, chunk_size=10000, compresslevel=6):
+        self.industry_id = industry_id
+        self.archive_root = Path(archive_root)
+        self.filename = f"{industry_id}.csv.gz"
+        self.append = append
+        self.rollup = rollup
+        self.chunk_size = chunk_size
+        self.compresslevel = compresslevel
+        self.files = {}
+        self.columns = COLUMNS
+        self.manifest = Manifest.for_archive(archive_root)
+        # the years with existing files to which the rows are appended
+        self.appended = set()
+        # [row count, min time, max time] of the rows written for every year
+        self.stats = {}
+        self.pending = []
+
+    def get_file(self, year):
+        if year not in self.files:
+            path = self.archive_root / year / self.filename
+            tmp_path = get_tmp_path(path)
+            tmp_path.parent.mkdir(parents=True, exist_ok=True)
+            if self.append and path.exists():
+                recover_append(path)
+                self.files[year] = gzip.open(tmp_path, "wb", compresslevel=self.compresslevel)
+                self.appended.add(year)
+            else:
+                self.files[year] = gzip.open(tmp_path, "wb", compresslevel=self.compresslevel)
+                self.files[year].write(HEADER)
+            self.stats[year] = [0, None, None]
+        return self.files[year]
+
+    def commit(self):
+        """Saves all the files"""
+        self.flush()
+        for year, f in self.files.items():
+            f.close()
+
+            name = self.archive_root / year / self.filename
+            if year in self.appended:
+                append_file(name, f.name)
+                Path(f.name).unlink()
+                logger.info("appended %d rows to %s", self.stats[year][0], name)
+                self.manifest.update(name, *self.stats[year])
+            else:
+                shutil.move(f.name, name)
+                logger.info("saving file %s", name)
+                self.manifest.add(name, *self.stats[year])
+
+        if self.rollup:
+            self.rollup.commit()
+
+    def rollback(self):
+        """Deletes all the files written.
+        """
+        self.pending = []
+        for f in self.files.values():
+            f.close()
+            Path(f.name).unlink()
+
+        if self.rollup:
+            self.rollup.rollback()
+
+    def write_rows(self, rows):
+        for chunk in iter_chunks(rows, self.chunk_size):
+            self.pending.extend(chunk)
+            if len(self.pending) >= self.chunk_size:
+                self.flush()
+
+    def write_row(self, row):
+        # row will be of the following format
+        # 122,190,3080,pm,PM,2016-01-08 16:15:00:000,13.5
+        self.pending.append(row)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending rows to the files.
+        """
+        rows = self.pending
+        if not rows:
+            return
+        self.pending = []
+
+        times = parse_times([row[5] for row in rows])
+        years = get_years(times)
+        # the rows are grouped by year, keeping the order of the rows
+        order = np.argsort(years, kind="stable")
+        groups = np.split(order, np.flatnonzero(np.diff(years[order])) + 1)
+        for indices in groups:
+            year = str(years[indices[0]])
+            self.get_file(year).write(encode_rows([rows[i] for i in indices.tolist()]))
+
+            stats = self.stats[year]
+            stats[0] += len(indices)
+            t_min = rows[indices[times[indices].argmin()]][5]
+            t_max = rows[indices[times[indices].argmax()]][5]
+            if stats[1] is None or t_min < stats[1]:
+                stats[1] = t_min
+            if stats[2] is None or t_max > stats[2]:
+                stats[2] = t_max
+        telemetry.count("rows_written", len(rows))
+
+        if self.rollup:
+            for row in rows:
+                self.rollup.add_row(row)
+
+
+class _YearlySplitter:
+    """Splits the lines of a csv file into one gzip file per year.
+
+    The lines are buffered in memory and written in large chunks. At most
+    max_open_files are kept open at any time. When that limit is reached,
+    the least recently used file is closed and it is reopened in append
+    mode when required, which adds a new gzip stream to the same file.
+    """
+    def __init__(self, archive_root, filename, header, compresslevel=6, max_open_files=16, buffer_size=1024*1024):
+        self.archive_root = Path(archive_root)
+        self.filename = filename
+        self.header = header
+        self.compresslevel = compresslevel
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+
+        self.open_files = OrderedDict()
+        # the years whose files were opened at least once
+        self.opened = set()
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.paths = {}
+        self.row_counts = {}
+        self.min_times = {}
+        self.max_times = {}
+        self.manifest = Manifest.for_archive(archive_root)
+
+    def get_path(self, year):
+        if year not in self.paths:
+            path = get_tmp_path(self.archive_root / year / self.filename)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.paths[year] = path
+            self.row_counts[year] = 0
+            self.min_times[year] = self.max_times[year] = None
+            self.buffers[year] = [self.header]
+            self.buffer_sizes[year] = len(self.header)
+        return self.paths[year]
+
+    def get_file(self, year):
+        if year in self.open_files:
+            self.open_files.move_to_end(year)
+            return self.open_files[year]
+
+        if len(self.open_files) >= self.max_open_files:
+            _, f = self.open_files.popitem(last=False)
+            f.close()
+
+        # the file is truncated when it is first opened, so that a .tmp file
+        # left by an interrupted run is not appended to
+        mode = "ab" if year in self.opened else "wb"
+        self.opened.add(year)
+        f = gzip.open(self.paths[year], mode, compresslevel=self.compresslevel)
+        self.open_files[year] = f
+        return f
+
+    def write(self, year, line, t):
+        self.get_path(year)
+        if self.min_times[year] is None or t < self.min_times[year]:
+            self.min_times[year] = t
+        if self.max_times[year] is None or t > self.max_times[year]:
+            self.max_times[year] = t
+        self.buffers[year].append(line)
+        self.buffer_sizes[year] += len(line)
+        self.row_counts[year] += 1
+        if self.buffer_sizes[year] >= self.buffer_size:
+            self.flush(year)
+
+    def flush(self, year):
+        self.get_file(year).write(b"".join(self.buffers[year]))
+        self.buffers[year] = []
+        self.buffer_sizes[year] = 0
+
+    def commit(self):
+        for year in self.paths:
+            if self.buffers[year]:
+                self.flush(year)
+        for f in self.open_files.values():
+            f.close()
+        self.open_files.clear()
+
+        for year, path in self.paths.items():
+            target = self.archive_root / year / self.filename
+            shutil.move(path, target)
+            logger.info("saved %s", target)
+            self.manifest.add(target, self.row_counts[year],
+                self.min_times[year].decode(), self.max_times[year].decode())
+
+    def rollback(self):
+        for f in self.open_files.values():
+            f.close()
+        self.open_files.clear()
+        for path in self.paths.values():
+            path.unlink(missing_ok=True)
+
+
+def split_file(path, archive_root, compresslevel=6, max_open_files=16, buffer_size=1024*1024,
+               rollup_root=None, thresholds=None):
+    """Splits a csv.gz data file for an industry by year.
+
+    The file cache/history/122.csv.gz is split into files like
+    archive/2016/122.csv.gz, archive/2017/122.csv.gz etc.
+
+    The files are written with a .tmp suffix and moved to the final path
+    only after the whole file is processed. Returns a dictionary with the
+    number of rows written for each year.
+
+    When rollup_root is specified, the rollups of the data are also
+    computed and saved there.
+    """
+    path = Path(path)
+    logger.info("splitting %s", path)
+
+    industry_id = path.name.split(".")[0]
+    rollup = rollup_root and Rollup(industry_id, rollup_root, thresholds)
+
+    with gzip.open(path, "rb") as gz:
+        f = io.BufferedReader(gz, buffer_size)
+        header = f.readline()
+        splitter = _YearlySplitter(archive_root, path.name, header,
+            compresslevel=compresslevel,
+            max_open_files=max_open_files,
+            buffer_size=buffer_size)
+        try:
+            for line in f:
+                # the time is the last but one column and looks like 2016-01-01 01:30:00:000
+                t = line.rsplit(b",", 2)[1]
+                year = t[:4].decode()
+                splitter.write(year, line, t)
+                if rollup:
+                    _, station_id, device_id, param_key, rest = line.decode().split(",", 4)
+                    _, t, value = rest.rsplit(",", 2)
+                    rollup.add(station_id, device_id, param_key, t, value)
+        except BaseException:
+            splitter.rollback()
+            if rollup:
+                rollup.rollback()
+            raise
+
+    splitter.commit()
+    if rollup:
+        rollup.commit()
+    return splitter.row_counts
@@ -0,0 +1,251 @@
+"""
+Cache for the responses of the OCEMS portal.
+
+All the entries are stored in a single SQLite database instead of one file
+per key. Every key can have an expiry time, decided by the longest matching
+key prefix in the ttls, and the least recently used entries are evicted
+when the cache grows beyond max_size bytes.
+
+The access times of the entries read from the cache are kept in memory
+and saved together when an entry is set, before evicting and on close, so
+that reading an entry doesn't need a write to the database.
+
+    cache = Cache("cache/cache.db", ttls={"states.json": 30*DAY})
+
+    @cache.memoize("cities/{state_id}.json")
+    def get_cities(state_id):
+        ...
+"""
+from pathlib import Path
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+import zlib
+
+from .db import connect
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+DAY = 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB,
+    size INTEGER,
+    created REAL,
+    accessed REAL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed);
+"""
+
+
+class Cache:
+    def __init__(self, path, ttls=None, max_size=None):
+        self.path = Path(path)
+        self.ttls = ttls or {}
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        # the size of all the entries, which is read from the database only
+        # when it is not known or may be larger than max_size
+        self._size = None
+        # the access times of the entries read since they were last saved
+        self._accessed = {}
+        self._lock = threading.Lock()
+        self.db = connect(self.path, SCHEMA)
+
+    def get_ttl(self, key):
+        """Returns the time-to-live of the key in seconds or None if it never expires.
+        """
+        prefixes = [p for p in self.ttls if key.startswith(p)]
+        if prefixes:
+            return self.ttls[max(prefixes, key=len)]
+
+    def _get(self, key):
+        row = self.db.execute("SELECT value, created FROM cache WHERE key=?", [key]).fetchone()
+        if row is None:
+            return None
+
+        value, created = row
+        ttl = self.get_ttl(key)
+        if ttl is not None and created + ttl < time.time():
+            logger.debug("cache entry expired: %s", key)
+            return None
+        return value
+
+    def exists(self, key):
+        """Returns True if the key is in the cache and it is not expired.
+        """
+        return self._get(key) is not None
+
+    def get(self, key, default=None):
+        """Returns the value of the key, or default if it is not found or expired.
+        """
+        value = self._get(key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return default
+
+        with self._lock:
+            self.hits += 1
+            self._accessed[key] = time.time()
+        return json.loads(zlib.decompress(value))
+
+    def save_accessed(self):
+        """Saves the access times of the entries read from the cache.
+        """
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            self.db.executemany("UPDATE cache SET accessed=? WHERE key=?", [[t, k] for k, t in accessed.items()])
+
+    def close(self):
+        """Saves the access times and closes the connection of the current thread.
+        """
+        self.save_accessed()
+        self.db.close()
+
+    def set(self, key, value):
+        data = zlib.compress(json.dumps(value).encode())
+        now = time.time()
+        old_size = self._get_entry_size(key)
+        self.save_accessed()
+        self.db.execute(
+            "INSERT OR REPLACE INTO cache (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            [key, data, len(data), now, now])
+        self._add_size(len(data) - old_size)
+        self.evict()
+
+    def delete(self, key):
+        old_size = self._get_entry_size(key)
+        self.db.execute("DELETE FROM cache WHERE key=?", [key])
+        self._add_size(-old_size)
+
+    def _get_entry_size(self, key):
+        row = self.db.execute("SELECT size FROM cache WHERE key=?", [key]).fetchone()
+        return row[0] if row else 0
+
+    def _add_size(self, delta):
+        with self._lock:
+            if self._size is not None:
+                self._size += delta
+
+    def get_size(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def evict(self):
+        """Deletes the least recently used entries when the cache is larger than max_size.
+        """
+        if not self.max_size:
+            return
+
+        with self._lock:
+            if self._size is not None and self._size <= self.max_size:
+                return
+        self.save_accessed()
+        # the other processes using the cache may have changed its size, so
+        # the size is read again before evicting
+        size = self.get_size()
+        with self._lock:
+            self._size = size
+        excess = size - self.max_size
+        if excess <= 0:
+            return
+
+        keys = []
+        evicted = 0
+        for key, size in self.db.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            keys.append(key)
+            evicted += size
+            if evicted >= excess:
+                break
+
+        logger.info("evicting %d entries from the cache", len(keys))
+        self.db.executemany("DELETE FROM cache WHERE key=?", [[k] for k in keys])
+        self._add_size(-evicted)
+
+    def stats(self):
+        count, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        total = self.hits + self.misses
+        return {
+            "entries": count,
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": total and round(self.hits / total, 4),
+        }
+
+    def memoize(self, key_template):
+        """Decorator to cache the result of a function.
+
+        The key is computed by formatting key_template with the arguments
+        of the function. When the function returns a generator, the result
+        is stored and returned as a list.
+        """
+        def decorator(f):
+            signature = inspect.signature(f)
+
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                arguments = signature.bind(*args, **kwargs)
+                arguments.apply_defaults()
+                key = key_template.format(**arguments.arguments)
+
+                value = self.get(key, _MISSING)
+                if value is _MISSING:
+                    value = f(*args, **kwargs)
+                    if inspect.isgenerator(value):
+                        value = list(value)
+                    self.set(key, value)
+                return value
+            return wrapper
+        return decorator
+
+    def dump(self, key, path):
+        """Writes the value of a key to a file.
+
+        Keys ending with .jsonl are written with one JSON record per line.
+        Raises KeyError if the key is not in the cache or has expired.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(f"{key} is not in the cache or has expired")
+        with open(path, "w") as f:
+            if key.endswith(".jsonl"):
+                for d in value:
+                    f.write(json.dumps(d) + "\n")
+            else:
+                json.dump(value, f)
+
+    def import_dir(self, root):
+        """Imports the .json and .jsonl files in the given directory into the cache.
+
+        This is used to move an existing cache directory with one file per
+        key into the cache.
+        """
+        root = Path(root)
+        count = 0
+        for path in root.rglob("*.json*"):
+            if path.suffix not in [".json", ".jsonl"]:
+                continue
+            # the history state is not part of the cache
+            if path.relative_to(root).parts[0] == "history":
+                continue
+            key = path.relative_to(root).as_posix()
+            with path.open() as f:
+                if path.suffix == ".jsonl":
+                    value = [json.loads(line) for line in f if line.strip()]
+                else:
+                    value = json.load(f)
+            self.set(key, value)
+            count += 1
+        logger.info("imported %d entries from %s", count, root)
+        return count
@@ -0,0 +1,57 @@
+"""
+Utilities to make concurrent requests to the OCEMS portal.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from urllib.parse import urlparse
+import threading
+import time
+
+
+class RateLimiter:
+    """Limits the number of requests made to each host per second.
+
+    A rate of None or 0 disables the rate limiting.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_times = {}
+
+    def wait(self, url):
+        """Blocks till a request to the host of the url is allowed.
+        """
+        if not self.rate:
+            return
+
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            t = max(now, self.next_times.get(host, now))
+            self.next_times[host] = t + 1.0 / self.rate
+
+        if t > now:
+            time.sleep(t - now)
+
+
+def bounded_map(func, items, max_workers, window=None):
+    """Like map, but calls func concurrently using a pool of threads.
+
+    Items are consumed lazily and at most `window` calls are pending at any
+    time, so this works with very long generators. The results are yielded
+    in the same order as the items.
+    """
+    if max_workers <= 1:
+        yield from map(func, items)
+        return
+
+    window = window or 2 * max_workers
+    with ThreadPoolExecutor(max_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
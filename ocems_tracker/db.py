@@ -0,0 +1,58 @@
+"""
+Connections to the SQLite databases used by the cache, the manifest and
+the work queue.
+
+    db = connect("cache/queue.db", SCHEMA)
+    db.execute("SELECT * FROM shards")
+"""
+from pathlib import Path
+import sqlite3
+import threading
+
+
+class LocalConnection:
+    """Connection to a SQLite database, with one connection for every thread
+    as sqlite connections can't be shared between threads.
+
+    The connection of a thread is opened, creating the database and its
+    tables if required, when it is first used. It is in autocommit mode, so
+    the transactions are started explicitly using BEGIN.
+
+    All the attributes of the sqlite connection, like execute, are
+    available on this object.
+    """
+    def __init__(self, path, schema):
+        self.path = Path(path)
+        self.schema = schema
+        self._local = threading.local()
+
+    def get(self):
+        """Returns the connection of the current thread.
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            # WAL mode doesn't work when the file is on a network filesystem,
+            # which is the case when the workers of the work queue share it
+            db.execute("PRAGMA journal_mode=DELETE")
+            db.executescript(self.schema)
+            self._local.db = db
+        return db
+
+    def close(self):
+        """Closes the connection of the current thread, if it is open.
+        """
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            del self._local.db
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def connect(path, schema):
+    """Returns a LocalConnection to the database at path.
+    """
+    return LocalConnection(path, schema)
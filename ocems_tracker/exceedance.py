@@ -0,0 +1,295 @@
+"""
+Detects the exceedances of the param thresholds in a stream of rows.
+
+The thresholds are the `max` of every param from the param metadata, by
+(station_id, param_key). An exceedance event is a run of consecutive
+readings of a param above its threshold, with no gap of more than max_gap
+minutes between them. Every event has its start and end time, the number
+of readings, and the peak value and its time.
+
+The rows are processed in chunks, in a single pass. The times and values
+of a chunk are parsed at once and compared with an array of the
+thresholds of the params of the rows, so the chunks without any
+exceedance cost only the comparison. The readings of every param are
+sorted by time within a chunk. A reading that is not newer than the last
+reading of its param in the earlier chunks is skipped and counted in
+skipped_count. This happens for the readings already processed in an
+earlier run and for the late readings that the merge appends to the end
+of the archive files, which are not checked for exceedances.
+
+    detector = ExceedanceDetector(thresholds)
+    with EventWriter("exceedances.csv.gz") as w:
+        w.write_events(detector.process(rows))
+
+When a state file is used, the last time seen and the open event of every
+param are kept between the runs, so the readings already processed are
+skipped and an event that continues in the next run is reported once.
+"""
+from dataclasses import dataclass, asdict
+from pathlib import Path
+import csv
+import gzip
+import json
+import logging
+import shutil
+
+import numpy as np
+
+from .archive import iter_chunks, parse_times
+from .writers import get_tmp_path
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = [
+    "industry_id", "station_id", "device_id", "param_key", "threshold",
+    "start", "end", "duration_minutes", "readings", "peak", "peak_time", "ongoing"
+]
+
+
+def format_time(t):
+    """Formats the milliseconds since epoch like 2016-01-08 16:15:00:000.
+    """
+    return str(np.datetime64(int(t), "ms")).replace("T", " ").replace(".", ":")
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+@dataclass
+class Event:
+    industry_id: str
+    station_id: str
+    device_id: str
+    param_key: str
+    threshold: float
+    # times are in milliseconds since epoch
+    start: int
+    end: int
+    readings: int
+    peak: float
+    peak_time: int
+
+    def to_row(self, ongoing=False):
+        return [self.industry_id, self.station_id, self.device_id, self.param_key, self.threshold,
+                format_time(self.start), format_time(self.end), round((self.end - self.start) / 60000, 1),
+                self.readings, self.peak, format_time(self.peak_time), int(ongoing)]
+
+
+class ExceedanceDetector:
+    def __init__(self, thresholds, max_gap=60, chunk_size=10000):
+        """The thresholds is a dict with (station_id, param_key) as key, like
+        the one returned by ParamIndex.get_thresholds.
+
+        Readings more than max_gap minutes apart are not part of the same event.
+        """
+        self.thresholds = {(str(k[0]), k[1]): v for k, v in thresholds.items()}
+        self.max_gap = max_gap * 60 * 1000
+        self.chunk_size = chunk_size
+
+        # every param seen gets a code, which is the index of its threshold in
+        # the threshold array
+        self.codes = {}
+        self.keys = []
+        self._thresholds = []
+        self.threshold_array = np.zeros(0)
+
+        self.last_times = {}
+        self.open_events = {}
+        self.event_count = 0
+        # readings not newer than the last reading of their param
+        self.skipped_count = 0
+
+    @classmethod
+    def from_param_index(cls, param_index, **kwargs):
+        return cls(param_index.get_thresholds(), **kwargs)
+
+    def get_code(self, key):
+        code = self.codes.get(key)
+        if code is None:
+            code = self.codes[key] = len(self.keys)
+            self.keys.append(key)
+            self._thresholds.append(self.thresholds.get((key[1], key[3]), np.nan))
+        return code
+
+    def get_threshold_array(self):
+        if len(self.threshold_array) != len(self._thresholds):
+            self.threshold_array = np.array(self._thresholds, dtype=np.float64)
+        return self.threshold_array
+
+    def process(self, rows):
+        """Returns a generator with the events that ended in the rows.
+
+        The events still open at the end of the rows are not included, they
+        are returned by finish.
+        """
+        for chunk in iter_chunks(rows, self.chunk_size):
+            yield from self.process_chunk(chunk)
+
+    def watch(self, rows, events):
+        """Returns a generator with the same rows, which adds the events that
+        ended to the list events as the rows are consumed.
+
+        This is used to detect the events in the rows while they are
+        being written.
+        """
+        for chunk in iter_chunks(rows, self.chunk_size):
+            events.extend(self.process_chunk(chunk))
+            yield from chunk
+
+    def process_chunk(self, rows):
+        codes = np.fromiter(
+            (self.get_code((str(r[0]), str(r[1]), str(r[2]), r[3])) for r in rows),
+            dtype=np.int64, count=len(rows))
+        thresholds = self.get_threshold_array()[codes]
+        has_threshold = ~np.isnan(thresholds)
+        if not has_threshold.any():
+            return []
+
+        times = parse_times([str(r[5]) for r in rows])
+        values = np.array([to_float(r[6]) for r in rows], dtype=np.float64)
+        exceeded = values > np.nan_to_num(thresholds, nan=np.inf)
+
+        # the rows of every param, in the order of time
+        order = np.flatnonzero(has_threshold)
+        order = order[np.lexsort((times[order], codes[order]))]
+        groups = np.split(order, np.flatnonzero(np.diff(codes[order])) + 1)
+
+        events = []
+        for indices in groups:
+            events.extend(self.process_param(int(codes[indices[0]]), times[indices], values[indices], exceeded[indices]))
+        return events
+
+    def process_param(self, code, t, v, e):
+        """Updates the events of a param with its readings, which are in
+        the order of time. Returns the events that ended.
+        """
+        last_time = self.last_times.get(code)
+        if last_time is not None:
+            # skip the readings that were already processed or are late
+            new = t > last_time
+            if not new.all():
+                self.skipped_count += len(t) - int(new.sum())
+                t, v, e = t[new], v[new], e[new]
+                if not len(t):
+                    return []
+        self.last_times[code] = int(t[-1])
+
+        events = []
+        event = self.open_events.pop(code, None)
+        if not e.any():
+            if event:
+                events.append(event)
+            return events
+
+        p = np.flatnonzero(e)
+        # a run ends at a reading not exceeding the threshold or at a gap
+        breaks = (np.diff(p) != 1) | (np.diff(t[p]) > self.max_gap)
+        starts = np.concatenate([[0], np.flatnonzero(breaks) + 1])
+        ends = np.concatenate([starts[1:], [len(p)]])
+
+        if event and not (p[0] == 0 and t[0] - event.end <= self.max_gap):
+            events.append(event)
+            event = None
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            run = p[start:end]
+            peak = int(run[v[run].argmax()])
+            if event is None:
+                key = self.keys[code]
+                event = Event(*key, float(self._thresholds[code]), int(t[run[0]]), int(t[run[-1]]),
+                              len(run), float(v[peak]), int(t[peak]))
+                self.event_count += 1
+            else:
+                event.end = int(t[run[-1]])
+                event.readings += len(run)
+                if v[peak] > event.peak:
+                    event.peak = float(v[peak])
+                    event.peak_time = int(t[peak])
+            events.append(event)
+            event = None
+
+        # the last run continues in the next rows if it is at the end
+        if p[-1] == len(t) - 1:
+            self.open_events[code] = events.pop()
+        return events
+
+    def finish(self):
+        """Returns the events that are still open and forgets them.
+        """
+        events = list(self.open_events.values())
+        self.open_events.clear()
+        return events
+
+    def save_state(self, path):
+        """Saves the last times and the open events of all the params.
+        """
+        state = {
+            "last_times": [[*self.keys[code], t] for code, t in self.last_times.items()],
+            "open_events": [asdict(event) for event in self.open_events.values()],
+        }
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = get_tmp_path(path)
+        tmp_path.write_text(json.dumps(state))
+        tmp_path.replace(path)
+
+    def load_state(self, path):
+        path = Path(path)
+        if not path.exists():
+            return
+        state = json.loads(path.read_text())
+        for *key, t in state["last_times"]:
+            self.last_times[self.get_code(tuple(key))] = t
+        for d in state["open_events"]:
+            event = Event(**d)
+            self.open_events[self.get_code((event.industry_id, event.station_id, event.device_id, event.param_key))] = event
+
+
+class EventWriter:
+    """Appends the events to a csv.gz file.
+
+    The new events are added as a new gzip stream, so the existing events
+    are not compressed again. The file is replaced only when the writer
+    is closed without an error.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.tmp_path = get_tmp_path(self.path)
+        self.event_count = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists():
+            shutil.copy(self.path, self.tmp_path)
+            self.file = gzip.open(self.tmp_path, "at", newline="")
+            self.writer = csv.writer(self.file)
+        else:
+            self.file = gzip.open(self.tmp_path, "wt", newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(COLUMNS)
+
+    def write_events(self, events, ongoing=False):
+        for event in events:
+            self.writer.writerow(event.to_row(ongoing))
+            self.event_count += 1
+
+    def commit(self):
+        self.file.close()
+        self.tmp_path.replace(self.path)
+        logger.info("saved %d events to %s", self.event_count, self.path)
+
+    def rollback(self):
+        self.file.close()
+        self.tmp_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
@@ -0,0 +1,76 @@
+"""
+Tracks the last timestamp archived for every param of an industry.
+
+This is used to download only the data that is newer than what is
+already archived.
+"""
+from pathlib import Path
+import csv
+import gzip
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryState:
+    """The last archived timestamp of every (station, device, param) of an industry.
+
+    The state is saved as a JSON file at `{root}/{industry_id}.json`.
+    """
+    def __init__(self, path, last_times=None):
+        self.path = Path(path)
+        self.last_times = last_times or {}
+
+    @staticmethod
+    def make_key(station_id, device_id, param_key):
+        return f"{station_id}/{device_id}/{param_key}"
+
+    @classmethod
+    def load(cls, root, industry_id, archive_root=None):
+        """Loads the state of an industry.
+
+        When the archive_root is specified, the state is computed from the
+        archived files of the industry if there is no saved state or if an
+        archive file was saved after it, like when split_data replaces the
+        files with older data.
+        """
+        path = Path(root) / f"{industry_id}.json"
+        paths = sorted(Path(archive_root).glob(f"*/{industry_id}.csv.gz")) if archive_root else []
+        if path.exists():
+            mtime = path.stat().st_mtime
+            if not any(p.stat().st_mtime > mtime for p in paths):
+                return cls(path, json.loads(path.read_text()))
+            logger.info("archive of industry %s changed after the history state, reading it again", industry_id)
+
+        state = cls(path)
+        for p in paths:
+            logger.info("reading last timestamps from %s", p)
+            with gzip.open(p, "rt", newline="") as f:
+                # every gzip stream appended to the file may have a header
+                state.update_rows(row for row in csv.reader(f) if row and row[0] != "industry_id")
+        return state
+
+    def get(self, station_id, device_id, param_key):
+        """Returns the last archived time of the param or None if nothing is archived.
+        """
+        return self.last_times.get(self.make_key(station_id, device_id, param_key))
+
+    def update(self, row):
+        # row will be of the following format
+        # 122,190,3080,pm,PM,2016-01-08 16:15:00:000,13.5
+        key = self.make_key(row[1], row[2], row[3])
+        t = row[5]
+        # the timestamps are in a fixed format and can be compared as strings
+        if t > self.last_times.get(key, ""):
+            self.last_times[key] = t
+
+    def update_rows(self, rows):
+        for row in rows:
+            self.update(row)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(self.last_times, indent=2, sort_keys=True))
+        tmp_path.replace(self.path)
@@ -2,8 +2,13 @@ from __future__ import annotations
 import dataclasses
 from dataclasses import dataclass, field
 import typing
+import functools
+import operator
+import csv
 import re
 
+from .optional import import_pyarrow
+
 
 def column(**metadata):
     """symtactic sugar for dataclasses.field to make adding metadata easier.
@@ -52,6 +57,85 @@ def dataclass_from_dict(klass, d):
 
     return klass(**{f:dataclass_from_dict(fieldtypes.get(f), d and d.get(f)) for f in fieldtypes})
 
+# The functions below do the same thing as dataclass_from_dict and
+# process_data, but the fields and type hints of a class are resolved only
+# once and a specialized function is made for every class.
+
+@functools.lru_cache(maxsize=None)
+def compile_from_dict(klass):
+    """Returns a function to convert a dict into an instance of klass.
+
+    The returned function is equivalent to `dataclass_from_dict(klass, d)`.
+    """
+    if not dataclasses.is_dataclass(klass):
+        return None
+
+    fieldtypes = typing.get_type_hints(klass)
+    converters = [(name, compile_from_dict(t)) for name, t in fieldtypes.items()]
+
+    def from_dict(d):
+        kwargs = {}
+        for name, convert in converters:
+            value = d and d.get(name)
+            kwargs[name] = convert(value) if convert else value
+        return klass(**kwargs)
+
+    return from_dict
+
+@functools.lru_cache(maxsize=None)
+def _get_flat_fields(klass):
+    """Returns the fields of klass after flattening the nested dataclasses
+    as a list of (path, target), where path is the tuple of field names to
+    reach the value.
+    """
+    fieldtypes = typing.get_type_hints(klass)
+    result = []
+    for f in dataclasses.fields(klass):
+        if f.metadata.get("ignore"):
+            continue
+
+        t = fieldtypes[f.name]
+        if dataclasses.is_dataclass(t):
+            result += [((f.name,) + path, target) for path, target in _get_flat_fields(t)]
+        else:
+            target = f.metadata.get('target') or _to_snake_case(f.name)
+            result.append(((f.name,), target))
+    return tuple(result)
+
+@functools.lru_cache(maxsize=None)
+def compile_flattener(klass):
+    """Returns a function to convert an instance of klass into a flat dict.
+
+    The returned function is equivalent to `process_data(obj)`.
+    """
+    flat_fields = _get_flat_fields(klass)
+    targets = [target for _, target in flat_fields]
+    getter = operator.attrgetter(*[".".join(path) for path, _ in flat_fields])
+
+    if len(targets) == 1:
+        return lambda obj: {targets[0]: getter(obj)}
+    return lambda obj: dict(zip(targets, getter(obj)))
+
+@functools.lru_cache(maxsize=None)
+def compile_dict_flattener(klass):
+    """Returns a function to convert a dict directly into a flat dict,
+    without making an instance of klass.
+
+    The returned function is equivalent to `process_data(dataclass_from_dict(klass, d))`.
+    """
+    flat_fields = _get_flat_fields(klass)
+
+    def flatten(d):
+        result = {}
+        for path, target in flat_fields:
+            value = d
+            for name in path:
+                value = value and value.get(name)
+            result[target] = value
+        return result
+
+    return flatten
+
 @dataclass
 class _IndustryZone:
     id: str = column(target="zone_id")
@@ -104,7 +188,85 @@ class Industry:
     @classmethod
     def from_dict(cls, data):
         # print("-- from_dict", data)
-        return dataclass_from_dict(cls, data)
+        return compile_from_dict(cls)(data)
 
     def to_flat_dict(self):
-        return process_data(self)
\ No newline at end of file
+        return compile_flattener(self.__class__)(self)
+
+    @classmethod
+    def flat_dict_from_dict(cls, data):
+        """Converts the data into a flat dict.
+
+        This is same as `Industry.from_dict(data).to_flat_dict()`, but faster.
+        """
+        return compile_dict_flattener(cls)(data)
+
+
+def industries_to_columns(records, existing_rows=None):
+    """Converts the industries from the portal into columns of the flat table.
+
+    Returns a dict with column name as key and the list of values as value.
+    The column names come from the `column(target=...)` metadata of Industry.
+
+    When existing_rows is specified, which is a dict of the rows of an
+    earlier table with id as key, the existing row is reused for the
+    industries whose lastUpdateDate is not changed.
+    """
+    flat_fields = _get_flat_fields(Industry)
+    columns = {target: [] for _, target in flat_fields}
+    appenders = [(path, columns[target].append) for path, target in flat_fields]
+    existing_rows = existing_rows or {}
+
+    for d in records:
+        row = existing_rows.get(str(d.get('id')))
+        if row is not None and row['last_update_date'] == d.get('lastUpdateDate'):
+            for target, values in columns.items():
+                values.append(row[target])
+            continue
+
+        for path, append in appenders:
+            value = d
+            for name in path:
+                value = value and value.get(name)
+            append(value)
+
+    return columns
+
+def write_columns_csv(columns, path):
+    """Writes the columns to a CSV file in a single pass.
+    """
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(columns)
+        w.writerows(zip(*columns.values()))
+
+def write_columns_parquet(columns, path):
+    """Writes the columns to a parquet file. The values are saved as strings.
+    """
+    pa = import_pyarrow()
+    arrays = {name: pa.array([None if v is None else str(v) for v in values], pa.string())
+              for name, values in columns.items()}
+    pa.parquet.write_table(pa.table(arrays), path)
+
+def read_rows_csv(path):
+    """Reads the rows of an industries CSV file as a dict with id as key.
+    """
+    with open(path, newline="") as f:
+        return {row['id']: row for row in csv.DictReader(f)}
+
+def read_rows_parquet(path):
+    """Reads the rows of an industries parquet file as a dict with id as key.
+    """
+    pq = import_pyarrow().parquet
+    return {row['id']: row for row in pq.read_table(path).to_pylist()}
+
+def count_changed(records, existing_rows):
+    """Returns the number of industries that are new or whose lastUpdateDate
+    changed since the existing rows were saved.
+    """
+    count = 0
+    for d in records:
+        row = existing_rows.get(str(d.get('id')))
+        if row is None or row['last_update_date'] != d.get('lastUpdateDate'):
+            count += 1
+    return count
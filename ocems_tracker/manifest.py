@@ -0,0 +1,171 @@
+"""
+Manifest of the files in the local archive.
+
+The manifest has one entry for every archive file with the industry,
+year, number of rows, the range of the timestamps, the size and the md5
+checksum of the file. It is updated by the writers whenever they save an
+archive file, so the index of the archive can be made and the changed
+files can be found without reading or listing the files. The md5 of a
+file that was appended to is computed by the next refresh.
+
+The manifest is a SQLite database at archive/manifest.db.
+
+    manifest = Manifest.for_archive("archive")
+    manifest.get("2016/122.csv.gz")
+"""
+from dataclasses import dataclass, astuple, fields
+from pathlib import Path
+import gzip
+import hashlib
+import logging
+
+from .db import connect
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    industry_id INTEGER,
+    year INTEGER,
+    rows INTEGER,
+    min_time TEXT,
+    max_time TEXT,
+    size INTEGER,
+    md5 TEXT,
+    mtime REAL
+);
+"""
+
+
+@dataclass
+class ManifestEntry:
+    path: str
+    industry_id: int
+    year: int
+    rows: int
+    min_time: str
+    max_time: str
+    size: int
+    md5: str
+    mtime: float
+
+
+def compute_md5(path, chunk_size=1024*1024):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def read_time_range(path):
+    """Returns the number of rows and the min and max time of an archive file.
+    """
+    rows = 0
+    min_time = max_time = None
+    with gzip.open(path, "rb") as f:
+        for line in f:
+            # every gzip stream appended to the file may have a header
+            if line.startswith(b"industry_id,"):
+                continue
+            t = line.rsplit(b",", 2)[1]
+            if min_time is None or t < min_time:
+                min_time = t
+            if max_time is None or t > max_time:
+                max_time = t
+            rows += 1
+    return rows, min_time and min_time.decode(), max_time and max_time.decode()
+
+
+class Manifest:
+    def __init__(self, path, archive_root):
+        self.path = Path(path)
+        self.archive_root = Path(archive_root)
+        self.db = connect(self.path, SCHEMA)
+
+    @classmethod
+    def for_archive(cls, archive_root):
+        return cls(Path(archive_root) / MANIFEST_NAME, archive_root)
+
+    def get_key(self, path):
+        """Returns the key of an archive file, which looks like 2016/122.csv.gz.
+        """
+        return Path(path).relative_to(self.archive_root).as_posix()
+
+    def get(self, key):
+        row = self.db.execute("SELECT * FROM files WHERE path=?", [key]).fetchone()
+        return row and ManifestEntry(*row)
+
+    def entries(self):
+        return [ManifestEntry(*row) for row in self.db.execute("SELECT * FROM files ORDER BY industry_id, year")]
+
+    def add(self, path, rows, min_time, max_time, with_md5=True):
+        """Adds or replaces the entry of an archive file that has just been saved.
+
+        When with_md5 is False, the md5 is left empty and it is computed by
+        the next refresh.
+        """
+        path = Path(path)
+        key = self.get_key(path)
+        year, filename = key.split("/")
+        stat = path.stat()
+        entry = ManifestEntry(
+            path=key,
+            industry_id=int(filename.split(".")[0]),
+            year=int(year),
+            rows=rows,
+            min_time=min_time,
+            max_time=max_time,
+            size=stat.st_size,
+            md5=compute_md5(path) if with_md5 else None,
+            mtime=stat.st_mtime)
+        columns = [f.name for f in fields(ManifestEntry)]
+        self.db.execute(
+            f"INSERT OR REPLACE INTO files ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            astuple(entry))
+        return entry
+
+    def update(self, path, rows, min_time, max_time):
+        """Updates the entry of an archive file after rows are appended to it.
+
+        The rows, min_time and max_time are of the appended rows. If the file
+        isn't in the manifest, the existing rows are read from the file. The
+        md5 is not computed, so that an append doesn't read the whole file.
+        """
+        key = self.get_key(path)
+        entry = self.get(key)
+        if entry is None:
+            return self.add(path, *read_time_range(path), with_md5=False)
+        return self.add(path,
+            entry.rows + rows,
+            min(t for t in [entry.min_time, min_time] if t),
+            max(t for t in [entry.max_time, max_time] if t),
+            with_md5=False)
+
+    def refresh(self):
+        """Adds the archive files that are missing in the manifest or
+        have changed since they were added, and computes the md5 of the
+        files appended to since then.
+
+        Returns the number of entries updated.
+        """
+        known = {e.path: e for e in self.entries()}
+        count = 0
+        for path in sorted(self.archive_root.glob("*/*.csv.gz")):
+            entry = known.pop(self.get_key(path), None)
+            stat = path.stat()
+            if entry and entry.size == stat.st_size and entry.mtime == stat.st_mtime:
+                if entry.md5 is None:
+                    self.db.execute("UPDATE files SET md5=? WHERE path=?", [compute_md5(path), entry.path])
+                    count += 1
+                continue
+            logger.info("adding %s to the manifest", path)
+            self.add(path, *read_time_range(path))
+            count += 1
+
+        # the files that were deleted from the archive
+        self.db.executemany("DELETE FROM files WHERE path=?", [[key] for key in known])
+        return count + len(known)
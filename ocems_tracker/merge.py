@@ -0,0 +1,327 @@
+"""
+Merges downloaded rows into the archive without adding duplicate readings.
+
+The live data is downloaded for overlapping windows and the historical
+downloads can overlap with the data already in the archive. The merge
+adds only the readings whose (station, device, param_key, time) is not
+already archived, appending them to the yearly files of the industry.
+
+The incoming rows are sorted and deduplicated using an external merge
+sort, so that the memory used is bounded by max_rows. Then every reading
+is compared with the last archived time of its param from the
+HistoryState:
+
+- readings newer than the last archived time are appended
+- readings in the last window_days before the last archived time are
+  checked against the recent times of the param, which are kept in
+  `{industry_id}.recent.json` next to the history state
+- older readings are checked against the archive file of their year
+
+So the archive files are parsed only for backfills. The new rows are
+appended to the year files as new gzip streams, without copying the
+files, so a merge that doesn't have backfills costs only the new rows.
+
+    merger = ArchiveMerger("archive", "cache/history/state")
+    merger.merge(rows)
+"""
+from itertools import groupby
+from pathlib import Path
+import csv
+import datetime
+import gzip
+import heapq
+import json
+import logging
+import tempfile
+
+from .archive import YearlyWriter, iter_chunks
+from .history import HistoryState
+
+logger = logging.getLogger(__name__)
+
+
+def row_key(row):
+    # the ids are compared as strings as the rows read from files have
+    # strings, while the rows from the scraper have ints
+    return str(row[0]), str(row[1]), str(row[2]), row[3], row[5]
+
+
+def read_csv_rows(path):
+    """Reads the rows of a csv or csv.gz data file, skipping the headers.
+
+    The archive files can have multiple headers as every gzip stream
+    appended to them starts with a header.
+    """
+    path = Path(path)
+    open_ = gzip.open if path.suffix == ".gz" else open
+    with open_(path, "rt", newline="") as f:
+        for row in csv.reader(f):
+            if row and row[0] != "industry_id":
+                yield row
+
+
+def _write_run(rows, tmp_dir):
+    f = tempfile.NamedTemporaryFile("w", suffix=".csv", dir=tmp_dir, delete=False, newline="")
+    with f:
+        csv.writer(f).writerows(rows)
+    return f.name
+
+
+def external_sort(rows, key, max_rows, tmp_dir):
+    """Returns the rows sorted by key, keeping at most max_rows rows in memory.
+
+    The rows are sorted in runs of max_rows rows, which are written to
+    files in tmp_dir and merged. When all the rows fit in a single run,
+    nothing is written to disk.
+    """
+    runs = []
+    for chunk in iter_chunks(rows, max_rows):
+        chunk.sort(key=key)
+        if not runs and len(chunk) < max_rows:
+            return iter(chunk)
+        runs.append(_write_run(chunk, tmp_dir))
+    return heapq.merge(*[read_csv_rows(path) for path in runs], key=key)
+
+
+def unique(rows, key):
+    """Drops the rows with the same key as the previous row.
+    """
+    previous = None
+    for row in rows:
+        k = key(row)
+        if k != previous:
+            yield row
+            previous = k
+
+
+class _Spool:
+    """List of rows, which is moved to a temporary file when it has more than max_rows.
+    """
+    def __init__(self, tmp_dir, max_rows):
+        self.tmp_dir = tmp_dir
+        self.max_rows = max_rows
+        self.rows = []
+        self.file = None
+        self.count = 0
+
+    def append(self, row):
+        self.count += 1
+        if self.file:
+            self.writer.writerow(row)
+            return
+        self.rows.append(row)
+        if len(self.rows) > self.max_rows:
+            self.file = tempfile.NamedTemporaryFile("w", suffix=".csv", dir=self.tmp_dir, delete=False, newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerows(self.rows)
+            self.rows = []
+
+    def __iter__(self):
+        if self.file:
+            self.file.flush()
+            return read_csv_rows(self.file.name)
+        return iter(self.rows)
+
+
+def find_missing(path, rows, max_rows, tmp_dir):
+    """Returns the rows that are not in the archive file at path.
+
+    The rows must be sorted by row_key. When there are more than max_rows
+    rows, the archive file is sorted and merged with the rows instead of
+    keeping the keys of the rows in memory.
+    """
+    if not Path(path).exists():
+        return iter(rows)
+
+    if rows.count <= max_rows:
+        keys = {row_key(row) for row in rows}
+        for row in read_csv_rows(path):
+            keys.discard(row_key(row))
+        return (row for row in rows if row_key(row) in keys)
+
+    existing = external_sort(read_csv_rows(path), row_key, max_rows, tmp_dir)
+    return _merge_missing(rows, existing)
+
+
+def _merge_missing(rows, existing):
+    """Yields the rows whose keys are not in existing. Both must be sorted by row_key.
+    """
+    existing_keys = (row_key(row) for row in existing)
+    existing_key = next(existing_keys, None)
+    for row in rows:
+        k = row_key(row)
+        while existing_key is not None and existing_key < k:
+            existing_key = next(existing_keys, None)
+        if existing_key != k:
+            yield row
+
+
+def get_cutoff(last_time, window_days):
+    """Returns the time window_days before the last_time.
+    """
+    date = datetime.date.fromisoformat(last_time[:10]) - datetime.timedelta(days=window_days)
+    return date.isoformat() + last_time[10:]
+
+
+class RecentTimes:
+    """The times of the readings archived in the last few days of every param.
+
+    For every param, all the archived times later than `after` are in
+    `times`, so a reading later than `after` is archived if and only if its
+    time is in `times`.
+    """
+    def __init__(self, path, series=None):
+        self.path = Path(path)
+        self.series = series or {}
+
+    @classmethod
+    def load(cls, root, industry_id):
+        path = Path(root) / f"{industry_id}.recent.json"
+        if path.exists():
+            data = json.loads(path.read_text())
+            return cls(path, {k: (v["after"], set(v["times"])) for k, v in data.items()})
+        return cls(path)
+
+    @classmethod
+    def from_archive(cls, path, archive_paths, last_times, window_days):
+        """Reads the recent times of all the params from the archive files.
+        """
+        recent = cls(path)
+        cutoffs = {key: get_cutoff(t, window_days) for key, t in last_times.items()}
+        for archive_path in archive_paths:
+            for row in read_csv_rows(archive_path):
+                key = HistoryState.make_key(row[1], row[2], row[3])
+                if row[5] > cutoffs[key]:
+                    recent.add(key, row[5], cutoffs[key])
+        return recent
+
+    def get(self, key):
+        """Returns (after, times) for the param or None if not known.
+        """
+        return self.series.get(key)
+
+    def add(self, key, t, after):
+        if key not in self.series:
+            self.series[key] = (after, set())
+        self.series[key][1].add(t)
+
+    def prune(self, key, last_time, window_days):
+        """Drops the times older than window_days before the last time.
+        """
+        after, times = self.series[key]
+        cutoff = get_cutoff(last_time, window_days)
+        self.series[key] = (max(after, cutoff), {t for t in times if t > cutoff})
+
+    def save(self):
+        data = {k: {"after": after, "times": sorted(times)} for k, (after, times) in self.series.items()}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(data, sort_keys=True))
+        tmp_path.replace(self.path)
+
+
+class ArchiveMerger:
+    def __init__(self, archive_root, state_root, window_days=3, max_rows=1000000):
+        self.archive_root = Path(archive_root)
+        self.state_root = Path(state_root)
+        self.window_days = window_days
+        self.max_rows = max_rows
+
+    def merge(self, rows):
+        """Merges the rows, of any number of industries, into the archive.
+
+        The duplicates within the rows are dropped first. Returns a dict with
+        the number of rows added, the number of rows that were already
+        archived and the number of rows that were not newer than the last
+        archived time of their param.
+        """
+        counts = dict(added=0, duplicates=0, late=0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rows = unique(external_sort(rows, row_key, self.max_rows, tmp_dir), row_key)
+            for industry_id, industry_rows in groupby(rows, key=lambda row: str(row[0])):
+                result = self.merge_industry(industry_id, industry_rows, tmp_dir)
+                for k, v in result.items():
+                    counts[k] += v
+        logger.info("merged rows: %s", counts)
+        return counts
+
+    def merge_industry(self, industry_id, rows, tmp_dir):
+        """Merges the rows of an industry, which are sorted by row_key.
+        """
+        state, recent = self.load_state(industry_id)
+        new_state = HistoryState(state.path, dict(state.last_times))
+        counts = dict(added=0, duplicates=0, late=0)
+        # the rows to check against the archive file, by year
+        old_rows = {}
+
+        w = YearlyWriter(industry_id, self.archive_root, append=True)
+        try:
+            for row in rows:
+                key = HistoryState.make_key(row[1], row[2], row[3])
+                last_time = state.last_times.get(key)
+                t = row[5]
+                if last_time is None or t > last_time:
+                    self.add_row(w, new_state, recent, row, last_time or "")
+                    counts["added"] += 1
+                    continue
+
+                counts["late"] += 1
+                known = recent.get(key)
+                if known and t > known[0]:
+                    if t in known[1]:
+                        counts["duplicates"] += 1
+                    else:
+                        self.add_row(w, new_state, recent, row, known[0])
+                        counts["added"] += 1
+                    continue
+
+                year = t[:4]
+                if year not in old_rows:
+                    old_rows[year] = _Spool(tmp_dir, self.max_rows)
+                old_rows[year].append(row)
+
+            for year, spool in old_rows.items():
+                path = self.archive_root / year / f"{industry_id}.csv.gz"
+                added = 0
+                for row in find_missing(path, spool, self.max_rows, tmp_dir):
+                    # these are older than the recent times and are not added to them
+                    w.write_row(row)
+                    new_state.update(row)
+                    added += 1
+                counts["added"] += added
+                counts["duplicates"] += spool.count - added
+        except BaseException:
+            w.rollback()
+            raise
+        w.commit()
+
+        for key, last_time in new_state.last_times.items():
+            if recent.get(key):
+                recent.prune(key, last_time, self.window_days)
+        # the state is saved only after the files are committed
+        new_state.save()
+        recent.save()
+        logger.info("merged rows of industry %s: %s", industry_id, counts)
+        return counts
+
+    def load_state(self, industry_id):
+        """Loads the HistoryState and the RecentTimes of an industry.
+
+        When an archive file of the industry was saved after the recent
+        times, like when split_data replaces the files or historical_data
+        --incremental appends to them, they are computed again from the
+        archive files. HistoryState.load does the same for the state.
+        """
+        state = HistoryState.load(self.state_root, industry_id, archive_root=self.archive_root)
+        recent = RecentTimes.load(self.state_root, industry_id)
+
+        paths = sorted(self.archive_root.glob(f"*/{industry_id}.csv.gz"))
+        if recent.path.exists() and any(p.stat().st_mtime > recent.path.stat().st_mtime for p in paths):
+            logger.info("archive of industry %s changed after the recent times, reading them again", industry_id)
+            recent = RecentTimes.from_archive(recent.path, paths, state.last_times, self.window_days)
+        return state, recent
+
+    def add_row(self, w, state, recent, row, after):
+        w.write_row(row)
+        state.update(row)
+        recent.add(HistoryState.make_key(row[1], row[2], row[3]), row[5], after)
@@ -0,0 +1,20 @@
+"""
+Imports of the optional dependencies.
+
+The optional dependencies are imported only when the features that need
+them are used, so that the other commands work without them.
+"""
+
+
+def import_pyarrow():
+    """Returns the pyarrow module, with pyarrow.parquet loaded.
+
+    Raises ImportError with the instructions to install it when pyarrow is
+    not available.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required for the parquet format. Install it using: pip install pyarrow")
+    return pyarrow
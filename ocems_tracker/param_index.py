@@ -0,0 +1,170 @@
+"""
+Compact index of the params of all industries.
+
+The params of all the industries are stored as one row per param in
+column arrays, with the strings stored once in a string table. The index
+is saved as one .npy file per column, which are memory mapped when loaded,
+so loading the index doesn't require parsing the param metadata.
+
+    index = ParamIndex.from_metadata(api.get_all_param_metadata())
+    index.save("cache/param-index")
+
+    index = ParamIndex.load("cache/param-index")
+    index.get_params(industry_id=122)
+    index.get_params(param_key="pm")
+"""
+from pathlib import Path
+import json
+import logging
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INT_COLUMNS = ["industry_id", "station_id", "device_id", "param_id"]
+STRING_COLUMNS = ["key", "label", "name", "unit"]
+
+
+class ParamRecord:
+    """A param of a device of an industry.
+    """
+    __slots__ = INT_COLUMNS + STRING_COLUMNS + ["threshold"]
+
+    def __init__(self, industry_id, station_id, device_id, param_id, key, label, name, unit, threshold=None):
+        self.industry_id = industry_id
+        self.station_id = station_id
+        self.device_id = device_id
+        self.param_id = param_id
+        self.key = key
+        self.label = label
+        self.name = name
+        self.unit = unit
+        self.threshold = threshold
+
+    def __repr__(self):
+        return f"<ParamRecord {self.industry_id}/{self.station_id}/{self.device_id}/{self.key}>"
+
+
+class ParamIndex:
+    def __init__(self, columns, strings):
+        self.columns = columns
+        self.strings = strings
+        self._string_codes = {s: i for i, s in enumerate(strings)}
+        self._group_cache = {}
+
+    def __len__(self):
+        return len(self.columns["industry_id"])
+
+    @classmethod
+    def from_metadata(cls, param_metadata):
+        """Builds the index from the output of API.get_all_param_metadata.
+        """
+        strings = {}
+        def encode(s):
+            return strings.setdefault(s, len(strings))
+
+        rows = []
+        for industry in param_metadata:
+            for station in industry['stations']:
+                for device in station['devices']:
+                    for param in device['params']:
+                        try:
+                            threshold = float(param['max'])
+                        except (KeyError, TypeError, ValueError):
+                            threshold = np.nan
+                        rows.append((industry['id'], station['id'], device['id'], param['id'],
+                                     encode(param['key']), encode(param['label']),
+                                     encode(param['name']), encode(param['unit']),
+                                     threshold))
+
+        names = INT_COLUMNS + STRING_COLUMNS
+        values = list(zip(*rows)) or [[]] * (len(names) + 1)
+        columns = {name: np.array(values[i], dtype=np.int32) for i, name in enumerate(names)}
+        columns["threshold"] = np.array(values[-1], dtype=np.float64)
+        return cls(columns, list(strings))
+
+    def save(self, root):
+        root = Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        for name, values in self.columns.items():
+            # the existing files may be memory mapped by other processes, so
+            # they are replaced instead of being overwritten
+            tmp_path = root / f"{name}.npy.tmp"
+            with tmp_path.open("wb") as f:
+                np.save(f, values)
+            tmp_path.replace(root / f"{name}.npy")
+        # strings are written last, as they mark the index as complete
+        tmp_path = root / "strings.json.tmp"
+        tmp_path.write_text(json.dumps(self.strings))
+        tmp_path.replace(root / "strings.json")
+
+    @classmethod
+    def load(cls, root):
+        root = Path(root)
+        names = INT_COLUMNS + STRING_COLUMNS + ["threshold"]
+        columns = {name: np.load(root / f"{name}.npy", mmap_mode="r") for name in names}
+        strings = json.loads((root / "strings.json").read_text())
+        return cls(columns, strings)
+
+    @classmethod
+    def is_fresh(cls, root, max_age):
+        """Returns True if the index at root exists and is not older than max_age seconds.
+        """
+        path = Path(root) / "strings.json"
+        return path.exists() and path.stat().st_mtime + max_age > time.time()
+
+    def _groups(self, column):
+        """Returns a dict with the value of the column as key and the
+        indices of the rows with that value as value.
+
+        The rows of each group are in the same order as in the index.
+        """
+        if column not in self._group_cache:
+            values = np.asarray(self.columns[column])
+            order = np.argsort(values, kind="stable")
+            keys, starts, counts = np.unique(values[order], return_index=True, return_counts=True)
+            self._group_cache[column] = {k: order[s:s+c] for k, s, c in zip(keys.tolist(), starts.tolist(), counts.tolist())}
+        return self._group_cache[column]
+
+    def get_record(self, i):
+        c = self.columns
+        s = self.strings
+        threshold = float(c["threshold"][i])
+        return ParamRecord(
+            int(c["industry_id"][i]), int(c["station_id"][i]), int(c["device_id"][i]), int(c["param_id"][i]),
+            s[c["key"][i]], s[c["label"][i]], s[c["name"][i]], s[c["unit"][i]],
+            None if threshold != threshold else threshold)
+
+    def _find_rows(self, industry_id=None, station_id=None, device_id=None, param_key=None):
+        rows = None
+        filters = [("industry_id", industry_id), ("station_id", station_id), ("device_id", device_id)]
+        if param_key is not None:
+            filters.append(("key", self._string_codes.get(param_key, -1)))
+
+        empty = np.array([], dtype=np.int64)
+        for column, value in filters:
+            if value is None:
+                continue
+            matches = self._groups(column).get(int(value), empty)
+            rows = matches if rows is None else np.intersect1d(rows, matches)
+        return np.arange(len(self)) if rows is None else rows
+
+    def get_params(self, industry_id=None, station_id=None, device_id=None, param_key=None):
+        """Returns the list of params matching all the given filters.
+        """
+        rows = self._find_rows(industry_id, station_id, device_id, param_key)
+        return [self.get_record(i) for i in rows.tolist()]
+
+    def get_industry_ids(self):
+        return list(self._groups("industry_id"))
+
+    def has_industry(self, industry_id):
+        return int(industry_id) in self._groups("industry_id")
+
+    def get_thresholds(self):
+        """Returns the thresholds of all the params as a dict with (station_id, param_key) as key.
+        """
+        c = self.columns
+        rows = np.flatnonzero(~np.isnan(c["threshold"]))
+        return {(str(int(c["station_id"][i])), self.strings[c["key"][i]]): float(c["threshold"][i])
+                for i in rows.tolist()}
@@ -0,0 +1,141 @@
+"""
+Parquet output format for the archive.
+
+The rows are stored with native types - integer ids, timestamps and float
+values - and the param key and label as dictionary encoded strings. The
+files are partitioned by year and industry, just like the csv archive:
+
+    parquet/{year}/{industry_id}.parquet
+
+This requires pyarrow, which is an optional dependency.
+"""
+from pathlib import Path
+import csv
+import gzip
+import logging
+import shutil
+
+from .archive import parse_times
+from .optional import import_pyarrow
+from .writers import get_tmp_path
+
+logger = logging.getLogger(__name__)
+
+
+def get_schema():
+    pa = import_pyarrow()
+    return pa.schema([
+        ("industry_id", pa.int32()),
+        ("station_id", pa.int32()),
+        ("device_id", pa.int32()),
+        ("param_key", pa.dictionary(pa.int32(), pa.string())),
+        ("param_label", pa.dictionary(pa.int32(), pa.string())),
+        ("time", pa.timestamp("ms")),
+        ("value", pa.float64()),
+    ])
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def make_table(rows):
+    """Converts a list of rows into an arrow table.
+    """
+    pa = import_pyarrow()
+    schema = get_schema()
+    columns = list(zip(*rows))
+    arrays = [
+        pa.array([int(x) for x in columns[0]], pa.int32()),
+        pa.array([int(x) for x in columns[1]], pa.int32()),
+        pa.array([int(x) for x in columns[2]], pa.int32()),
+        pa.array([str(x) for x in columns[3]]).dictionary_encode(),
+        pa.array([str(x) for x in columns[4]]).dictionary_encode(),
+        # milliseconds since epoch
+        pa.array(parse_times([str(x) for x in columns[5]]), pa.timestamp("ms")),
+        pa.array([_to_float(x) for x in columns[6]], pa.float64()),
+    ]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class YearlyParquetWriter:
+    """Writes the rows of an industry to one parquet file per year.
+
+    This has the same interface as YearlyWriter. The rows are converted to
+    arrow tables in batches of batch_size rows.
+    """
+    def __init__(self, industry_id, parquet_root, batch_size=100000):
+        self.industry_id = industry_id
+        self.parquet_root = Path(parquet_root)
+        self.filename = f"{industry_id}.parquet"
+        self.batch_size = batch_size
+        self.writers = {}
+        self.paths = {}
+        self.batches = {}
+
+    def get_writer(self, year):
+        if year not in self.writers:
+            pq = import_pyarrow().parquet
+            path = get_tmp_path(self.parquet_root / year / self.filename)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.paths[year] = path
+            self.writers[year] = pq.ParquetWriter(path, get_schema(), compression="zstd")
+        return self.writers[year]
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def write_row(self, row):
+        # time looks like 2016-01-08 16:15:00:000
+        year = str(row[-2])[:4]
+        batch = self.batches.setdefault(year, [])
+        batch.append(row)
+        if len(batch) >= self.batch_size:
+            self.flush(year)
+
+    def flush(self, year):
+        rows = self.batches.pop(year)
+        self.get_writer(year).write_table(make_table(rows))
+
+    def commit(self):
+        """Saves all the files"""
+        for year in list(self.batches):
+            self.flush(year)
+
+        for year, w in self.writers.items():
+            w.close()
+            path = self.paths[year]
+            name = self.parquet_root / year / self.filename
+            shutil.move(path, name)
+            logger.info("saving file %s", name)
+
+    def rollback(self):
+        """Deletes all the files written.
+        """
+        self.batches.clear()
+        for year, w in self.writers.items():
+            w.close()
+            self.paths[year].unlink()
+
+
+def split_file_parquet(path, parquet_root, batch_size=100000):
+    """Splits a csv.gz data file for an industry into yearly parquet files.
+    """
+    path = Path(path)
+    logger.info("converting %s to parquet", path)
+    industry_id = path.name.split(".")[0]
+
+    w = YearlyParquetWriter(industry_id, parquet_root, batch_size=batch_size)
+    try:
+        with gzip.open(path, "rt") as f:
+            reader = csv.reader(f)
+            next(reader, None) # skip header
+            w.write_rows(reader)
+    except BaseException:
+        w.rollback()
+        raise
+    w.commit()
@@ -0,0 +1,244 @@
+"""
+Policy for making requests to the OCEMS portal.
+
+All the requests to the portal go through a RequestPolicy, which retries
+failed requests with exponential backoff and jitter, honors the
+Retry-After header of 429 and 503 responses and pauses all the requests
+using a circuit breaker when the portal is failing most of the requests.
+
+The requests that fail even after the retries are saved in a DeadLetters
+file so that they can be retried later.
+"""
+from collections import deque
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# the status codes that are worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Pauses all the requests for cooldown seconds when the error rate of
+    the recent requests goes above the given error_rate.
+
+    After the cooldown, the circuit is half-open. The first request that
+    completes decides whether the circuit is closed again or is opened for
+    another cooldown. The results of the requests that complete while the
+    circuit is open were started before it opened, so they are ignored.
+    """
+    def __init__(self, window=50, error_rate=0.5, min_requests=20, cooldown=60):
+        self.results = deque(maxlen=window)
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Blocks till the circuit is closed.
+        """
+        delay = self.open_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_state(self):
+        if not self.open_until:
+            return CLOSED
+        return OPEN if time.monotonic() < self.open_until else HALF_OPEN
+
+    def record(self, ok):
+        with self.lock:
+            state = self.get_state()
+            if state == OPEN:
+                return
+            if state == HALF_OPEN:
+                if ok:
+                    logger.info("The portal is responding again. Resuming all requests")
+                    self.open_until = 0
+                else:
+                    logger.warning("The request after the pause failed. Pausing all requests for %s seconds", self.cooldown)
+                    self._open()
+                return
+
+            self.results.append(ok)
+            if len(self.results) < self.min_requests:
+                return
+
+            errors = self.results.count(False)
+            if errors / len(self.results) >= self.error_rate:
+                logger.warning("%d of the last %d requests failed. Pausing all requests for %s seconds",
+                    errors, len(self.results), self.cooldown)
+                self._open()
+
+    def _open(self):
+        self.open_until = time.monotonic() + self.cooldown
+        self.results.clear()
+
+
+def get_retry_after(response):
+    """Returns the number of seconds to wait as specified by the Retry-After header.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        t = parsedate_to_datetime(value)
+        return max(0, (t - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestPolicy:
+    """Makes requests using a session with retries, backoff and a circuit breaker.
+
+    The wait asked for by the Retry-After header is honored in full, up to
+    max_retry_after seconds, even when it is longer than max_backoff.
+    """
+    def __init__(self, session, retries=5, backoff=1, max_backoff=60, max_retry_after=600, timeout=60,
+                 rate_limiter=None, circuit_breaker=None):
+        self.session = session
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+    def get_backoff(self, attempt):
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, parse=None, **kwargs):
+        """Makes the request, retrying it when it fails.
+
+        When parse is specified, it is called with the successful response
+        and its result is returned instead of the response. A ValueError
+        raised by parse, like for a truncated body or an error page in place
+        of JSON, is retried like a failed request.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries):
+            self.circuit_breaker.wait()
+            if self.rate_limiter:
+                self.rate_limiter.wait(url)
+
+            delay = self.get_backoff(attempt)
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            else:
+                if r.status_code not in RETRY_STATUS_CODES:
+                    if not parse or not r.ok:
+                        self.circuit_breaker.record(True)
+                        r.raise_for_status()
+                        return r
+                    try:
+                        result = parse(r)
+                    except ValueError as e:
+                        error = e
+                    else:
+                        self.circuit_breaker.record(True)
+                        return result
+                else:
+                    error = requests.HTTPError(f"{r.status_code} {r.reason}", response=r)
+                    retry_after = get_retry_after(r)
+                    if retry_after is not None:
+                        delay = min(retry_after, self.max_retry_after)
+
+            self.circuit_breaker.record(False)
+            if attempt + 1 == self.retries:
+                logger.error("%s %s failed even after %d attempts", method, url, self.retries)
+                raise error
+
+            logger.warning("%s %s failed with error %s. Retrying in %.1f seconds", method, url, error, delay)
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get_json(self, url, loads=None, **kwargs):
+        """Returns the JSON of the response, parsed using loads if specified.
+        """
+        return self.get(url, parse=_get_json_parser(loads), **kwargs)
+
+    def post_json(self, url, loads=None, **kwargs):
+        return self.post(url, parse=_get_json_parser(loads), **kwargs)
+
+
+def _get_json_parser(loads):
+    if loads:
+        return lambda r: loads(r.text)
+    return lambda r: r.json()
+
+
+class DeadLetters:
+    """List of failed requests saved as a JSONL file.
+
+    The records are taken out of the file for retrying using pop_all and
+    the file of the records being retried is deleted by calling done. If
+    the retry is interrupted, those records are included in the next pop_all.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.processing_path = self.path.with_name(self.path.name + ".processing")
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def _read(self, path):
+        if not path.exists():
+            return []
+        with path.open() as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def load(self):
+        """Returns all the records, without any duplicates.
+        """
+        records = self._read(self.processing_path) + self._read(self.path)
+        unique = {json.dumps(r, sort_keys=True): r for r in records}
+        return list(unique.values())
+
+    def pop_all(self):
+        """Returns all the records and moves them out of the list.
+        """
+        with self.lock:
+            records = self.load()
+            self.processing_path.parent.mkdir(parents=True, exist_ok=True)
+            with self.processing_path.open("w") as f:
+                for r in records:
+                    f.write(json.dumps(r) + "\n")
+            self.path.unlink(missing_ok=True)
+            return records
+
+    def done(self):
+        """Marks the records returned by pop_all as processed.
+        """
+        self.processing_path.unlink(missing_ok=True)
@@ -0,0 +1,92 @@
+"""
+Query the local copy of the archive.
+
+The index at data/index.csv is used to find the files of the matching
+industries and years, and only those files are read from the archive.
+The files are streamed line by line and the lines that don't match the
+query are skipped without fully parsing them.
+
+    q = ArchiveQuery("archive")
+    rows = q.query(industry_ids=[122], param_keys=["pm"], start="2019-03", end="2019-04")
+"""
+from pathlib import Path
+import csv
+import gzip
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveQuery:
+    def __init__(self, archive_root, index_path="data/index.csv"):
+        self.archive_root = Path(archive_root)
+        self.index_path = Path(index_path)
+
+    def read_index(self):
+        with self.index_path.open() as f:
+            yield from csv.DictReader(f)
+
+    def find_files(self, industry_ids=None, states=None, cities=None, start=None, end=None):
+        """Returns the paths of the archive files matching the given filters.
+
+        The start and end are dates or prefixes of dates like 2019 or
+        2019-03. The start is inclusive and the end is exclusive.
+        """
+        industry_ids = industry_ids and {str(id) for id in industry_ids}
+        states = states and {s.lower() for s in states}
+        cities = cities and {c.lower() for c in cities}
+
+        for row in self.read_index():
+            if industry_ids and row['industry_id'] not in industry_ids:
+                continue
+            if states and row['state'].lower() not in states:
+                continue
+            if cities and row['city'].lower() not in cities:
+                continue
+            if start and row['year'] < start[:4]:
+                continue
+            if end and row['year'] > end[:4]:
+                continue
+
+            path = self.archive_root / row['year'] / f"{row['industry_id']}.csv.gz"
+            if not path.exists():
+                logger.warning("%s is not available in the local archive", path)
+                continue
+            yield path
+
+    def query(self, industry_ids=None, states=None, cities=None, param_keys=None, start=None, end=None):
+        """Returns a generator with the rows matching the given filters.
+
+        Each row is a list of strings in the same format as the archive.
+        """
+        for path in self.find_files(industry_ids, states, cities, start, end):
+            yield from self.read_file(path, param_keys, start, end)
+
+    def read_file(self, path, param_keys=None, start=None, end=None):
+        logger.debug("reading %s", path)
+        param_keys = param_keys and {p.encode() for p in param_keys}
+        start = start and start.encode()
+        end = end and end.encode()
+
+        with gzip.open(path, "rb") as gz:
+            f = io.BufferedReader(gz, 1024*1024)
+            f.readline() # skip header
+            for line in f:
+                # 122,190,3080,pm,PM,2016-01-08 16:15:00:000,13.5
+                # the label may have commas, so split the fixed columns from both the ends
+                industry_id, station_id, device_id, param_key, rest = line.split(b",", 4)
+                if param_keys and param_key not in param_keys:
+                    continue
+
+                label, t, value = rest.rsplit(b",", 2)
+                if start and t < start:
+                    continue
+                if end and t >= end:
+                    continue
+
+                if label.startswith(b'"'):
+                    yield next(csv.reader([line.decode()]))
+                else:
+                    row = [industry_id, station_id, device_id, param_key, label, t, value.rstrip(b"\r\n")]
+                    yield [x.decode() for x in row]
@@ -0,0 +1,55 @@
+"""
+Removes sensitive fields like email, phone number, password and tokens
+from the data returned by the portal.
+
+The sensitive names are compiled into a single regular expression and the
+decision for every key is remembered, as the same keys are repeated in
+every response. The fields can be removed while the JSON is being parsed,
+without making a copy of the parsed data.
+
+    redactor = Redactor()
+    data = redactor.loads(response.text)
+"""
+import json
+import re
+
+SENSITIVE_NAMES = ['email', 'phone', 'contactno', 'password', 'token']
+
+
+class Redactor:
+    def __init__(self, sensitive_names=SENSITIVE_NAMES):
+        self.pattern = re.compile("|".join(re.escape(name) for name in sensitive_names), re.IGNORECASE)
+        self._decisions = {}
+
+    def is_sensitive_key(self, key):
+        decision = self._decisions.get(key)
+        if decision is None:
+            decision = self._decisions[key] = self.pattern.search(key) is not None
+        return decision
+
+    def _strip_object(self, d):
+        decisions = self._decisions
+        for k in d:
+            decision = decisions.get(k)
+            if decision is None:
+                decision = self.is_sensitive_key(k)
+            if decision:
+                # most objects don't have any sensitive fields,
+                # so a new dict is made only when required
+                return {k: v for k, v in d.items() if not self.is_sensitive_key(k)}
+        return d
+
+    def loads(self, text):
+        """Parses the JSON text, leaving out all the sensitive fields.
+        """
+        return json.loads(text, object_hook=self._strip_object)
+
+    def redact(self, data):
+        """Returns a copy of data without the sensitive fields.
+        """
+        if isinstance(data, list):
+            return [self.redact(d) for d in data]
+        elif isinstance(data, dict):
+            return {k: self.redact(v) for k, v in data.items() if not self.is_sensitive_key(k)}
+        else:
+            return data
@@ -0,0 +1,192 @@
+"""
+Hourly, daily and monthly rollups of the archived data.
+
+The rollups are computed while the data is being written to the archive
+and are saved next to it, one file per industry per year:
+
+    rollups/{year}/{industry_id}.csv.gz
+
+Each row of a rollup file has the count, mean, min and max of a param for
+one period, along with the threshold of the param and the number of
+readings that exceeded the threshold in that period. The unrounded sum
+of the values is also saved, so that the mean doesn't drift when the
+rollups are updated with new data.
+"""
+from pathlib import Path
+import csv
+import gzip
+import logging
+import shutil
+
+from .writers import get_tmp_path
+
+logger = logging.getLogger(__name__)
+
+# the period and the length of the prefix of the timestamp that identifies
+# the period. The timestamps look like 2016-01-08 16:15:00:000.
+PERIODS = [
+    ("hour", 13),
+    ("day", 10),
+    ("month", 7),
+]
+
+COLUMNS = [
+    "industry_id", "station_id", "device_id", "param_key", "period", "period_start",
+    "count", "mean", "min", "max", "threshold", "exceed_count", "sum"
+]
+
+
+class Rollup:
+    """Computes the rollups of an industry from a stream of values.
+
+    The stats are kept in memory and are spilled to disk when there are
+    more than max_entries of them, so the memory usage is bounded even when
+    the rows are not in any particular order. The spilled stats are merged
+    when the rollups are committed.
+
+    In append mode, the stats are merged with the existing rollup files
+    instead of replacing them.
+    """
+    def __init__(self, industry_id, rollup_root, thresholds=None, append=False, max_entries=200000):
+        self.industry_id = str(industry_id)
+        self.rollup_root = Path(rollup_root)
+        self.thresholds = thresholds or {}
+        self.append = append
+        self.max_entries = max_entries
+
+        # (station_id, device_id, param_key, period, period_start) -> [count, total, min, max, exceed_count]
+        self.stats = {}
+        self.spill_paths = {}
+
+    def add(self, station_id, device_id, param_key, t, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        if value != value: # nan
+            return
+
+        station_id = str(station_id)
+        threshold = self.thresholds.get((station_id, param_key))
+        exceeded = 1 if threshold is not None and value > threshold else 0
+
+        for period, n in PERIODS:
+            key = (station_id, str(device_id), param_key, period, t[:n])
+            s = self.stats.get(key)
+            if s is None:
+                self.stats[key] = [1, value, value, value, exceeded]
+            else:
+                s[0] += 1
+                s[1] += value
+                if value < s[2]:
+                    s[2] = value
+                if value > s[3]:
+                    s[3] = value
+                s[4] += exceeded
+
+        if len(self.stats) >= self.max_entries:
+            self.spill()
+
+    def add_row(self, row):
+        # row will be of the following format
+        # 122,190,3080,pm,PM,2016-01-08 16:15:00:000,13.5
+        self.add(row[1], row[2], row[3], str(row[5]), row[6])
+
+    def get_path(self, year):
+        return self.rollup_root / year / f"{self.industry_id}.csv.gz"
+
+    def spill(self):
+        """Writes the stats in memory to the spill files.
+        """
+        logger.debug("spilling %d rollup entries of industry %s", len(self.stats), self.industry_id)
+        for year, rows in self._group_by_year(self.stats).items():
+            if year in self.spill_paths:
+                mode = "at"
+            else:
+                # the name is unique to the process and the file is truncated
+                # when it is first opened, so that the spill file left by a
+                # worker that was killed is not read again
+                path = get_tmp_path(self.get_path(year).with_suffix(".gz.spill"))
+                path.parent.mkdir(parents=True, exist_ok=True)
+                self.spill_paths[year] = path
+                mode = "wt"
+            with gzip.open(self.spill_paths[year], mode, compresslevel=1) as f:
+                w = csv.writer(f)
+                w.writerows(list(key) + s for key, s in rows)
+        self.stats = {}
+
+    def _group_by_year(self, stats):
+        years = {}
+        for key, s in stats.items():
+            year = key[4][:4]
+            years.setdefault(year, []).append((key, s))
+        return years
+
+    def _read_spill(self, path, stats):
+        with gzip.open(path, "rt") as f:
+            for row in csv.reader(f):
+                key = tuple(row[:5])
+                s = [int(row[5]), float(row[6]), float(row[7]), float(row[8]), int(row[9])]
+                self._merge(stats, key, s)
+
+    def _read_existing(self, path, stats):
+        with gzip.open(path, "rt") as f:
+            for row in csv.DictReader(f):
+                key = (row['station_id'], row['device_id'], row['param_key'], row['period'], row['period_start'])
+                count = int(row['count'])
+                # the files saved before the sum was added have only the rounded mean
+                total = float(row['sum']) if row.get('sum') else float(row['mean']) * count
+                s = [count, total, float(row['min']), float(row['max']), int(row['exceed_count'])]
+                self._merge(stats, key, s)
+
+    def _merge(self, stats, key, s):
+        s0 = stats.get(key)
+        if s0 is None:
+            stats[key] = s
+        else:
+            s0[0] += s[0]
+            s0[1] += s[1]
+            s0[2] = min(s0[2], s[2])
+            s0[3] = max(s0[3], s[3])
+            s0[4] += s[4]
+
+    def commit(self):
+        """Merges the stats of every year and saves the rollup files.
+        """
+        in_memory = self._group_by_year(self.stats)
+        self.stats = {}
+
+        for year in sorted(set(in_memory) | set(self.spill_paths)):
+            stats = {}
+            path = self.get_path(year)
+            if self.append and path.exists():
+                self._read_existing(path, stats)
+            if year in self.spill_paths:
+                self._read_spill(self.spill_paths[year], stats)
+                self.spill_paths.pop(year).unlink()
+            for key, s in in_memory.get(year, []):
+                self._merge(stats, key, s)
+            self._save(path, stats)
+
+    def _save(self, path, stats):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = get_tmp_path(path)
+        with gzip.open(tmp_path, "wt") as f:
+            w = csv.writer(f)
+            w.writerow(COLUMNS)
+            for key in sorted(stats):
+                station_id, device_id, param_key, period, period_start = key
+                count, total, min_value, max_value, exceed_count = stats[key]
+                threshold = self.thresholds.get((station_id, param_key), "")
+                w.writerow([self.industry_id, station_id, device_id, param_key, period, period_start,
+                            count, round(total / count, 4), min_value, max_value, threshold, exceed_count, total])
+        shutil.move(tmp_path, path)
+        logger.info("saved rollups %s", path)
+
+    def rollback(self):
+        """Discards the stats and deletes the spill files.
+        """
+        self.stats = {}
+        for path in self.spill_paths.values():
+            path.unlink(missing_ok=True)
+        self.spill_paths = {}
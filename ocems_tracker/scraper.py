@@ -5,15 +5,37 @@ https://rtdms.cpcb.gov.in/data/
 """
 from bs4 import BeautifulSoup
 import requests
-from niftyhacks.cache import DiskCache
+from requests.adapters import HTTPAdapter
+from .cache import Cache, DAY
+from .concurrency import RateLimiter, bounded_map
+from .policy import DeadLetters, RequestPolicy
+from .redact import Redactor
+from .param_index import ParamIndex
+from .telemetry import telemetry
 from dataclasses import dataclass, field
 import datetime
 import pytz
 import logging
+import itertools
 import json
-import time
+import threading
+
+# how long the entries are kept in the cache, by key prefix
+CACHE_TTLS = {
+    "states.json": 30*DAY,
+    "cities": 30*DAY,
+    "industries": 7*DAY,
+    "industry-ids": 7*DAY,
+    "industry-metadata/": DAY,
+    "param-metadata": DAY,
+}
+
+cache = Cache("cache/cache.db", ttls=CACHE_TTLS, max_size=1024*1024*1024)
 
-cache = DiskCache("cache/")
+redactor = Redactor()
+
+# metrics of all the requests to the portal and the progress of the downloads
+telemetry.cache = cache
 
 logger = logging.getLogger(__name__)
 
@@ -22,26 +44,32 @@ headers = {
     "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0"
 }
 
+DEAD_LETTERS_PATH = "cache/dead-letters.jsonl"
+PARAM_INDEX_PATH = "cache/param-index"
+
 class API:
     def __init__(self):
         self.session = requests.Session()
         self.session.headers.update(headers)
         self.session.verify = False
+        telemetry.instrument(self.session)
+        # all requests go through the policy for retries and backoff
+        self.policy = RequestPolicy(self.session)
 
     @cache.memoize("states.json")
     def get_states(self):
         url = "https://rtdms.cpcb.gov.in/api/getAllState"
-        return self.session.get(url).json()
+        return self.policy.get_json(url)
 
     @cache.memoize("cities/{state_id}.json")
     def get_cities(self, state_id):
         url = f"https://rtdms.cpcb.gov.in/api/getAllCity/{state_id}"
-        return self.session.get(url).json()
+        return self.policy.get_json(url)
 
     @cache.memoize("industries/{state_id}-{city}.json")
     def get_industries(self, state_id, city):
         url = f"https://rtdms.cpcb.gov.in/api/industryList/45/{state_id}/{city}"
-        return self.session.get(url).json()
+        return self.policy.get_json(url)
 
     @cache.memoize("industries.json")
     def get_all_industries(self):
@@ -53,29 +81,59 @@ class API:
         industries = self.get_all_industries()
         return sorted(industry['id'] for industry in industries)
 
-    def get_all_industry_status(self):
+    def get_all_industry_status(self, max_workers=8):
+        """Returns the status of all industries.
+
+        The status is 'unknown' for the industries in the cities for which
+        the status could not be fetched.
+        """
         industry_ids = self.get_industry_ids()
-        d = {row['id']: row['status'] for row in self._get_all_industry_live_status()}
+        records, failed_cities = self._get_all_industry_live_status(max_workers)
+        d = {row['id']: row['status'] for row in records}
+
+        unknown = {industry['id'] for industry in self.get_all_industries()
+                   if (str(industry['state']['id']), industry['city']) in failed_cities}
+        if unknown:
+            logger.warning("status of %d industries in %d cities is unknown", len(unknown), len(failed_cities))
 
         for industry_id in industry_ids:
-            status = d.get(industry_id) or 'offline'
+            if industry_id in unknown:
+                status = 'unknown'
+            else:
+                status = d.get(industry_id) or 'offline'
             yield dict(industry_id=industry_id, status=status)
 
-    def _get_all_industry_live_status(self):
+    def _get_all_industry_live_status(self, max_workers=8):
         """Returns status of all live industries.
 
-        Returns a generator with one record for every live industry. Each record looks like the following:
+        The status of all the cities is fetched concurrently and the
+        requests are retried as per the request policy of the API. Returns a list
+        with one record for every live industry and the set of (state_id, city)
+        for which the status could not be fetched. Each record looks like the following:
 
             {"id": 2364, "status": "live"}
         """
-        for city in self.get_all_cities():
-            yield from self._get_industry_live_status(city['id'], city['city'])
+        def fetch(city):
+            try:
+                return self._get_industry_live_status(city['id'], city['city'])
+            except Exception:
+                logger.error("Failed to fetch live status for city %s - %s", city['id'], city['city'], exc_info=True)
+                return None
+
+        cities = self.get_all_cities()
+        records = []
+        failed_cities = set()
+        for city, result in zip(cities, bounded_map(fetch, cities, max_workers)):
+            if result is None:
+                failed_cities.add((str(city['id']), city['city']))
+            else:
+                records.extend(result)
+        return records, failed_cities
 
     def _get_industry_live_status(self, state_id, city):
         logger.info("fetching live status for city %s - %s", state_id, city)
         url = f"https://rtdms.cpcb.gov.in/api/industryListStatus/45/{state_id}/{city}"
-        r = self.session.get(url)
-        return r.json()
+        return self.policy.get_json(url, timeout=30)
 
     @cache.memoize("cities.json")
     def get_all_cities(self):
@@ -85,10 +143,10 @@ class API:
 
     @cache.memoize("industry-metadata/{industry_id}.json")
     def get_industry_metadata(self, industry_id):
-        print("get_industry_metadata", industry_id)
+        logger.info("fetching metadata of industry %s", industry_id)
         url = f"https://rtdms.cpcb.gov.in/api/industryMapDetailNEW/{industry_id}"
-        print("GET", url)
-        data = self.session.get(url).json()
+        # the sensitive fields are removed while parsing the response
+        data = self.policy.get_json(url, loads=redactor.loads)
         if not data:
             data = {
                 "industry": {
@@ -97,27 +155,82 @@ class API:
             }
         # remove recentData
         data.pop('recentData', None)
-        return self.strip_sensitive_data(data)
+        return data
 
-    @cache.memoize("industry-metadata/all.jsonl")
     def get_all_industry_metadata(self):
+        """Returns the metadata of all the industries.
+
+        The industries whose metadata could not be fetched are skipped and
+        the result is saved in the cache only when there are no failures,
+        so that the next call fetches the failed industries again.
+        """
+        key = "industry-metadata/all.jsonl"
+        records = cache.get(key)
+        if records is not None:
+            return records
+
+        records = []
+        failed = []
         for id in self.get_industry_ids():
-            yield self.get_industry_metadata(id)
+            try:
+                records.append(self.get_industry_metadata(id))
+            except Exception:
+                logger.error("Failed to fetch metadata of industry %s", id, exc_info=True)
+                failed.append(id)
+
+        if failed:
+            logger.error("Failed to fetch metadata for %d industries: %s", len(failed), failed)
+        else:
+            cache.set(key, records)
+        return records
+
+    def prefetch_industries(self, max_workers=8):
+        """Fetches the industries of all cities concurrently and saves them in the cache.
+
+        Only the cities that are not already in the cache are fetched, so an
+        interrupted run can be resumed by calling this again.
+        """
+        cities = [city for city in self.get_all_cities()
+                  if not cache.exists(f"industries/{city['id']}-{city['city']}.json")]
+        logger.info("fetching industries for %d cities", len(cities))
+
+        def fetch(city):
+            return self._prefetch(self.get_industries, city['id'], city['city'])
+
+        failed = sum(1 for ok in bounded_map(fetch, cities, max_workers) if not ok)
+        if failed:
+            logger.error("Failed to fetch industries for %d cities", failed)
+
+    def prefetch_industry_metadata(self, max_workers=8):
+        """Fetches the metadata of all industries concurrently and saves them in the cache.
+
+        Only the industries that are not already in the cache are fetched, so
+        an interrupted run can be resumed by calling this again.
+        """
+        self.prefetch_industries(max_workers)
+        industry_ids = [id for id in self.get_industry_ids()
+                        if not cache.exists(f"industry-metadata/{id}.json")]
+        logger.info("fetching metadata for %d industries", len(industry_ids))
+
+        def fetch(industry_id):
+            return self._prefetch(self.get_industry_metadata, industry_id)
+
+        failed = sum(1 for ok in bounded_map(fetch, industry_ids, max_workers) if not ok)
+        if failed:
+            logger.error("Failed to fetch metadata for %d industries", failed)
+
+    def _prefetch(self, func, *args):
+        try:
+            func(*args)
+            return True
+        except Exception:
+            logger.error("Failed to fetch %s%s", func.__name__, args, exc_info=True)
+            return False
 
     def strip_sensitive_data(self, data):
         """Removes sensitive fields like email, phone number, password and tokens.
         """
-        def is_sensitive_key(key):
-            key = key.lower()
-            sensitive_names = ['email', 'phone', 'contactno', 'password', 'token']
-            return any(name in key for name in sensitive_names)
-
-        if isinstance(data, list):
-            return [self.strip_sensitive_data(d) for d in data]
-        elif isinstance(data, dict):
-            return {k: self.strip_sensitive_data(v) for k, v in data.items() if not is_sensitive_key(k)}
-        else:
-            return data
+        return redactor.redact(data)
 
 
     def today(self) -> datetime.date:
@@ -214,74 +327,264 @@ class API:
         return process_industry(data)
 
 
+def load_param_index(api):
+    """Loads the index of params, building it from the param metadata
+    if it is not available or is older than a day.
+    """
+    if ParamIndex.is_fresh(PARAM_INDEX_PATH, max_age=DAY):
+        return ParamIndex.load(PARAM_INDEX_PATH)
+
+    logger.info("building the param index")
+    index = ParamIndex.from_metadata(api.get_all_param_metadata())
+    index.save(PARAM_INDEX_PATH)
+    return index
+
+
+def resolve_start_date(start_date, today):
+    """Returns the date of a start date relative to today, like 2d-ago or 10y-ago.
+    """
+    n, unit = int(start_date[:-5]), start_date[-5]
+    if unit == "y":
+        try:
+            return today.replace(year=today.year - n)
+        except ValueError:
+            # Feb 29 in a year that is not a leap year
+            return today.replace(year=today.year - n, day=28)
+    return today - datetime.timedelta(days=n)
+
+
 class LiveDataScrapper:
     """Utility to download live data for all industries.
+
+    The param values are fetched concurrently using `max_workers` threads
+    and the requests to the portal are limited to `rate_limit` requests per
+    second per host.
+
+    The params that could not be fetched are saved to the dead_letters,
+    so that they can be retried later using retry_failed. The start date
+    is saved as a date, so that the same window is fetched when retrying
+    on a later day.
+
+    When batch_params is True, all the params of a device are requested in
+    a single request. If the portal doesn't return all the params in the
+    response, the missing params are requested one at a time. Batching is
+    turned off when none of the first few batch requests succeed.
     """
-    def __init__(self, api):
+    # number of failed batch requests after which batching is turned off
+    MAX_BATCH_FAILURES = 3
+
+    def __init__(self, api, max_workers=1, rate_limit=None, dead_letters=None, batch_params=False):
         self.api = api
         self.session = api.session
-        self.param_metadata = api.get_all_param_metadata()
-        self.metadata_lookup = {d['id']: d for d in self.param_metadata}
+        self.param_index = load_param_index(api)
         # fetch last 2 days of data
         self.start_date = "2d-ago"
 
+        self.max_workers = max_workers
+        if rate_limit:
+            self.api.policy.rate_limiter = RateLimiter(rate_limit)
+        self.dead_letters = dead_letters or DeadLetters(DEAD_LETTERS_PATH)
+        # make sure there is a connection for every worker thread
+        adapter = HTTPAdapter(pool_maxsize=max(max_workers, 10))
+        self.session.mount("https://", adapter)
+
+        self.batch_params = batch_params
+        self.batch_successes = 0
+        self.batch_failures = 0
+        self.param_count = 0
+        self.request_count = 0
+        self.lock = threading.Lock()
+
     def get_historical_data(self, industry_id):
         self.start_date = "10y-ago"
         date = "history"
         return self._get_live_data(date, industry_id)
 
+    def get_incremental_data(self, industry_id, state):
+        """Returns the historical data of an industry that is newer than the
+        last archived timestamps in the given HistoryState.
+
+        Only the window after the last archived timestamp of every param is
+        requested from the portal. The params that were never archived are
+        downloaded in full.
+        """
+        today = self.api.today()
+        tasks = []
+        last_times = {}
+        for param, _ in self._get_param_tasks(industry_id):
+            last_time = state.get(param.station_id, param.device_id, param.key)
+            if last_time:
+                # time looks like 2016-01-08 16:15:00:000
+                days = (today - datetime.date.fromisoformat(last_time[:10])).days + 1
+                start_date = f"{days}d-ago"
+            else:
+                start_date = "10y-ago"
+            tasks.append((param, start_date))
+            last_times[param.station_id, param.device_id, param.key] = last_time or ""
+
+        for row in self._fetch_params(tasks):
+            if row[5] > last_times[row[1], row[2], row[3]]:
+                yield row
+
     def get_live_data(self, industry_id):
         date = self.api.today()
         return self._get_live_data(date, industry_id)
 
     def get_all_live_data(self):
-        for industry_id in self.api.get_industry_ids():
-            yield from self.get_live_data(industry_id)
+        tasks = [task
+            for industry_id in self.api.get_industry_ids()
+            for task in self._get_param_tasks(industry_id)]
+        telemetry.add_total(len(tasks))
+        return self._fetch_params(tasks)
+
+    def count_params(self, industry_ids):
+        """Returns the number of params of the given industries.
+
+        This is used as the total of the progress of the download.
+        """
+        return sum(len(self.param_index.get_params(industry_id=id)) for id in industry_ids)
 
     # @cache.memoize("live-data/{date}/{industry_id}.jsonl")
     def _get_live_data(self, date, industry_id):
-        industry_id = int(industry_id)
-        if industry_id not in self.metadata_lookup:
-            print("Unknown industry_id: %r", industry_id)
+        tasks = self._get_param_tasks(industry_id)
+        return self._fetch_params(tasks)
+
+    def _get_param_tasks(self, industry_id):
+        """Returns a generator with (param, start_date) for every param of
+        the given industry, where param is a ParamRecord.
+
+        The start_date is None to use the default start date of the scrapper.
+        """
+        if not self.param_index.has_industry(industry_id):
+            logger.warning("Unknown industry_id: %r", industry_id)
+            return
+        for param in self.param_index.get_params(industry_id=industry_id):
+            yield param, None
+
+    def _fetch_params(self, tasks):
+        """Fetches the values of all the params concurrently.
+
+        Returns a generator with one row for each value. The rows are in the
+        same order as the tasks. The number of params and rows fetched are
+        added to the telemetry.
+        """
+        if self.batch_params:
+            batches = (list(g) for _, g in itertools.groupby(tasks, key=self._get_device_key))
+            results = bounded_map(self._fetch_param_batch, batches, self.max_workers)
+        else:
+            results = bounded_map(self._fetch_param, tasks, self.max_workers)
+
+        for rows in results:
+            # counted as they are fetched, before any filtering by the callers
+            telemetry.count("rows_fetched", len(rows))
+            yield from rows
+
+        logger.info("fetched %d params using %d requests, saved %d requests",
+            self.param_count, self.request_count, self.param_count - self.request_count)
+
+    def _get_device_key(self, task):
+        param, start_date = task
+        return param.industry_id, param.station_id, param.device_id, start_date
+
+    def _make_rows(self, param, values):
+        row = [param.industry_id, param.station_id, param.device_id, param.key, param.label]
+        return [row + [d['time'], d['value']] for d in values]
+
+    def _fetch_param(self, task):
+        param, start_date = task
+        with self.lock:
+            self.param_count += 1
+        telemetry.advance()
+        try:
+            data = self.get_param_values(param.industry_id, param.station_id, param.device_id, param.key, start_date=start_date)
+            return self._make_rows(param, data[param.name])
+        except Exception:
+            args = dict(industry_id=param.industry_id,
+                        station_id=param.station_id,
+                        device_id=param.device_id,
+                        param_key=param.key,
+                        start_date=resolve_start_date(start_date or self.start_date, self.api.today()).isoformat())
+            logger.error("FAILED PARAMS %s", json.dumps(args))
+            logger.error("Failed to fetch param values", exc_info=True)
+            self.dead_letters.add(args)
             return []
-        industry = self.metadata_lookup[industry_id]
-        for station in industry['stations']:
-            for device in station['devices']:
-                for param in device['params']:
-                    row = [industry['id'], station['id'], device['id'], param['key'], param['label']]
-                    try:
-                        data = self.get_param_values(industry_id, station['id'], device['id'], param['key'])
-
-                        data2 = [row + [d['time'], d['value']] for d in data[param['name']]]
-                        yield from data2
-                    except Exception:
-                        args = dict(industry_id=industry['id'],
-                                    station_id=station['id'],
-                                    device_id=device['id'],
-                                    param_key=param['key'])
-                        logger.error("FAILED PARAMS %s", json.dumps(args))
-                        logger.error("Failed to fetch param values", exc_info=True)
-
-    def get_param_values(self, industry_id, station_id, device_id, param_key):
-        logger.info("get_param_values %s %s %s %s", industry_id, station_id, device_id, param_key)
-        retries = 3
-        r = None
-        for i in range(retries):
-            try:
-                url = f"https://rtdms.cpcb.gov.in/api/stations/{station_id}/devices/{device_id}/data"
-                payload = {
-                    "avg": "minute_15",
-                    "param": param_key,
-                    "startDate": self.start_date
-                }
-                r = self.session.post(url, json=payload)
-                return r.json()
-            except Exception as e:
-                if i+1 < retries:
-                    logger.error("Failed with error %s", e)
-                    logger.error("Response: %s", r.text if r else "")
-                    logger.error("Retrying...")
-                    time.sleep(2)
-                else:
-                    logger.error("Failed even after retries")
-                    raise
+
+    def _fetch_param_batch(self, tasks):
+        """Fetches the values of all the params of a device in a single request.
+
+        The params missing in the response are fetched one at a time.
+        """
+        if len(tasks) == 1 or not self.batch_params:
+            return [row for task in tasks for row in self._fetch_param(task)]
+
+        first, start_date = tasks[0]
+        param_keys = ",".join(param.key for param, _ in tasks)
+        try:
+            data = self.get_param_values(first.industry_id, first.station_id, first.device_id, param_keys, start_date=start_date)
+        except Exception:
+            logger.warning("Failed to fetch params %s of device %s in a batch", param_keys, first.device_id, exc_info=True)
+            data = {}
+
+        rows = []
+        missing = []
+        for task in tasks:
+            param = task[0]
+            if isinstance(data, dict) and param.name in data:
+                rows.extend(self._make_rows(param, data[param.name]))
+            else:
+                missing.append(task)
+
+        with self.lock:
+            self.param_count += len(tasks) - len(missing)
+            if len(missing) < len(tasks) - 1:
+                self.batch_successes += 1
+            else:
+                self.batch_failures += 1
+                if self.batch_successes == 0 and self.batch_failures >= self.MAX_BATCH_FAILURES:
+                    logger.warning("The portal doesn't seem to support fetching multiple params in a request. Turning off batching.")
+                    self.batch_params = False
+        telemetry.advance(len(tasks) - len(missing))
+
+        for task in missing:
+            rows.extend(self._fetch_param(task))
+        return rows
+
+    def retry_failed(self):
+        """Retries fetching the params saved in the dead letters.
+
+        Returns a generator with the rows of the params that could be
+        fetched. The params that fail again are added back to the dead letters.
+        """
+        records = self.dead_letters.pop_all()
+        logger.info("retrying %d failed params", len(records))
+
+        today = self.api.today()
+        tasks = []
+        for r in records:
+            params = self.param_index.get_params(
+                industry_id=r['industry_id'],
+                station_id=r['station_id'],
+                device_id=r['device_id'],
+                param_key=r['param_key'])
+            if not params:
+                logger.error("Unknown param %s", json.dumps(r))
+                continue
+            # the portal takes the start date relative to today, like 5d-ago
+            days = (today - datetime.date.fromisoformat(r['start_date'])).days
+            tasks.append((params[0], f"{days}d-ago"))
+
+        yield from self._fetch_params(tasks)
+        self.dead_letters.done()
+
+    def get_param_values(self, industry_id, station_id, device_id, param_key, start_date=None):
+        start_date = start_date or self.start_date
+        logger.info("get_param_values %s %s %s %s %s", industry_id, station_id, device_id, param_key, start_date)
+        with self.lock:
+            self.request_count += 1
+        url = f"https://rtdms.cpcb.gov.in/api/stations/{station_id}/devices/{device_id}/data"
+        payload = {
+            "avg": "minute_15",
+            "param": param_key,
+            "startDate": start_date
+        }
+        return self.api.policy.post_json(url, json=payload)
@@ -0,0 +1,154 @@
+"""
+History of the live status of all industries.
+
+The status of every industry for every day is stored as a matrix of
+industry x date, with one byte per entry, in a single .npz file. The
+queries over date ranges are computed on the whole matrix at once.
+
+    history = StatusHistory.load("daily/status-history.npz")
+    history.append(date, {2364: "live", 2365: "offline"})
+    history.save("daily/status-history.npz")
+
+    history.uptime(start="2023-01-01", end="2024-01-01")
+"""
+from pathlib import Path
+import datetime
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN = 0
+OFFLINE = 1
+LIVE = 2
+
+STATUS_CODES = {
+    "offline": OFFLINE,
+    "live": LIVE,
+}
+
+
+def _days(date1, date2):
+    """Returns the number of days from date2 to date1.
+    """
+    return int((date1 - date2) // np.timedelta64(1, "D"))
+
+
+class StatusHistory:
+    def __init__(self, industry_ids=None, start_date=None, matrix=None):
+        self.industry_ids = np.asarray(industry_ids if industry_ids is not None else [], dtype=np.int64)
+        self.start_date = np.datetime64(start_date, "D") if start_date is not None else None
+        self.matrix = matrix if matrix is not None else np.zeros((len(self.industry_ids), 0), dtype=np.int8)
+        self._index = {id: i for i, id in enumerate(self.industry_ids.tolist())}
+
+    @classmethod
+    def load(cls, path):
+        """Loads the history from a file, or returns an empty history if the file doesn't exist.
+        """
+        path = Path(path)
+        if not path.exists():
+            return cls()
+        with np.load(path) as d:
+            start_date = d['start_date'][0] if len(d['start_date']) else None
+            return cls(d['industry_ids'], start_date, d['matrix'])
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        start_date = np.array([self.start_date] if self.start_date is not None else [], dtype="datetime64[D]")
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("wb") as f:
+            np.savez_compressed(f, industry_ids=self.industry_ids, start_date=start_date, matrix=self.matrix)
+        tmp_path.replace(path)
+
+    @property
+    def dates(self):
+        if self.start_date is None:
+            return np.array([], dtype="datetime64[D]")
+        return self.start_date + np.arange(self.matrix.shape[1])
+
+    def append(self, date, statuses):
+        """Adds the status of industries on a date.
+
+        The statuses is a dict with industry_id as key and status as value.
+        The status of the industries that are not in the dict is unknown.
+        """
+        date = np.datetime64(date, "D")
+
+        new_ids = [id for id in statuses if id not in self._index]
+        if new_ids:
+            self.industry_ids = np.concatenate([self.industry_ids, np.asarray(new_ids, dtype=np.int64)])
+            rows = np.zeros((len(new_ids), self.matrix.shape[1]), dtype=np.int8)
+            self.matrix = np.concatenate([self.matrix, rows])
+            self._index.update((id, i) for i, id in enumerate(self.industry_ids.tolist()))
+
+        if self.start_date is None:
+            self.start_date = date
+        if date < self.start_date:
+            columns = np.zeros((self.matrix.shape[0], _days(self.start_date, date)), dtype=np.int8)
+            self.matrix = np.concatenate([columns, self.matrix], axis=1)
+            self.start_date = date
+
+        column = _days(date, self.start_date)
+        if column >= self.matrix.shape[1]:
+            columns = np.zeros((self.matrix.shape[0], column + 1 - self.matrix.shape[1]), dtype=np.int8)
+            self.matrix = np.concatenate([self.matrix, columns], axis=1)
+
+        rows = np.array([self._index[id] for id in statuses], dtype=np.int64)
+        codes = np.array([STATUS_CODES.get(s, UNKNOWN) for s in statuses.values()], dtype=np.int8)
+        self.matrix[rows, column] = codes
+
+    def _select(self, start=None, end=None, industry_ids=None):
+        """Returns the industry ids and the part of the matrix for the given
+        date range and industries. The start is inclusive and the end is exclusive.
+        """
+        dates = self.dates
+        mask = np.ones(len(dates), dtype=bool)
+        if start is not None:
+            mask &= dates >= np.datetime64(start, "D")
+        if end is not None:
+            mask &= dates < np.datetime64(end, "D")
+
+        matrix = self.matrix[:, mask]
+        ids = self.industry_ids
+        if industry_ids is not None:
+            rows = np.array([self._index[id] for id in industry_ids if id in self._index], dtype=np.int64)
+            matrix = matrix[rows]
+            ids = ids[rows]
+        return ids, dates[mask], matrix
+
+    def uptime(self, start=None, end=None, industry_ids=None):
+        """Returns the percentage of days each industry was live, ignoring
+        the days on which the status is unknown.
+
+        Returns a dict with industry_id as key.
+        """
+        ids, _, matrix = self._select(start, end, industry_ids)
+        live = (matrix == LIVE).sum(axis=1)
+        known = (matrix != UNKNOWN).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            percent = np.where(known > 0, 100.0 * live / known, np.nan)
+        return dict(zip(ids.tolist(), percent.round(2).tolist()))
+
+    def longest_outage(self, start=None, end=None, industry_ids=None):
+        """Returns the maximum number of consecutive days each industry was offline.
+
+        Returns a dict with industry_id as key.
+        """
+        ids, _, matrix = self._select(start, end, industry_ids)
+        if matrix.shape[1] == 0:
+            return dict.fromkeys(ids.tolist(), 0)
+
+        offline = matrix == OFFLINE
+        # number of offline days so far and its value at the last day that was not offline
+        count = np.cumsum(offline, axis=1)
+        last_reset = np.maximum.accumulate(np.where(offline, 0, count), axis=1)
+        runs = count - last_reset
+        return dict(zip(ids.tolist(), runs.max(axis=1).tolist()))
+
+    def live_counts(self, start=None, end=None, industry_ids=None):
+        """Returns the number of live industries on each date as a dict with date as key.
+        """
+        _, dates, matrix = self._select(start, end, industry_ids)
+        counts = (matrix == LIVE).sum(axis=0)
+        return dict(zip(dates.astype(datetime.date).tolist(), counts.tolist()))
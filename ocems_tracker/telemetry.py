@@ -0,0 +1,317 @@
+"""
+Telemetry of the requests to the portal and the progress of the downloads.
+
+The requests made using an instrumented session are counted by endpoint,
+along with the bytes downloaded and a histogram of the latencies. The
+scraper and the writers add counters like the number of rows fetched and
+written, and the progress towards a known total, from which the
+throughput and the ETA are computed.
+
+The metrics of the running command are kept in the module level
+`telemetry`, which is shared by the scraper and the writers.
+
+    telemetry.instrument(session)
+
+    with Reporter(telemetry, interval=30, path="metrics.prom"):
+        ...
+
+The metrics can be saved as JSON or as a Prometheus textfile, which is
+picked up by the textfile collector of node_exporter.
+"""
+from pathlib import Path
+from urllib.parse import urlparse
+import bisect
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the latency buckets in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")]
+
+
+def get_endpoint(url):
+    """Returns the name of the API endpoint of a url, leaving out the ids in the path.
+
+        >>> get_endpoint("https://rtdms.cpcb.gov.in/api/industryList/45/1/Delhi")
+        'industryList'
+        >>> get_endpoint("https://rtdms.cpcb.gov.in/api/stations/1/devices/2/data")
+        'stations/data'
+    """
+    parts = urlparse(url).path.strip("/").split("/")
+    if parts and parts[0] == "api":
+        parts = parts[1:]
+    if not parts or not parts[0]:
+        return "/"
+    if parts[0] == "stations" and parts[-1] == "data":
+        return "stations/data"
+    return parts[0]
+
+
+class Histogram:
+    """Histogram with fixed buckets, so that the memory used doesn't grow
+    with the number of values.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket that has the p-th percentile.
+        """
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def _round(value, digits=3):
+    return None if value is None else round(value, digits)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "latency_avg": _round(self.latency.sum / self.latency.count) if self.latency.count else None,
+            "latency_p50": _round(self.latency.percentile(50)),
+            "latency_p90": _round(self.latency.percentile(90)),
+            "latency_p99": _round(self.latency.percentile(99)),
+            "latency_max": round(self.latency.max, 3),
+        }
+
+
+class Telemetry:
+    """Metrics of the requests to the portal and the progress of a command.
+
+    The hit ratio of the cache is included in the metrics when a cache
+    is specified and it was used.
+    """
+    def __init__(self, name="ocems", cache=None):
+        self.name = name
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.endpoints = {}
+            self.counters = {}
+            self.done = 0
+            self.total = 0
+
+    def instrument(self, session):
+        """Records every request made using the session.
+
+        The time includes reading the response body, and the requests that
+        fail without a response are counted as errors.
+        """
+        request = session.request
+
+        def instrumented_request(method, url, *args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                response = request(method, url, *args, **kwargs)
+            except Exception:
+                self.record_request(url, time.perf_counter() - t0, error=True)
+                raise
+            size = len(response.content) if not kwargs.get("stream") else 0
+            self.record_request(url, time.perf_counter() - t0, size, error=response.status_code >= 400)
+            return response
+
+        session.request = instrumented_request
+        return session
+
+    def record_request(self, url, latency, size=0, error=False):
+        endpoint = get_endpoint(url)
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.requests += 1
+            stats.errors += error
+            stats.bytes += size
+            stats.latency.add(latency)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_total(self, n):
+        """Adds n to the total amount of work, which is used to compute the ETA.
+        """
+        with self.lock:
+            self.total += n
+
+    def advance(self, n=1):
+        with self.lock:
+            self.done += n
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            endpoints = {k: v.to_dict() for k, v in sorted(self.endpoints.items())}
+            counters = dict(self.counters)
+            done, total = self.done, self.total
+            request_seconds = sum(s.latency.sum for s in self.endpoints.values())
+
+        rate = done / elapsed if elapsed else 0
+        d = {
+            "name": self.name,
+            "elapsed": round(elapsed, 1),
+            "requests": sum(e["requests"] for e in endpoints.values()),
+            "errors": sum(e["errors"] for e in endpoints.values()),
+            "bytes": sum(e["bytes"] for e in endpoints.values()),
+            # time spent waiting for the portal, summed over all the threads
+            "request_seconds": round(request_seconds, 1),
+            "counters": counters,
+            "rates": {k: round(v / elapsed, 1) if elapsed else 0 for k, v in counters.items()},
+            "done": done,
+            "total": total,
+            "eta": round((total - done) / rate) if total and rate else None,
+            "endpoints": endpoints,
+        }
+        # only the counters of the cache are read, as reading its stats
+        # would open the cache even for the commands that don't use it
+        lookups = self.cache.hits + self.cache.misses if self.cache is not None else 0
+        if lookups:
+            d["cache_hit_ratio"] = round(self.cache.hits / lookups, 4)
+        return d
+
+    def summary(self):
+        """Returns a one line summary of the metrics.
+        """
+        d = self.snapshot()
+        parts = [
+            f"{d['name']}: {d['requests']} requests ({d['errors']} errors)",
+            f"{d['bytes'] / 1024 / 1024:.1f} MB",
+        ]
+        parts.extend(f"{d['counters'][k]} {k} ({d['rates'][k]}/s)" for k in d["counters"])
+        if "cache_hit_ratio" in d:
+            parts.append(f"cache hit ratio {d['cache_hit_ratio']}")
+        if d["total"]:
+            parts.append(f"{d['done']}/{d['total']} done")
+        if d["eta"] is not None:
+            parts.append(f"ETA {d['eta']}s")
+        return ", ".join(parts)
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text format.
+        """
+        d = self.snapshot()
+        labels = f'command="{d["name"]}"'
+        lines = []
+
+        def metric(name, type, help, values):
+            lines.append(f"# HELP ocems_{name} {help}")
+            lines.append(f"# TYPE ocems_{name} {type}")
+            for extra_labels, value in values:
+                lines.append(f"ocems_{name}{{{labels}{extra_labels}}} {value}")
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            metric("requests_total", "counter", "Number of requests to the portal",
+                   [(f',endpoint="{k}"', s.requests) for k, s in endpoints])
+            metric("request_errors_total", "counter", "Number of failed requests to the portal",
+                   [(f',endpoint="{k}"', s.errors) for k, s in endpoints])
+            metric("response_bytes_total", "counter", "Bytes downloaded from the portal",
+                   [(f',endpoint="{k}"', s.bytes) for k, s in endpoints])
+
+            lines.append("# HELP ocems_request_duration_seconds Latency of the requests to the portal")
+            lines.append("# TYPE ocems_request_duration_seconds histogram")
+            for k, s in endpoints:
+                h = s.latency
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f'ocems_request_duration_seconds_bucket{{{labels},endpoint="{k}",le="{le}"}} {cumulative}')
+                lines.append(f'ocems_request_duration_seconds_sum{{{labels},endpoint="{k}"}} {h.sum}')
+                lines.append(f'ocems_request_duration_seconds_count{{{labels},endpoint="{k}"}} {h.count}')
+
+        for k, v in d["counters"].items():
+            metric(f"{k}_total", "counter", f"Number of {k}", [("", v)])
+        metric("progress_done", "gauge", "Amount of work done", [("", d["done"])])
+        metric("progress_total", "gauge", "Total amount of work", [("", d["total"])])
+        if d["eta"] is not None:
+            metric("eta_seconds", "gauge", "Estimated time to finish", [("", d["eta"])])
+        if "cache_hit_ratio" in d:
+            metric("cache_hit_ratio", "gauge", "Hit ratio of the cache", [("", d["cache_hit_ratio"])])
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        """Saves the metrics to path, as JSON if it ends with .json or
+        in the Prometheus text format otherwise.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if path.suffix == ".json":
+            text = json.dumps(self.snapshot(), indent=2)
+        else:
+            text = self.to_prometheus()
+        # the file is replaced atomically so that it is never read half written
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(text)
+        tmp_path.replace(path)
+
+
+# the metrics of the running command
+telemetry = Telemetry()
+
+
+class Reporter:
+    """Context manager that logs a summary of the metrics every interval
+    seconds and saves them to path, if specified.
+    """
+    def __init__(self, telemetry, interval=30, path=None):
+        self.telemetry = telemetry
+        self.interval = interval
+        self.path = path
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def report(self):
+        logger.info("%s", self.telemetry.summary())
+        if self.path:
+            self.telemetry.save(self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception:
+                logger.warning("Failed to report the metrics", exc_info=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.report()
@@ -0,0 +1,149 @@
+"""
+Uploads the files of the local archive to the internet archive item.
+
+Only the files that are not already in the item with the same md5 are
+uploaded, using a pool of threads. Every upload is recorded in a journal
+file, so an interrupted upload can be resumed without checking the files
+that are already uploaded again.
+
+    client = InternetArchiveClient("ocems-data-archive")
+    uploader = Uploader(client, "archive", UploadJournal("cache/upload-journal.jsonl"))
+    uploader.run(max_workers=4)
+
+The LocalArchiveClient is a stand-in for the archive item that copies
+the files to a local directory.
+"""
+from pathlib import Path
+import json
+import logging
+import shutil
+import threading
+import time
+
+from .concurrency import bounded_map
+from .manifest import Manifest, compute_md5
+
+logger = logging.getLogger(__name__)
+
+
+class InternetArchiveClient:
+    """Uploads files to an item in internet archive.
+    """
+    def __init__(self, identifier, retries=3):
+        import internetarchive as ia
+        self.item = ia.get_item(identifier)
+        self.retries = retries
+
+    def get_md5s(self):
+        """Returns the md5 of all the files in the item as a dict with the name as key.
+        """
+        return {f["name"]: f.get("md5") for f in self.item.files}
+
+    def upload_file(self, path, name):
+        r = self.item.upload_file(str(path), key=name, retries=self.retries)
+        r.raise_for_status()
+
+
+class LocalArchiveClient:
+    """Stand-in for an archive item, which keeps the files in a local directory.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def get_md5s(self):
+        return {p.relative_to(self.root).as_posix(): compute_md5(p) for p in self.root.glob("*/*.csv.gz")}
+
+    def upload_file(self, path, name):
+        target = self.root / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_name(target.name + ".tmp")
+        shutil.copy(path, tmp_path)
+        tmp_path.replace(target)
+
+
+class UploadJournal:
+    """JSONL file with a record for every file uploaded.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def load(self):
+        """Returns the md5 of the files uploaded as a dict with the name as key.
+        """
+        if not self.path.exists():
+            return {}
+        with self.path.open() as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        return {r["name"]: r["md5"] for r in records}
+
+
+class Uploader:
+    def __init__(self, client, archive_root, journal):
+        self.client = client
+        self.archive_root = Path(archive_root)
+        self.journal = journal
+        self.manifest = Manifest.for_archive(archive_root)
+
+    def get_pending_files(self, years=None):
+        """Returns the manifest entries of the files that need to be uploaded.
+
+        The files are skipped when the same md5 is in the journal or in the
+        archive item. The item is listed only when some file is not in the
+        journal.
+        """
+        # make sure the md5s are of the files as they are now
+        self.manifest.refresh()
+        entries = self.manifest.entries()
+        if years:
+            years = {int(y) for y in years}
+            entries = [e for e in entries if e.year in years]
+
+        uploaded = self.journal.load()
+        entries = [e for e in entries if uploaded.get(e.path) != e.md5]
+        if entries:
+            remote = self.client.get_md5s()
+            entries = [e for e in entries if remote.get(e.path) != e.md5]
+        return entries
+
+    def upload(self, entry):
+        path = self.archive_root / entry.path
+        t0 = time.perf_counter()
+        try:
+            self.client.upload_file(path, entry.path)
+        except Exception:
+            logger.error("Failed to upload %s", entry.path, exc_info=True)
+            return False
+
+        seconds = time.perf_counter() - t0
+        logger.info("uploaded %s - %.1f MB in %.1f seconds (%.2f MB/s)",
+            entry.path, entry.size / 1024 / 1024, seconds, entry.size / 1024 / 1024 / max(seconds, 1e-6))
+        self.journal.add(dict(name=entry.path, md5=entry.md5, size=entry.size, seconds=round(seconds, 3), time=time.time()))
+        return True
+
+    def run(self, years=None, max_workers=4, dry_run=False):
+        """Uploads the pending files, max_workers at a time.
+
+        Returns the number of files uploaded and failed.
+        """
+        entries = self.get_pending_files(years)
+        size = sum(e.size for e in entries)
+        logger.info("%d files to upload, %.1f MB", len(entries), size / 1024 / 1024)
+        if dry_run:
+            for e in entries:
+                logger.info("would upload %s", e.path)
+            return dict(uploaded=0, failed=0)
+
+        t0 = time.perf_counter()
+        results = list(bounded_map(self.upload, entries, max_workers))
+        seconds = time.perf_counter() - t0
+        uploaded = sum(results)
+        logger.info("uploaded %d files in %.1f seconds (%.2f MB/s)",
+            uploaded, seconds, size / 1024 / 1024 / max(seconds, 1e-6))
+        return dict(uploaded=uploaded, failed=len(results) - uploaded)
@@ -0,0 +1,271 @@
+"""
+Work queue for downloading the historical data using many workers.
+
+The industries are split into shards, which are stored in a SQLite
+database. Workers, running as separate processes on one machine or on
+several machines sharing the filesystem, take a lease on a shard, renew
+the lease periodically while they work on it and mark every industry as
+done once it is downloaded. When a worker crashes, its lease expires and
+the shard is picked up by another worker, skipping the industries that
+are already done.
+
+    queue = WorkQueue("cache/queue.db")
+    queue.init(industry_ids, shard_size=10)
+
+    while (shard := queue.claim(worker_id)):
+        with Heartbeat(queue, shard):
+            for industry_id in shard.pending_ids:
+                ...
+                queue.mark_done(shard, industry_id, row_count)
+        queue.complete(shard)
+
+The database doesn't use WAL mode, as that doesn't work when the file
+is on a network filesystem.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .db import connect
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS items (
+    industry_id INTEGER PRIMARY KEY,
+    shard_id INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    rows INTEGER NOT NULL DEFAULT 0,
+    finished REAL,
+    worker TEXT
+);
+CREATE INDEX IF NOT EXISTS items_shard ON items(shard_id);
+"""
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@dataclass
+class Shard:
+    id: int
+    worker: str
+    industry_ids: list
+    pending_ids: list
+
+
+class LeaseLost(Exception):
+    """Raised when a worker has lost the lease on its shard to another worker.
+    """
+
+
+class WorkQueue:
+    """Queue of shards of industries, stored in a SQLite database.
+
+    A shard is leased by a worker for lease_timeout seconds. A shard that
+    failed max_attempts times is marked as failed and not retried.
+    """
+    def __init__(self, path, lease_timeout=300, max_attempts=3):
+        self.path = Path(path)
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.db = connect(self.path, SCHEMA)
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock upfront, so that two
+        # workers can't claim the same shard
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        return db
+
+    def init(self, industry_ids, shard_size=10, reset=False):
+        """Adds the industries to the queue, in shards of shard_size industries.
+
+        The industries that are already in the queue are not added again,
+        unless reset is True, in which case the queue is cleared first.
+        """
+        db = self._transaction()
+        try:
+            if reset:
+                db.execute("DELETE FROM items")
+                db.execute("DELETE FROM shards")
+            existing = {id for id, in db.execute("SELECT industry_id FROM items")}
+            new_ids = [id for id in dict.fromkeys(industry_ids) if id not in existing]
+            for i in range(0, len(new_ids), shard_size):
+                shard_id = db.execute("INSERT INTO shards (status) VALUES (?)", [PENDING]).lastrowid
+                db.executemany("INSERT INTO items (industry_id, shard_id) VALUES (?, ?)",
+                               [(id, shard_id) for id in new_ids[i:i+shard_size]])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        logger.info("added %d industries to the queue", len(new_ids))
+        return len(new_ids)
+
+    def claim(self, worker):
+        """Takes a lease on the next available shard.
+
+        A shard is available when it is pending or when the lease of the
+        worker working on it has expired. Returns None when there are no
+        shards available.
+        """
+        now = time.time()
+        db = self._transaction()
+        try:
+            row = db.execute(
+                "SELECT id, worker FROM shards"
+                " WHERE status=? OR (status=? AND lease_until < ?)"
+                " ORDER BY id LIMIT 1",
+                [PENDING, LEASED, now]).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+
+            shard_id, previous_worker = row
+            if previous_worker:
+                logger.warning("lease of worker %s on shard %d has expired", previous_worker, shard_id)
+            db.execute(
+                "UPDATE shards SET status=?, worker=?, lease_until=?, attempts=attempts+1,"
+                " started=COALESCE(started, ?) WHERE id=?",
+                [LEASED, worker, now + self.lease_timeout, now, shard_id])
+            items = db.execute("SELECT industry_id, done FROM items WHERE shard_id=? ORDER BY rowid", [shard_id]).fetchall()
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        return Shard(shard_id, worker,
+                     industry_ids=[id for id, _ in items],
+                     pending_ids=[id for id, done in items if not done])
+
+    def heartbeat(self, shard):
+        """Renews the lease on the shard.
+
+        Raises LeaseLost if the shard has been leased by another worker.
+        """
+        cursor = self.db.execute(
+            "UPDATE shards SET lease_until=? WHERE id=? AND worker=? AND status=?",
+            [time.time() + self.lease_timeout, shard.id, shard.worker, LEASED])
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"worker {shard.worker} has lost the lease on shard {shard.id}")
+
+    def mark_done(self, shard, industry_id, rows=0):
+        """Marks an industry of the shard as done.
+        """
+        self.db.execute(
+            "UPDATE items SET done=1, rows=?, finished=?, worker=? WHERE industry_id=? AND shard_id=?",
+            [rows, time.time(), shard.worker, industry_id, shard.id])
+
+    def complete(self, shard):
+        self._finish(shard, DONE)
+
+    def fail(self, shard, error):
+        """Releases the shard after an error, so that it is retried by
+        another worker, or marks it as failed after max_attempts.
+        """
+        db = self._transaction()
+        try:
+            attempts, = db.execute("SELECT attempts FROM shards WHERE id=?", [shard.id]).fetchone()
+            status = FAILED if attempts >= self.max_attempts else PENDING
+            db.execute(
+                "UPDATE shards SET status=?, worker=NULL, lease_until=NULL, error=? WHERE id=? AND worker=?",
+                [status, str(error), shard.id, shard.worker])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def release(self, shard):
+        """Returns the shard to the queue without counting it as an attempt.
+        """
+        self.db.execute(
+            "UPDATE shards SET status=?, worker=NULL, lease_until=NULL, attempts=attempts-1 WHERE id=? AND worker=?",
+            [PENDING, shard.id, shard.worker])
+
+    def _finish(self, shard, status):
+        self.db.execute(
+            "UPDATE shards SET status=?, lease_until=NULL, finished=? WHERE id=? AND worker=?",
+            [status, time.time(), shard.id, shard.worker])
+
+    def status(self):
+        """Returns the progress of the queue.
+
+        The throughput is the number of rows downloaded per second since
+        the first shard was claimed.
+        """
+        now = time.time()
+        db = self.db
+        shards = dict.fromkeys([PENDING, LEASED, DONE, FAILED], 0)
+        for status, count in db.execute("SELECT status, COUNT(*) FROM shards GROUP BY status"):
+            shards[status] = count
+        expired, = db.execute("SELECT COUNT(*) FROM shards WHERE status=? AND lease_until < ?", [LEASED, now]).fetchone()
+        total, done, rows = db.execute("SELECT COUNT(*), COALESCE(SUM(done), 0), COALESCE(SUM(rows), 0) FROM items").fetchone()
+        started, = db.execute("SELECT MIN(started) FROM shards").fetchone()
+        workers = [w for w, in db.execute("SELECT worker FROM shards WHERE status=? AND lease_until >= ?", [LEASED, now])]
+
+        elapsed = now - started if started else 0
+        return {
+            "shards": shards,
+            "expired_leases": expired,
+            "industries": total,
+            "industries_done": done,
+            "rows": rows,
+            "rows_per_sec": round(rows / elapsed, 1) if elapsed else 0,
+            "industries_per_hour": round(3600 * done / elapsed, 1) if elapsed else 0,
+            "active_workers": workers,
+        }
+
+
+class Heartbeat:
+    """Context manager that renews the lease on a shard in a background thread.
+
+    The lost attribute is set when the lease is lost to another worker.
+    """
+    def __init__(self, queue, shard, interval=None):
+        self.queue = queue
+        self.shard = shard
+        self.interval = interval or queue.lease_timeout / 3
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.queue.heartbeat(self.shard)
+            except LeaseLost as e:
+                logger.error("%s", e)
+                self.lost.set()
+                return
+            except sqlite3.Error:
+                # try again in the next interval, the lease is long enough
+                logger.warning("Failed to renew the lease on shard %d", self.shard.id, exc_info=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
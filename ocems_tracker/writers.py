@@ -0,0 +1,133 @@
+"""
+Writers to save the rows downloaded from OCEMS.
+"""
+from pathlib import Path
+import csv
+import gzip
+import logging
+import os
+import shutil
+import socket
+
+from .telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = "industry_id station_id device_id param_key param_label time value".split()
+
+
+def get_tmp_path(path):
+    """Returns the path of the temporary file used to write the file at path.
+
+    The name is unique to the process, so the workers of the work queue
+    that write the same file at the same time don't share the temporary file.
+    """
+    path = Path(path)
+    return path.with_name(f"{path.name}.{socket.gethostname()}-{os.getpid()}.tmp")
+
+
+class StreamingCSVWriter:
+    """Writes rows to a CSV file as they arrive.
+
+    Only `buffer_size` rows are kept in memory at any time, so the memory
+    usage stays the same irrespective of the number of rows written.
+
+    When split_by_date is True, the path must have a `{date}` placeholder
+    and the rows are written to one file per date. The rows are written to
+    temporary files, which are moved to their final place on commit.
+
+        with StreamingCSVWriter("live-data/{date}.csv.gz", compress=True, split_by_date=True) as w:
+            w.write_rows(rows)
+    """
+    def __init__(self, path, columns=COLUMNS, compress=False, split_by_date=False, buffer_size=1000):
+        self.path = str(path)
+        self.columns = columns
+        self.compress = compress
+        self.split_by_date = split_by_date
+        self.buffer_size = buffer_size
+
+        if split_by_date and "{date}" not in self.path:
+            raise ValueError("path must have a {date} placeholder when splitting by date")
+
+        self.files = {}
+        self.buffers = {}
+        self.row_count = 0
+        # paths of the files saved by commit
+        self.saved_paths = []
+
+    def get_key(self, row):
+        # time looks like 2016-01-08 16:15:00:000
+        return str(row[-2])[:10] if self.split_by_date else None
+
+    def get_path(self, key):
+        return Path(self.path.format(date=key) if self.split_by_date else self.path)
+
+    def open_file(self, key):
+        path = self.get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        if self.compress:
+            f = gzip.open(tmp_path, "wt", newline="")
+        else:
+            f = open(tmp_path, "w", newline="")
+        w = csv.writer(f)
+        w.writerow(self.columns)
+        return path, tmp_path, f, w
+
+    def write_row(self, row):
+        key = self.get_key(row)
+        buffer = self.buffers.setdefault(key, [])
+        buffer.append(row)
+        self.row_count += 1
+        if len(buffer) >= self.buffer_size:
+            self.flush_buffer(key)
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def flush_buffer(self, key):
+        if key not in self.files:
+            self.files[key] = self.open_file(key)
+        _, _, f, w = self.files[key]
+        rows = self.buffers.pop(key)
+        w.writerows(rows)
+        telemetry.count("rows_written", len(rows))
+
+    def flush(self):
+        for key in list(self.buffers):
+            self.flush_buffer(key)
+
+    def commit(self):
+        """Writes the pending rows and moves all the files to their final place.
+
+        When there are no rows, a file with only the header is saved, except
+        when splitting by date as the date of the file isn't known.
+        """
+        self.flush()
+        if not self.files and not self.saved_paths and not self.split_by_date:
+            self.files[None] = self.open_file(None)
+        for path, tmp_path, f, _ in self.files.values():
+            f.close()
+            shutil.move(tmp_path, path)
+            logger.info("saved %s", path)
+            self.saved_paths.append(path)
+        self.files.clear()
+
+    def rollback(self):
+        """Deletes all the partially written files.
+        """
+        self.buffers.clear()
+        for _, tmp_path, f, _ in self.files.values():
+            f.close()
+            tmp_path.unlink()
+        self.files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
@@ -0,0 +1,55 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from ocems_tracker.archive import get_years, parse_times
+
+
+def to_ms(t):
+    dt = datetime.datetime.strptime(t, "%Y-%m-%d %H:%M:%S:%f").replace(tzinfo=datetime.timezone.utc)
+    return round(dt.timestamp() * 1000)
+
+
+def test_parse_times():
+    times = [
+        "2016-01-08 16:15:00:000",
+        "2016-02-29 23:59:59:999",
+        "1999-12-31 00:00:00:001",
+        "2024-07-01 12:30:45:500",
+    ]
+    assert parse_times(times).tolist() == [to_ms(t) for t in times]
+    assert parse_times([t.encode() for t in times]).tolist() == [to_ms(t) for t in times]
+    assert get_years(parse_times(times)).tolist() == [2016, 2016, 1999, 2024]
+
+
+def test_parse_times_empty():
+    assert len(parse_times([])) == 0
+
+
+def test_parse_times_without_milliseconds():
+    assert parse_times(["2016-01-08 16:15:00", "2016-01-08 16:15:00:5"]).tolist() == [
+        to_ms("2016-01-08 16:15:00:000"), to_ms("2016-01-08 16:15:00:500")]
+
+
+@pytest.mark.parametrize("t", [
+    "",
+    "2016-01-08",
+    "2016-01-08T16:15:00:000",
+    "2016-01-08 16:15:00:0000",
+    " 2016-01-08 16:15:00:00",
+    "2016-13-01 00:00:00:000",
+    "2016-02-30 00:00:00:000",
+    "2016-01-08 24:00:00:000",
+    "2016-01-08 16:15:00:00é",
+])
+def test_parse_times_invalid(t):
+    with pytest.raises(ValueError):
+        parse_times(["2016-01-08 16:15:00:000", t])
+
+
+def test_parse_times_large():
+    start = np.datetime64("2015-12-31T00:00:00", "ms")
+    expected = start + np.arange(0, 10000) * np.timedelta64(15, "m")
+    times = [str(t).replace("T", " ").replace(".", ":") for t in expected]
+    assert (parse_times(times) == expected.astype(np.int64)).all()
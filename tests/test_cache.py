@@ -0,0 +1,93 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ocems_tracker.cache import Cache
+
+
+def test_get_and_set(tmp_path):
+    cache = Cache(tmp_path / "cache.db")
+    cache.set("a.json", {"x": [1, 2]})
+    assert cache.get("a.json") == {"x": [1, 2]}
+    assert cache.get("b.json") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_ttl_by_longest_prefix(tmp_path):
+    cache = Cache(tmp_path / "cache.db", ttls={"industries": 100, "industries/1": 0.01})
+    cache.set("industries/1.json", 1)
+    cache.set("industries/2.json", 2)
+    cache.set("states.json", 3)
+    time.sleep(0.02)
+    assert not cache.exists("industries/1.json")
+    assert cache.get("industries/2.json") == 2
+    assert cache.get("states.json") == 3
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = Cache(tmp_path / "cache.db", max_size=2000)
+    for i in range(10):
+        cache.set(f"k{i}", os.urandom(100).hex())
+        time.sleep(0.001)
+    cache.get("k0")
+    for i in range(10, 20):
+        cache.set(f"k{i}", os.urandom(100).hex())
+        time.sleep(0.001)
+
+    assert cache.get_size() <= 2000
+    assert cache.exists("k0")
+    assert not cache.exists("k1")
+    assert cache.exists("k19")
+
+
+def test_running_size(tmp_path):
+    cache = Cache(tmp_path / "cache.db", max_size=10**6)
+    for i in range(20):
+        cache.set(f"k{i % 7}", "x" * i)
+    cache.delete("k3")
+    assert cache._size == cache.get_size()
+
+
+def test_counters_from_threads(tmp_path):
+    cache = Cache(tmp_path / "cache.db")
+    cache.set("a", 1)
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda i: cache.get("a" if i % 2 else "b"), range(1000)))
+    assert cache.stats()["hits"] == 500
+    assert cache.stats()["misses"] == 500
+
+
+def test_dump_missing_key(tmp_path):
+    cache = Cache(tmp_path / "cache.db")
+    with pytest.raises(KeyError):
+        cache.dump("missing.json", tmp_path / "out.json")
+    assert not (tmp_path / "out.json").exists()
+
+
+def test_access_times_saved_on_set(tmp_path):
+    cache = Cache(tmp_path / "cache.db")
+    cache.set("a", 1)
+    cache.set("b", 2)
+    created = cache.db.execute("SELECT accessed FROM cache WHERE key='a'").fetchone()[0]
+    time.sleep(0.01)
+    cache.get("a")
+    # reading an entry doesn't write to the database
+    assert cache.db.execute("SELECT accessed FROM cache WHERE key='a'").fetchone()[0] == created
+    cache.set("c", 3)
+    assert cache.db.execute("SELECT accessed FROM cache WHERE key='a'").fetchone()[0] > created
+
+
+def test_access_times_saved_on_close(tmp_path):
+    cache = Cache(tmp_path / "cache.db")
+    cache.set("a", 1)
+    cache.set("b", 2)
+    time.sleep(0.01)
+    cache.get("a")
+    cache.close()
+
+    cache = Cache(tmp_path / "cache.db")
+    keys = [k for k, in cache.db.execute("SELECT key FROM cache ORDER BY accessed")]
+    assert keys == ["b", "a"]
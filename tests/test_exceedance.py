@@ -0,0 +1,142 @@
+import csv
+import datetime
+import gzip
+import random
+
+import pytest
+
+from ocems_tracker.exceedance import EventWriter, ExceedanceDetector
+
+THRESHOLDS = {("1", "pm"): 50.0, ("2", "pm"): 50.0, ("1", "so2"): 55.0}
+
+
+def make_rows(seed=1, n=300):
+    """Rows of 3 stations with 2 params each, with gaps and invalid values.
+    """
+    random.seed(seed)
+    rows = []
+    for station_id in (1, 2, 3):
+        for key in ("pm", "so2"):
+            t = datetime.datetime(2016, 1, 1)
+            for i in range(n):
+                t += datetime.timedelta(minutes=15 if random.random() > 0.05 else 120)
+                value = random.choice([10, 20, 60, "70", "", None, "x"])
+                rows.append([9, station_id, 100 + station_id, key, "PM", t.strftime("%Y-%m-%d %H:%M:%S:000"), value])
+    return rows
+
+
+def find_events(rows, max_gap=60):
+    """Finds the events one row at a time.
+    """
+    events = []
+    open_events = {}
+    for row in rows:
+        key = (str(row[0]), str(row[1]), str(row[2]), row[3])
+        threshold = THRESHOLDS.get((key[1], key[3]))
+        if threshold is None:
+            continue
+        t = datetime.datetime.strptime(row[5], "%Y-%m-%d %H:%M:%S:000")
+        try:
+            value = float(row[6])
+        except (TypeError, ValueError):
+            value = float("nan")
+
+        event = open_events.get(key)
+        if value > threshold:
+            if event and (t - event["end"]).total_seconds() <= max_gap * 60:
+                event["end"] = t
+                event["readings"] += 1
+                event["peak"] = max(event["peak"], value)
+            else:
+                if event:
+                    events.append(event)
+                open_events[key] = dict(key=key, start=t, end=t, readings=1, peak=value)
+        elif event:
+            events.append(open_events.pop(key))
+    events.extend(open_events.values())
+    return sorted((e["key"], e["start"], e["end"], e["readings"], e["peak"]) for e in events)
+
+
+def to_tuples(events):
+    def to_datetime(ms):
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=ms)
+    return sorted(((e.industry_id, e.station_id, e.device_id, e.param_key),
+                   to_datetime(e.start), to_datetime(e.end), e.readings, e.peak) for e in events)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 10000])
+def test_events_across_chunks(chunk_size):
+    rows = make_rows()
+    detector = ExceedanceDetector(THRESHOLDS, chunk_size=chunk_size)
+    events = list(detector.process(rows)) + detector.finish()
+    assert to_tuples(events) == find_events(rows)
+
+
+def test_single_event():
+    rows = [[9, 1, 101, "pm", "PM", f"2016-01-01 00:{m:02d}:00:000", v]
+            for m, v in [(0, 10), (15, 60), (30, 80), (45, 70), (59, 10)]]
+    detector = ExceedanceDetector(THRESHOLDS)
+    events = list(detector.process(rows))
+    assert len(events) == 1
+    assert events[0].to_row() == [
+        "9", "1", "101", "pm", 50.0, "2016-01-01 00:15:00:000", "2016-01-01 00:45:00:000",
+        30.0, 3, 80.0, "2016-01-01 00:30:00:000", 0]
+    assert detector.finish() == []
+
+
+def test_state_between_runs(tmp_path):
+    rows = make_rows()
+    detector = ExceedanceDetector(THRESHOLDS, chunk_size=33)
+    events = list(detector.process(rows[:1000]))
+    detector.save_state(tmp_path / "state.json")
+
+    # the next run overlaps with the rows already processed
+    detector = ExceedanceDetector(THRESHOLDS, chunk_size=33)
+    detector.load_state(tmp_path / "state.json")
+    events += list(detector.process(rows[900:])) + detector.finish()
+    assert to_tuples(events) == find_events(rows)
+
+
+def test_event_writer(tmp_path):
+    path = tmp_path / "events.csv.gz"
+    rows = make_rows()
+    detector = ExceedanceDetector(THRESHOLDS)
+    with EventWriter(path) as w:
+        w.write_events(detector.process(rows[:500]))
+    with EventWriter(path) as w:
+        w.write_events(detector.process(rows[500:]))
+        w.write_events(detector.finish(), ongoing=True)
+
+    with gzip.open(path, "rt") as f:
+        records = list(csv.DictReader(f))
+    assert len(records) == len(find_events(rows))
+
+
+def test_event_writer_rollback(tmp_path):
+    path = tmp_path / "events.csv.gz"
+    with pytest.raises(RuntimeError):
+        with EventWriter(path):
+            raise RuntimeError()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_unsorted_rows_in_chunk():
+    rows = make_rows()
+    shuffled = rows[:]
+    random.seed(2)
+    random.shuffle(shuffled)
+    detector = ExceedanceDetector(THRESHOLDS, chunk_size=len(rows))
+    events = list(detector.process(shuffled)) + detector.finish()
+    assert to_tuples(events) == find_events(rows)
+    assert detector.skipped_count == 0
+
+
+def test_late_rows_are_skipped():
+    rows = [[9, 1, 101, "pm", "PM", f"2016-01-01 00:{m:02d}:00:000", v]
+            for m, v in [(0, 10), (15, 60), (30, 10), (45, 10)]]
+    # a late reading, like the ones the merge appends to the archive files
+    rows.append([9, 1, 101, "pm", "PM", "2016-01-01 00:20:00:000", 90])
+    detector = ExceedanceDetector(THRESHOLDS, chunk_size=4)
+    events = list(detector.process(rows)) + detector.finish()
+    assert [e.peak for e in events] == [60.0]
+    assert detector.skipped_count == 1
@@ -0,0 +1,38 @@
+import time
+
+from ocems_tracker.archive import YearlyWriter
+from ocems_tracker.history import HistoryState
+
+
+def make_rows(first_day, last_day):
+    return [[1, 10, 20, "pm", "PM", f"2016-01-{day:02d} 00:00:00:000", day]
+            for day in range(first_day, last_day + 1)]
+
+
+def write_archive(root, rows):
+    w = YearlyWriter(1, root)
+    w.write_rows(rows)
+    w.commit()
+
+
+def test_load_from_archive(tmp_path):
+    write_archive(tmp_path / "archive", make_rows(1, 5))
+    state = HistoryState.load(tmp_path / "state", 1, archive_root=tmp_path / "archive")
+    assert state.get(10, 20, "pm") == "2016-01-05 00:00:00:000"
+
+
+def test_load_after_archive_replaced(tmp_path):
+    write_archive(tmp_path / "archive", make_rows(1, 5))
+    state = HistoryState.load(tmp_path / "state", 1, archive_root=tmp_path / "archive")
+    state.update(make_rows(9, 9)[0])
+    state.save()
+    assert HistoryState.load(tmp_path / "state", 1, archive_root=tmp_path / "archive").get(10, 20, "pm") == "2016-01-09 00:00:00:000"
+    time.sleep(0.01)
+
+    # like split_data replacing the files with older data
+    write_archive(tmp_path / "archive", make_rows(1, 3))
+    state = HistoryState.load(tmp_path / "state", 1, archive_root=tmp_path / "archive")
+    assert state.get(10, 20, "pm") == "2016-01-03 00:00:00:000"
+
+    # without the archive_root, the saved state is used as it is
+    assert HistoryState.load(tmp_path / "state", 1).get(10, 20, "pm") == "2016-01-09 00:00:00:000"
@@ -0,0 +1,142 @@
+import time
+
+import pytest
+
+from ocems_tracker.archive import YearlyWriter, append_file, recover_append
+from ocems_tracker.manifest import Manifest, compute_md5
+from ocems_tracker.history import HistoryState
+from ocems_tracker.merge import ArchiveMerger, external_sort, read_csv_rows, row_key, unique
+
+
+def make_rows(first_day, last_day, industry_id=1):
+    return [[industry_id, 10, 20, "pm", "PM, 2.5", f"2016-01-{day:02d} {hour:02d}:00:00:000", day * hour]
+            for day in range(first_day, last_day + 1) for hour in range(0, 24, 6)]
+
+
+def read_keys(root, industry_id=1):
+    rows = list(read_csv_rows(root / "archive" / "2016" / f"{industry_id}.csv.gz"))
+    return [row_key(row) for row in rows]
+
+
+def test_external_sort(tmp_path):
+    rows = make_rows(1, 10)[::-1]
+    # the rows written to disk are read back as strings
+    expected = sorted(row_key(row) for row in rows)
+    assert [row_key(row) for row in external_sort(rows, row_key, 7, tmp_path)] == expected
+    assert [row_key(row) for row in external_sort(rows, row_key, 1000, tmp_path)] == expected
+
+
+def test_unique():
+    rows = sorted(make_rows(1, 2) + make_rows(2, 3), key=row_key)
+    assert len(list(unique(rows, row_key))) == 12
+
+
+def test_merge_overlapping_windows(tmp_path):
+    merger = ArchiveMerger(tmp_path / "archive", tmp_path / "state")
+    assert merger.merge(make_rows(1, 4))["added"] == 16
+
+    counts = merger.merge(make_rows(3, 7) + make_rows(5, 6))
+    assert counts["added"] == 12
+    assert counts["duplicates"] == 8
+
+    keys = read_keys(tmp_path)
+    assert len(keys) == len(set(keys)) == 28
+
+
+def test_merge_late_and_old_rows(tmp_path):
+    merger = ArchiveMerger(tmp_path / "archive", tmp_path / "state")
+    merger.merge(make_rows(1, 7))
+
+    # a gap in the recent window and one before it
+    late = [[1, 10, 20, "pm", "PM, 2.5", "2016-01-06 03:00:00:000", 1]]
+    old = [[1, 10, 20, "pm", "PM, 2.5", "2016-01-01 03:00:00:000", 1]]
+    counts = merger.merge(late + old + make_rows(1, 7))
+    assert counts == dict(added=2, duplicates=28, late=30)
+
+    keys = read_keys(tmp_path)
+    assert len(keys) == len(set(keys)) == 30
+
+
+def test_merge_backfill_using_external_sort(tmp_path):
+    ArchiveMerger(tmp_path / "archive", tmp_path / "state").merge(make_rows(1, 7))
+
+    merger = ArchiveMerger(tmp_path / "archive", tmp_path / "state", window_days=1, max_rows=3)
+    counts = merger.merge(make_rows(1, 8))
+    assert counts["added"] == 4
+
+    keys = read_keys(tmp_path)
+    assert len(keys) == len(set(keys)) == 32
+
+
+def test_merge_after_rows_appended_outside_the_merge(tmp_path):
+    merger = ArchiveMerger(tmp_path / "archive", tmp_path / "state")
+    merger.merge(make_rows(1, 4))
+    time.sleep(0.01)
+
+    # like historical_data --incremental, which saves only the history state
+    state = HistoryState.load(tmp_path / "state", 1)
+    w = YearlyWriter(1, tmp_path / "archive", append=True)
+    for row in make_rows(5, 6):
+        w.write_row(row)
+        state.update(row)
+    w.commit()
+    state.save()
+
+    counts = merger.merge(make_rows(3, 7))
+    assert counts["added"] == 4
+
+    keys = read_keys(tmp_path)
+    assert len(keys) == len(set(keys)) == 28
+
+
+def test_append_in_place(tmp_path):
+    ArchiveMerger(tmp_path / "archive", tmp_path / "state").merge(make_rows(1, 4))
+    path = tmp_path / "archive" / "2016" / "1.csv.gz"
+    before = path.read_bytes()
+
+    ArchiveMerger(tmp_path / "archive", tmp_path / "state").merge(make_rows(5, 6))
+    # the existing gzip streams are kept as they are
+    assert path.read_bytes().startswith(before)
+    assert len(read_keys(tmp_path)) == 24
+
+    # the md5 is computed only when the manifest is refreshed
+    manifest = Manifest.for_archive(tmp_path / "archive")
+    assert manifest.get("2016/1.csv.gz").md5 is None
+    assert manifest.refresh() == 1
+    assert manifest.get("2016/1.csv.gz").md5 == compute_md5(path)
+    assert manifest.get("2016/1.csv.gz").rows == 24
+
+
+def test_rollback_of_append(tmp_path):
+    ArchiveMerger(tmp_path / "archive", tmp_path / "state").merge(make_rows(1, 4))
+    path = tmp_path / "archive" / "2016" / "1.csv.gz"
+    before = path.read_bytes()
+
+    w = YearlyWriter(1, tmp_path / "archive", append=True)
+    w.write_rows(make_rows(5, 6))
+    w.flush()
+    w.rollback()
+    assert path.read_bytes() == before
+    assert sorted(p.name for p in path.parent.iterdir()) == ["1.csv.gz"]
+
+
+def test_recover_interrupted_append(tmp_path, monkeypatch):
+    path = tmp_path / "a.gz"
+    path.write_bytes(b"abc")
+    src = tmp_path / "b.gz"
+    src.write_bytes(b"def")
+
+    def copy_and_crash(f, out):
+        out.write(f.read(1))
+        raise KeyboardInterrupt()
+    monkeypatch.setattr("shutil.copyfileobj", copy_and_crash)
+    with pytest.raises(KeyboardInterrupt):
+        append_file(path, src)
+    assert path.read_bytes() == b"abc"
+
+    # a crash that leaves the journal behind is undone by recover_append
+    path.write_bytes(b"abcd")
+    (tmp_path / "a.gz.append").write_text("3")
+    recover_append(path)
+    assert path.read_bytes() == b"abc"
+    assert not (tmp_path / "a.gz.append").exists()
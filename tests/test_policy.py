@@ -0,0 +1,169 @@
+import datetime
+from email.utils import format_datetime
+
+import pytest
+import requests
+
+from ocems_tracker import policy
+from ocems_tracker.policy import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, RequestPolicy, get_retry_after
+
+
+def make_response(status_code=200, content=b"{}", headers=None):
+    r = requests.Response()
+    r.status_code = status_code
+    r.reason = "Reason"
+    r._content = content
+    r.headers.update(headers or {})
+    return r
+
+
+class FakeSession:
+    """Session that returns the given responses, or raises them if they are exceptions.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        r = self.responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+
+class Clock:
+    def __init__(self):
+        self.t = 1000.0
+
+    def monotonic(self):
+        return self.t
+
+    def sleep(self, seconds):
+        self.t += seconds
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(policy.time, "sleep", sleeps.append)
+    return sleeps
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(policy.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(policy.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_retries_failed_requests(sleeps):
+    session = FakeSession([make_response(503), requests.ConnectionError(), make_response(200)])
+    p = RequestPolicy(session, retries=3, backoff=1, max_backoff=2)
+    assert p.get("https://example.com").status_code == 200
+    assert session.calls == 3
+    assert len(sleeps) == 2
+    assert all(0 <= s <= 2 for s in sleeps)
+
+
+def test_raises_after_retries(sleeps):
+    session = FakeSession([make_response(500)] * 3)
+    p = RequestPolicy(session, retries=3)
+    with pytest.raises(requests.HTTPError):
+        p.get("https://example.com")
+    assert session.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_client_errors_are_not_retried(sleeps):
+    session = FakeSession([make_response(404)])
+    p = RequestPolicy(session)
+    with pytest.raises(requests.HTTPError):
+        p.get_json("https://example.com")
+    assert session.calls == 1
+    assert sleeps == []
+
+
+def test_honors_retry_after(sleeps):
+    session = FakeSession([make_response(429, headers={"Retry-After": "120"}), make_response(200)])
+    p = RequestPolicy(session, max_backoff=60)
+    p.get("https://example.com")
+    assert sleeps == [120]
+
+
+def test_retry_after_is_capped(sleeps):
+    session = FakeSession([make_response(503, headers={"Retry-After": "3600"}), make_response(200)])
+    p = RequestPolicy(session, max_retry_after=600)
+    p.get("https://example.com")
+    assert sleeps == [600]
+
+
+def test_retries_unparsable_responses(sleeps):
+    session = FakeSession([make_response(200, b'{"a": '), make_response(200, b'{"a": 1}')])
+    p = RequestPolicy(session)
+    assert p.get_json("https://example.com") == {"a": 1}
+    assert session.calls == 2
+    assert len(sleeps) == 1
+
+
+def test_get_retry_after():
+    assert get_retry_after(make_response(429)) is None
+    assert get_retry_after(make_response(429, headers={"Retry-After": "30"})) == 30
+    assert get_retry_after(make_response(429, headers={"Retry-After": "-5"})) == 0
+    assert get_retry_after(make_response(429, headers={"Retry-After": "soon"})) is None
+
+    t = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=100)
+    seconds = get_retry_after(make_response(503, headers={"Retry-After": format_datetime(t, usegmt=True)}))
+    assert 90 < seconds <= 100
+
+    t = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=100)
+    assert get_retry_after(make_response(503, headers={"Retry-After": format_datetime(t, usegmt=True)})) == 0
+
+
+def test_circuit_breaker_opens(clock):
+    breaker = CircuitBreaker(window=10, error_rate=0.5, min_requests=4, cooldown=60)
+    for ok in [True, False, True]:
+        breaker.record(ok)
+    assert breaker.get_state() == CLOSED
+
+    breaker.record(False)
+    assert breaker.get_state() == OPEN
+
+    # the requests that were in flight don't change the state
+    breaker.record(True)
+    assert breaker.get_state() == OPEN
+
+    breaker.wait()
+    assert clock.t == 1060
+    assert breaker.get_state() == HALF_OPEN
+
+
+def test_circuit_breaker_half_open(clock):
+    breaker = CircuitBreaker(min_requests=2, cooldown=60)
+    breaker.record(False)
+    breaker.record(False)
+    breaker.wait()
+    assert breaker.get_state() == HALF_OPEN
+
+    # a failure after the cooldown opens the circuit again right away
+    breaker.record(False)
+    assert breaker.get_state() == OPEN
+
+    breaker.wait()
+    breaker.record(True)
+    assert breaker.get_state() == CLOSED
+
+    # once closed, it takes min_requests failures to open again
+    breaker.record(False)
+    assert breaker.get_state() == CLOSED
+
+
+def test_policy_waits_for_open_circuit(clock):
+    breaker = CircuitBreaker(min_requests=2, cooldown=60)
+    session = FakeSession([make_response(500), make_response(500), make_response(200)])
+    p = RequestPolicy(session, retries=3, backoff=0, circuit_breaker=breaker)
+    start = clock.t
+    assert p.get("https://example.com").status_code == 200
+    assert clock.t - start >= 60
+    assert breaker.get_state() == CLOSED
@@ -0,0 +1,38 @@
+import csv
+import gzip
+
+from ocems_tracker.rollup import Rollup
+
+
+def add_rows(rollup):
+    for hour in range(24):
+        rollup.add(10, 20, "pm", f"2016-01-01 {hour:02d}:00:00:000", hour)
+
+
+def read_daily(root):
+    with gzip.open(root / "2016" / "1.csv.gz", "rt") as f:
+        return [row for row in csv.DictReader(f) if row["period"] == "day"]
+
+
+def test_spill(tmp_path):
+    rollup = Rollup(1, tmp_path, max_entries=5)
+    add_rows(rollup)
+    rollup.commit()
+
+    [row] = read_daily(tmp_path)
+    assert row["count"] == "24"
+    assert float(row["sum"]) == sum(range(24))
+    assert sorted(p.name for p in (tmp_path / "2016").iterdir()) == ["1.csv.gz"]
+
+
+def test_spill_of_killed_worker_is_not_read(tmp_path):
+    rollup = Rollup(1, tmp_path, max_entries=5)
+    add_rows(rollup)
+    rollup.spill()
+    # the worker is killed without a rollback, leaving the spill file behind
+
+    rollup = Rollup(1, tmp_path, max_entries=5)
+    add_rows(rollup)
+    rollup.commit()
+    [row] = read_daily(tmp_path)
+    assert row["count"] == "24"
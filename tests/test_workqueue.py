@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from ocems_tracker.workqueue import DONE, FAILED, Heartbeat, LeaseLost, WorkQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = WorkQueue(tmp_path / "queue.db", lease_timeout=60, max_attempts=2)
+    q.init(list(range(1, 8)), shard_size=3)
+    return q
+
+
+def expire_lease(queue, shard):
+    queue.db.execute("UPDATE shards SET lease_until=? WHERE id=?", [time.time() - 1, shard.id])
+
+
+def test_init_skips_existing(queue):
+    assert queue.init([5, 6, 7, 8]) == 1
+    assert queue.status()["industries"] == 8
+
+
+def test_claim_all_shards(queue):
+    shards = [queue.claim("a"), queue.claim("b"), queue.claim("c")]
+    assert [s.industry_ids for s in shards] == [[1, 2, 3], [4, 5, 6], [7]]
+    assert queue.claim("d") is None
+
+
+def test_expired_lease_is_claimed_again(queue):
+    shard = queue.claim("a")
+    queue.mark_done(shard, 1, rows=10)
+    expire_lease(queue, shard)
+
+    shard2 = queue.claim("b")
+    assert shard2.id == shard.id
+    assert shard2.pending_ids == [2, 3]
+
+    # the old worker can't renew or complete the shard anymore
+    with pytest.raises(LeaseLost):
+        queue.heartbeat(shard)
+    queue.complete(shard)
+    assert queue.status()["shards"][DONE] == 0
+
+    queue.complete(shard2)
+    assert queue.status()["shards"][DONE] == 1
+
+
+def test_heartbeat_renews_lease(queue):
+    shard = queue.claim("a")
+    expire_lease(queue, shard)
+    queue.heartbeat(shard)
+    assert queue.status()["expired_leases"] == 0
+
+
+def test_heartbeat_thread_detects_lost_lease(queue):
+    shard = queue.claim("a")
+    expire_lease(queue, shard)
+    queue.claim("b")
+    queue.claim("b")
+    queue.claim("b")
+    with Heartbeat(queue, shard, interval=0.01) as hb:
+        assert hb.lost.wait(5)
+
+
+def test_fail_retries_then_gives_up(queue):
+    shard = queue.claim("a")
+    queue.fail(shard, "error 1")
+    shard = queue.claim("a")
+    assert shard.id == 1
+    queue.fail(shard, "error 2")
+
+    assert queue.status()["shards"][FAILED] == 1
+    assert queue.claim("a").id == 2
+
+
+def test_release_does_not_count_as_attempt(queue):
+    for _ in range(3):
+        shard = queue.claim("a")
+        assert shard.id == 1
+        queue.release(shard)
+    queue.fail(queue.claim("a"), "error")
+    assert queue.claim("a").id == 1